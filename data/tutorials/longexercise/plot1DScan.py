@@ -9,8 +9,11 @@ from functools import partial
 
 from six.moves import range
 
+import numpy
+
 import CombineHarvester.CombineTools.plotting as plot
 import ROOT
+from HiggsAnalysis.CombinedLimit.ColumnarOutput import isColumnar, loadArrays
 
 ROOT.PyConfig.IgnoreCommandLineOptions = True
 ROOT.gROOT.SetBatch(ROOT.kTRUE)
@@ -23,9 +26,17 @@ NAMECOUNTER = 0
 
 
 def read(scan, param, files, ycut):
-    goodfiles = [f for f in files if plot.TFileIsGood(f)]
-    limit = plot.MakeTChain(goodfiles, "limit")
-    graph = plot.TGraphFromTree(limit, param, "2*deltaNLL", "quantileExpected > -1.5")
+    if all([isColumnar(f) for f in files]):
+        # columnar exports of the scan (see limitTreeToColumnar.py), loaded as arrays
+        cols = loadArrays(files, [param, "deltaNLL", "quantileExpected"])
+        sel = cols["quantileExpected"] > -1.5
+        x = numpy.ascontiguousarray(cols[param][sel], dtype=numpy.float64)
+        y = numpy.ascontiguousarray(2 * cols["deltaNLL"][sel], dtype=numpy.float64)
+        graph = ROOT.TGraph(len(x), x, y)
+    else:
+        goodfiles = [f for f in files if plot.TFileIsGood(f)]
+        limit = plot.MakeTChain(goodfiles, "limit")
+        graph = plot.TGraphFromTree(limit, param, "2*deltaNLL", "quantileExpected > -1.5")
     graph.SetName(scan)
     graph.Sort()
     plot.RemoveGraphXDuplicates(graph)
@@ -97,7 +108,7 @@ def BuildScan(scan, param, files, color, yvals, ycut):
 
 parser = argparse.ArgumentParser()
 
-parser.add_argument("main", help="Main input file for the scan")
+parser.add_argument("main", help="Main input file for the scan (ROOT file, or its npz/parquet export)")
 parser.add_argument("--y-cut", type=float, default=7.0, help="Remove points with y > y-cut")
 parser.add_argument("--y-max", type=float, default=8.0, help="y-axis maximum")
 parser.add_argument("--output", "-o", help="output name without file extension", default="scan")
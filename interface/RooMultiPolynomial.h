@@ -0,0 +1,33 @@
+#ifndef HiggsAnalysis_CombinedLimit_RooMultiPolynomial_h
+#define HiggsAnalysis_CombinedLimit_RooMultiPolynomial_h
+#include <RooAbsReal.h>
+#include <RooListProxy.h>
+#include <vector>
+
+// Polynomial in any number of variables, constant + sum_i coefficient_i * prod_j vars[index_ij],
+// evaluated in a single loop instead of one RooProduct per term and RooAdditions of the terms.
+// The terms are stored flat: termSizes[i] is the number of factors of term i (a variable appears
+// as many times as its power), and termVars lists the index in vars of each factor, term after term.
+class RooMultiPolynomial : public RooAbsReal {
+    public:
+        RooMultiPolynomial() {}
+        RooMultiPolynomial(const char *name, const char *title, const RooArgList &vars, const std::vector<double> &coefficients,
+                           const std::vector<int> &termSizes, const std::vector<int> &termVars, double constant=1.0);
+        RooMultiPolynomial(const RooMultiPolynomial& other, const char* name=0);
+        virtual ~RooMultiPolynomial() {}
+        virtual TObject *clone(const char *newname) const { return new RooMultiPolynomial(*this,newname); }
+        const RooArgList & variables() const { return vars_; }
+        unsigned int nTerms() const { return coefficients_.size(); }
+    protected:
+        RooListProxy vars_;
+        double constant_;
+        std::vector<double> coefficients_;
+        std::vector<int> termSizes_;
+        std::vector<int> termVars_;
+        mutable std::vector<double> values_; //! not to be serialized
+        virtual Double_t evaluate() const ;
+    private:
+        ClassDef(RooMultiPolynomial,1)
+};
+
+#endif
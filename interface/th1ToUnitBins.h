@@ -0,0 +1,13 @@
+#ifndef HiggsAnalysis_CombinedLimit_th1ToUnitBins_h
+#define HiggsAnalysis_CombinedLimit_th1ToUnitBins_h
+
+#include "TH1.h"
+
+// Copy the contents and errors of the first nbins bins of hist into a new TH1F
+// with nbins bins of unit width in [0, nbins]. Bins beyond the range of hist are
+// left empty; nbins <= 0 means the number of bins of hist. This is the bulk
+// version of the copy done in ShapeBuilder.rebinH1, which would otherwise need
+// two PyROOT calls per bin.
+TH1F *th1ToUnitBins(const char *name, const TH1 &hist, Int_t nbins=-1) ;
+
+#endif
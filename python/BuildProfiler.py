@@ -0,0 +1,98 @@
+from __future__ import absolute_import, print_function
+
+import json
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+
+def peakRSS(who=resource.RUSAGE_SELF):
+    """Return the peak resident set size in MB (of this process, or of its terminated children)"""
+    maxrss = resource.getrusage(who).ru_maxrss
+    # ru_maxrss is in kB on linux, but in bytes on macOS
+    return maxrss / (1024.0 * 1024.0) if sys.platform == "darwin" else maxrss / 1024.0
+
+
+class BuildProfiler(object):
+    """
+    Records, for each stage of the building of a workspace, the wall and cpu time spent in it, the increase of a set
+    of counters (e.g. the number of RooWorkspace factory calls and imports) and the peak memory at its end. Stages can
+    be nested, and are identified by the path of their names (e.g. doIndividualModels/ch1). If not enabled, nothing
+    is recorded.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        ## list of the stages, in the order in which they were started
+        self.stages = []
+        ## dict of {counter name : function returning its current value}
+        self.counters = {}
+        self._stack = []
+        self._start = (time.time(), self.cpuTime())
+
+    def cpuTime(self):
+        t = os.times()
+        return t[0] + t[1]
+
+    def addCounter(self, name, func):
+        self.counters[name] = func
+
+    def begin(self, name):
+        if not self.enabled:
+            return
+        path = self._stack[-1]["path"] + "/" + name if self._stack else name
+        record = {"stage": name, "path": path, "depth": len(self._stack)}
+        record["_start"] = (time.time(), self.cpuTime(), dict([(k, f()) for (k, f) in self.counters.items()]))
+        self.stages.append(record)
+        self._stack.append(record)
+
+    def end(self):
+        if not self.enabled:
+            return
+        record = self._stack.pop()
+        wall, cpu, counts = record.pop("_start")
+        record["wallTime"] = time.time() - wall
+        record["cpuTime"] = self.cpuTime() - cpu
+        for k, f in self.counters.items():
+            record[k] = f() - counts.get(k, 0)
+        record["peakRSS"] = peakRSS()
+
+    @contextmanager
+    def stage(self, name):
+        self.begin(name)
+        try:
+            yield
+        finally:
+            self.end()
+
+    def report(self):
+        """Return the profile as a dictionary"""
+        ret = {
+            "wallTime": time.time() - self._start[0],
+            "cpuTime": self.cpuTime() - self._start[1],
+            "peakRSS": peakRSS(),
+            "peakRSSChildren": peakRSS(resource.RUSAGE_CHILDREN),
+            "stages": self.stages,
+        }
+        for k, f in self.counters.items():
+            ret[k] = f()
+        return ret
+
+    def write(self, fname):
+        """Write the profile to a JSON file"""
+        with open(fname, "w") as fout:
+            json.dump(self.report(), fout, indent=2, sort_keys=True)
+
+    def summary(self):
+        """Return a table with the time spent in each stage. The counters registered after a stage ended are shown as '-' for it"""
+        counters = sorted(self.counters.keys())
+        lines = ["%-50s %10s %10s %s %10s" % ("stage", "wall [s]", "cpu [s]", " ".join(["%12s" % k for k in counters]), "RSS [MB]")]
+        for s in self.stages:
+            if "wallTime" not in s:
+                continue
+            name = "  " * s["depth"] + s["stage"]
+            counts = " ".join([("%12d" % s[k]) if k in s else "%12s" % "-" for k in counters])
+            lines.append("%-50s %10.3f %10.3f %s %10.1f" % (name, s["wallTime"], s["cpuTime"], counts, s["peakRSS"]))
+        return "\n".join(lines)
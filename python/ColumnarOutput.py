@@ -0,0 +1,105 @@
+from __future__ import absolute_import, print_function
+
+import os
+from collections import OrderedDict
+
+import numpy
+
+import ROOT
+
+COLUMNAR_EXTENSIONS = [".npz", ".parquet"]
+
+# types of the branches that are exported (all those of the limit tree: POIs, deltaNLL, quantileExpected, tracked parameters...)
+_scalarTypes = ["Char_t", "UChar_t", "Bool_t", "Short_t", "UShort_t", "Int_t", "UInt_t", "Long64_t", "ULong64_t", "Float_t", "Double_t"]
+
+
+def isColumnar(fname):
+    """True if fname is a columnar export of a combine output (npz or parquet file)"""
+    return os.path.splitext(fname)[1] in COLUMNAR_EXTENSIONS
+
+
+def scalarBranches(tree):
+    """Return the names of the branches of the tree with a single number per entry"""
+    return [l.GetName() for l in tree.GetListOfLeaves() if l.GetTypeName() in _scalarTypes and l.GetLen() == 1]
+
+
+def treeToArrays(files, treename="limit", branches=None, selection=""):
+    """
+    Read the tree treename from the files into a dictionary of {branch name : numpy array}, in a single pass with
+    RDataFrame. All the scalar branches are read if branches is None, and only the entries passing the selection are kept.
+    """
+    chain = ROOT.TChain(treename)
+    for fname in files:
+        chain.Add(fname)
+    if chain.GetEntries() == 0:
+        raise RuntimeError("No entries in tree %s of %s" % (treename, ", ".join(files)))
+    chain.LoadTree(0)
+    if branches is None:
+        branches = scalarBranches(chain)
+    df = ROOT.RDataFrame(chain)
+    if selection:
+        df = df.Filter(selection)
+    cols = df.AsNumpy(branches)
+    return OrderedDict([(b, numpy.asarray(cols[b])) for b in branches])
+
+
+def writeColumnar(arrays, fname, compress=False):
+    """Write a dictionary of {column name : numpy array} to a npz or parquet file"""
+    ext = os.path.splitext(fname)[1]
+    if ext == ".npz":
+        if compress:
+            numpy.savez_compressed(fname, **arrays)
+        else:
+            numpy.savez(fname, **arrays)
+    elif ext == ".parquet":
+        import pandas
+
+        pandas.DataFrame(arrays).to_parquet(fname, compression="snappy" if compress else None)
+    else:
+        raise RuntimeError("Unknown columnar format for %s, the extension should be one of %s" % (fname, ", ".join(COLUMNAR_EXTENSIONS)))
+
+
+def readColumnar(fname, columns=None):
+    """Read the columns (all of them if None) of a npz or parquet file into a dictionary of {column name : numpy array}"""
+    ext = os.path.splitext(fname)[1]
+    if ext == ".npz":
+        with numpy.load(fname) as fin:
+            for c in columns or []:
+                if c not in fin.files:
+                    raise RuntimeError("No column %s in %s" % (c, fname))
+            return OrderedDict([(c, fin[c]) for c in (columns or fin.files)])
+    elif ext == ".parquet":
+        import pandas
+
+        try:
+            df = pandas.read_parquet(fname, columns=columns)
+        except (KeyError, ValueError) as e:
+            raise RuntimeError("Cannot read columns %s of %s: %s" % (columns, fname, e))
+        return OrderedDict([(c, df[c].values) for c in df.columns])
+    raise RuntimeError("Unknown columnar format for %s, the extension should be one of %s" % (fname, ", ".join(COLUMNAR_EXTENSIONS)))
+
+
+def loadArrays(files, columns=None, treename="limit"):
+    """
+    Load the columns (all the scalar branches if None) of combine outputs as a dictionary of {column name : numpy array},
+    concatenating the files in order. The files can be columnar exports or ROOT files, whose tree treename is read.
+    """
+    if isinstance(files, str):
+        files = [files]
+    parts = []
+    rootFiles = []
+    for fname in files:
+        if isColumnar(fname):
+            if rootFiles:
+                parts.append(treeToArrays(rootFiles, treename, columns))
+                rootFiles = []
+            parts.append(readColumnar(fname, columns))
+        else:
+            rootFiles.append(fname)
+    if rootFiles:
+        parts.append(treeToArrays(rootFiles, treename, columns))
+    if len(parts) == 1:
+        return parts[0]
+    if columns is None:
+        columns = [c for c in parts[0] if all([c in p for p in parts])]
+    return OrderedDict([(c, numpy.concatenate([p[c] for p in parts])) for c in columns])
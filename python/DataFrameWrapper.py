@@ -10,38 +10,52 @@ import ROOT
 class DataFrameWrapper(object):
     th1_class = "TH1F"
 
-    def __init__(self, path, ext, load=True):
+    def __init__(self, path, ext, load=True, lazy=False):
         """
         path: file system path to the dataframe on disk
         ext: file extension used to interpret the file based on pandas IO
         load: skip loading the dataframe if False
+        lazy: defer loading the dataframe to the first Get, and then read
+            only the columns that are requested (when the format allows it)
         """
         self.path = path
         self.ext = ext
 
         self.read_args = []
         self.read_kwargs = {}
-        if load:
+        self.lazy = lazy
+        self.columns = None
+        self._index_dtypes = None
+        self._groups = {}
+        if load and not lazy:
             self.df = self.load_dataframe()
 
-    def load_dataframe(self):
+    def load_dataframe(self, columns=None):
         """
         Use pandas IO tools to load a dataframe from any of the following:
         ["csv", "json", "html", "pkl", "xlsx", "h5", "parquet"]
+
+        columns: if not None, keep only these columns (on top of the index).
+            They are the only ones read from disk for csv, h5 (table format)
+            and parquet files.
         """
         # Index all columns apart from the last 2 (taken as sum_w and sum_ww)
         # for csv, json, html and xlsx
         if self.ext == ".csv":
-            df = pd.read_csv(self.path, *self.read_args, **self.read_kwargs)
-            return df.set_index(df.columns.tolist()[:-2])
+            if columns is None:
+                df = pd.read_csv(self.path, *self.read_args, **self.read_kwargs)
+                return df.set_index(df.columns.tolist()[:-2])
+            index = pd.read_csv(self.path, nrows=0, *self.read_args, **self.read_kwargs).columns.tolist()[:-2]
+            df = pd.read_csv(self.path, usecols=index + list(columns), *self.read_args, **self.read_kwargs)
+            return df.set_index(index)[list(columns)]
         elif self.ext == ".json":
             df = pd.read_json(self.path, *self.read_args, **self.read_kwargs)
-            return df.set_index(df.columns.tolist()[:-2])
+            df = df.set_index(df.columns.tolist()[:-2])
         elif self.ext == ".html":
             df = pd.read_html(self.path, *self.read_args, **self.read_kwargs)
-            return df.set_index(df.columns.tolist()[:-2])
+            df = df.set_index(df.columns.tolist()[:-2])
         elif self.ext == ".pkl":
-            return pd.read_pickle(self.path, *self.read_args, **self.read_kwargs)
+            df = pd.read_pickle(self.path, *self.read_args, **self.read_kwargs)
         elif self.ext == ".xlsx":
             if ":" in self.path:
                 filepath, sheetname = self.path.split(":")
@@ -50,13 +64,49 @@ class DataFrameWrapper(object):
 
             # read in columns first
             cols = pd.read_excel(self.path, sheetname, *self.read_args, **self.read_kwargs).columns.tolist()
-            return pd.read_excel(self.path, sheetname, index_col=list(range(len(cols) - 2)), *self.read_args, **self.read_kwargs)
+            df = pd.read_excel(self.path, sheetname, index_col=list(range(len(cols) - 2)), *self.read_args, **self.read_kwargs)
         elif self.ext == ".h5":
             filepath, internalpath = self.path.split(":")
-            return pd.read_hdf(filepath, internalpath, *self.read_args, **self.read_kwargs)
+            if columns is not None:
+                try:
+                    return pd.read_hdf(filepath, internalpath, columns=list(columns), *self.read_args, **self.read_kwargs)
+                except (TypeError, ValueError):
+                    # column selection is only possible for the table format
+                    pass
+            df = pd.read_hdf(filepath, internalpath, *self.read_args, **self.read_kwargs)
         elif self.ext == ".parquet":
-            return pd.read_parquet(self.path, *self.read_args, **self.read_kwargs)
-        return None
+            df = pd.read_parquet(self.path, columns=columns, *self.read_args, **self.read_kwargs)
+        else:
+            return None
+        return df if columns is None else df[list(columns)]
+
+    def load_columns(self, columns):
+        """
+        Make sure that the columns are loaded. In lazy mode the dataframe is
+        (re)loaded with the union of the columns requested so far.
+        """
+        if hasattr(self, "df") and (self.columns is None or set(columns) <= set(self.columns)):
+            return
+        if not self.lazy:
+            raise AttributeError("Dataframe has not been loaded")
+        self.columns = sorted(set(columns) | set(self.columns or []))
+        self.df = self.load_dataframe(self.columns)
+        self._index_dtypes = None
+        self._groups = {}
+
+    def group_index(self, columns):
+        """
+        Return the values of the columns as an array, and a dictionary from
+        each index without the last (bin) level to the positions of its rows,
+        built with a single pass over the dataframe.
+        """
+        key = tuple(columns)
+        if key not in self._groups:
+            levels = list(range(self.df.index.nlevels - 1))
+            groups = self.df.groupby(level=levels, sort=False).indices
+            groups = dict(((k if isinstance(k, tuple) else (k,)), v) for (k, v) in groups.items())
+            self._groups[key] = (self.df[list(columns)].values.astype(np.float64), groups)
+        return self._groups[key]
 
     def Get(self, object_name):
         """
@@ -67,35 +117,55 @@ class DataFrameWrapper(object):
             the index (125, bin1, signal, sigmaUp) and columns (event_count,
             event_variance)
         """
+        index_labels, column_labels = object_name.split(",")
+        columns = column_labels.split(":")
+        if self.lazy:
+            self.load_columns(columns)
         if not hasattr(self, "df"):
             raise AttributeError("Dataframe has not been loaded")
-
-        index_labels, column_labels = object_name.split(",")
+        if self._index_dtypes is None:
+            self._index_dtypes = [self.df.index.get_level_values(idx).dtype for idx in range(self.df.index.nlevels)]
 
         # Try to cast index_labels into self.df.index dtypes. Users can only
         # input index_labels as a string, but the dataframe might have other
         # dtypes (e.g. int, float, ...)
-        selection = [
-            np.array([index_labels.split(":")[idx]]).astype(self.df.index.get_level_values(idx).dtype)[0] for idx in range(len(index_labels.split(":")))
-        ]
-
-        df_hist = self.df.loc[tuple(selection), column_labels.split(":")]
+        selection = tuple(np.array([label]).astype(self._index_dtypes[idx])[0] for (idx, label) in enumerate(index_labels.split(":")))
 
         # index name used for th1 name
-        df_hist.index.names = [index_labels.replace(":", "_")]
+        name = index_labels.replace(":", "_")
+        if len(selection) == self.df.index.nlevels - 1 and len(columns) == 2:
+            values, groups = self.group_index(columns)
+            if selection not in groups:
+                raise KeyError(selection)
+            rows = values[groups[selection]]
+            return self.array_to_th1(name, rows[:, 0], rows[:, 1], self.th1_class)
+
+        df_hist = self.df.loc[selection, columns]
+        df_hist.index.names = [name]
         return self.convert_to_th1(df_hist, self.th1_class)
 
+    @staticmethod
+    def array_to_th1(name, sum_w, sum_ww, th1_class):
+        """
+        Convert arrays of bin contents and squared errors to a TH1 with unit
+        bins. Last bin is overflow.
+        """
+        nbins = len(sum_w) - 1
+        th1 = getattr(ROOT, th1_class)(name, name, nbins, 0.0, float(nbins))
+        # the arrays include the underflow bin, left empty
+        content = np.zeros(nbins + 2, dtype=np.float64)
+        content[1:] = sum_w
+        error = np.zeros(nbins + 2, dtype=np.float64)
+        error[1:] = np.sqrt(sum_ww)
+        th1.SetContent(content)
+        th1.SetError(error)
+        return th1
+
     @staticmethod
     def convert_to_th1(df, th1_class):
         """
         Receive a dataframe and convert it to a TH1. Index is taken as the
         binning for labelling. Last bin is overflow.
         """
-        name = df.index.names[0]
-        nbins = df.shape[0] - 1
-        th1 = getattr(ROOT, th1_class)(name, name, nbins, 0.0, float(nbins))
-        for i in range(nbins + 1):
-            sum_w, sum_ww = df.iloc[i]
-            th1.SetBinContent(i + 1, sum_w)
-            th1.SetBinError(i + 1, np.sqrt(sum_ww))
-        return th1
+        values = df.values.astype(np.float64)
+        return DataFrameWrapper.array_to_th1(df.index.names[0], values[:, 0], values[:, 1], th1_class)
@@ -1,6 +1,261 @@
 from __future__ import print_function
 
 import six
+from six.moves.collections_abc import MutableMapping
+
+
+class ErrlineColumns(object):
+    """
+    Index of the (bin, process) columns of the keyline, shared by all the sparse errlines of a datacard. Columns for
+    pairs that are not in the keyline are appended when a value is first set for them.
+    """
+
+    def __init__(self, keyline=[]):
+        ## list of [(bin, process)], by column index
+        self.columns = []
+        ## dict of {(bin, process) : column index}
+        self.index = {}
+        ## dict of {bin : [processes]}, in keyline order
+        self.binProcs = {}
+        self.bins = []
+        for b, p, s in keyline:
+            self.add(b, p)
+
+    def add(self, b, p):
+        col = self.index.get((b, p))
+        if col is None:
+            col = len(self.columns)
+            self.columns.append((b, p))
+            self.index[(b, p)] = col
+            if b not in self.binProcs:
+                self.binProcs[b] = []
+                self.bins.append(b)
+            self.binProcs[b].append(p)
+        return col
+
+
+class SparseErrline(MutableMapping):
+    """
+    Sparse version of the errline of a systematic, as filled by parseCard with the sparseDatacard option. Only the
+    entries different from 0 are stored, as a dict of {column index : value}, but it can be used as the usual dict
+    of {bin : {process : value}}, with a value of 0.0 for all the processes of the bin that are not affected.
+    """
+
+    def __init__(self, columns, values=None, packed=None):
+        self.columns = columns
+        self._values = values if values is not None or packed is not None else {}
+        ## (columns, values, {column : value}) of a card loaded from a binary datacard, see values
+        self._packed = packed
+        self._bins = {}
+
+    @property
+    def values(self):
+        """The dict of {column index : value}. For a card loaded from a binary datacard, it is created at the first access."""
+        if self._values is None:
+            cols, vals, extra = self._packed
+            self._values = dict(zip(cols, vals))
+            if extra:
+                self._values.update(extra)
+            self._packed = None
+        return self._values
+
+    def __getitem__(self, b):
+        if b not in self.columns.binProcs:
+            raise KeyError(b)
+        if b not in self._bins:
+            self._bins[b] = SparseErrlineBin(self, b)
+        return self._bins[b]
+
+    def __setitem__(self, b, procs):
+        if b not in self.columns.binProcs:
+            self.columns.binProcs[b] = []
+            self.columns.bins.append(b)
+        view = self[b]
+        for p in view:
+            view[p] = 0.0
+        for p, v in six.iteritems(procs):
+            view[p] = v
+
+    def __delitem__(self, b):
+        raise RuntimeError("Cannot remove bin %s from a sparse errline, set its values to 0 instead" % b)
+
+    def __iter__(self):
+        return iter(self.columns.bins)
+
+    def __len__(self):
+        return len(self.columns.bins)
+
+    def __repr__(self):
+        return repr(dict([(b, dict(self[b])) for b in self]))
+
+    def nonNullItems(self):
+        """Return a list of (bin, process, value) for the stored entries"""
+        if self._values is None:
+            # read from the packed values, without creating the dict (the values that are not floats are 0 in them)
+            cols, vals, extra = self._packed
+            ret = [self.columns.columns[col] + (v,) for (col, v) in zip(cols, vals) if v != 0]
+            if extra:
+                ret += [self.columns.columns[col] + (v,) for (col, v) in six.iteritems(extra)]
+            return ret
+        return [self.columns.columns[col] + (v,) for col, v in six.iteritems(self.values)]
+
+
+class SparseErrlineBin(MutableMapping):
+    """The {process : value} view of a bin of a SparseErrline"""
+
+    def __init__(self, errline, b):
+        self.errline = errline
+        self.bin = b
+
+    def __getitem__(self, p):
+        col = self.errline.columns.index.get((self.bin, p))
+        if col is None:
+            raise KeyError(p)
+        return self.errline.values.get(col, 0.0)
+
+    def __setitem__(self, p, v):
+        col = self.errline.columns.add(self.bin, p)
+        if not isinstance(v, list) and v == 0:
+            self.errline.values.pop(col, None)
+        else:
+            self.errline.values[col] = v
+
+    def __delitem__(self, p):
+        raise RuntimeError("Cannot remove process %s from a sparse errline, set its value to 0 instead" % p)
+
+    def __iter__(self):
+        return iter(self.errline.columns.binProcs[self.bin])
+
+    def __len__(self):
+        return len(self.errline.columns.binProcs[self.bin])
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class ErrlineRow(MutableMapping):
+    """
+    Errline of a systematic loaded from a binary datacard, that can be used as the usual dict of {bin : {process :
+    value}}. The values are kept in a row with one entry per keyline column, and the dict of a bin is only created at
+    its first access, so that loading a card does not create the dicts of all the systematics.
+    """
+
+    def __init__(self, slices, columns, row, extra=None):
+        ## dict of {bin : (processes, first column, last column)} of the row, shared by the errlines of a card
+        self.slices = slices
+        ## list of the (bin, process) of each column of the row, shared by the errlines of a card
+        self.columns = columns
+        self.row = row
+        ## dict of {column : value} of the values that are not floats (e.g. asymmetric lnN), which are not in the row
+        self.extra = extra
+        self._bins = {}
+
+    def _materialize(self):
+        """Create the dicts of all the bins, so that bins can be added or removed"""
+        if self.slices is not None:
+            self._bins = dict([(b, self[b]) for b in self.slices])
+            self.slices = None
+
+    def __getitem__(self, b):
+        ret = self._bins.get(b)
+        if ret is None:
+            if self.slices is None or b not in self.slices:
+                raise KeyError(b)
+            procs, first, last = self.slices[b]
+            ret = dict(zip(procs, self.row[first:last]))
+            if self.extra:
+                for col, v in six.iteritems(self.extra):
+                    if first <= col < last:
+                        ret[procs[col - first]] = v
+            self._bins[b] = ret
+        return ret
+
+    def __setitem__(self, b, procs):
+        if self.slices is not None and b not in self.slices:
+            self._materialize()
+        self._bins[b] = procs
+
+    def __delitem__(self, b):
+        self._materialize()
+        del self._bins[b]
+
+    def __iter__(self):
+        return iter(self.slices if self.slices is not None else self._bins)
+
+    def __len__(self):
+        return len(self.slices if self.slices is not None else self._bins)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def nonNullItems(self):
+        """Return a list of (bin, process, value) for the values different from 0"""
+        if self._bins:
+            # the dicts of some bins may have been modified
+            return [(b, p, v) for b in self for (p, v) in six.iteritems(self[b]) if v != 0]
+        ret = [bp + (v,) for (bp, v) in zip(self.columns, self.row) if v != 0]
+        if self.extra:
+            ret += [self.columns[col] + (v,) for (col, v) in six.iteritems(self.extra) if v != 0]
+        return ret
+
+
+class SystematicsTable(object):
+    """
+    Columnar version of Datacard.systs, with one list per field indexed by nuisance, and a sparse nuisances x keyline
+    columns table of the non-null values: for each nuisance the dict of {column : value}, and for each (bin, process)
+    column the list of the nuisances that affect it, in datacard order. It is a snapshot: it must be rebuilt if
+    Datacard.systs is modified.
+    """
+
+    def __init__(self, systs, keyline):
+        self.columns = ErrlineColumns(keyline)
+        ## lists of the name, nofloat flag, pdf and arguments of each nuisance
+        self.names = []
+        self.nofloat = []
+        self.pdfs = []
+        self.args = []
+        ## list of {column : value} of the non-null values of each nuisance
+        self.rows = []
+        ## list of [(nuisance index, value)] of the nuisances affecting each column
+        self.affectingColumn = [[] for k in keyline]
+        for i, (lsyst, nofloat, pdf, args, errline) in enumerate(systs):
+            self.names.append(lsyst)
+            self.nofloat.append(nofloat)
+            self.pdfs.append(pdf)
+            self.args.append(args)
+            row = {}
+            if isinstance(errline, (SparseErrline, ErrlineRow)):
+                entries = errline.nonNullItems()
+            elif errline:
+                entries = [(b, p, v) for b in errline for (p, v) in six.iteritems(errline[b]) if v != 0]
+            else:
+                entries = []  # param, constr, flatParam... have no errline
+            for b, p, v in entries:
+                col = self.columns.index.get((b, p))
+                if col is None or v == 0:
+                    continue
+                row[col] = v
+            for col in sorted(row):
+                self.affectingColumn[col].append((i, row[col]))
+            self.rows.append(row)
+
+    def __len__(self):
+        return len(self.names)
+
+    def value(self, i, b, p):
+        """Return the value of nuisance i for bin b and process p (0.0 if it does not affect them)"""
+        col = self.columns.index.get((b, p))
+        return self.rows[i].get(col, 0.0) if col is not None else 0.0
+
+    def affecting(self, b, p):
+        """
+        Return the list of (name, nofloat, pdf, args, value) of the nuisances with a non-null value for bin b and
+        process p, in datacard order
+        """
+        col = self.columns.index.get((b, p))
+        if col is None:
+            return []
+        return [(self.names[i], self.nofloat[i], self.pdfs[i], self.args[i], v) for (i, v) in self.affectingColumn[col]]
 
 
 class Datacard:
@@ -30,6 +285,10 @@ class Datacard:
         self.exp = {}
         ## list of [(name of uncert, boolean to indicate whether to float this nuisance or not, type, list of what additional arguments (e.g. for gmN), keyline element)]
         self.systs = []
+        ## ErrlineColumns shared by the SparseErrline of the systs, if the datacard was parsed with the sparseDatacard option
+        self.errlineColumns = None
+        ## SystematicsTable of the systs, see systematicsTable()
+        self.systsTable = None
         ## list of [{bin : {process : [input file, path to shape, path to shape for uncertainty]}}]
         self.shapeMap = {}
         ## boolean that indicates whether the datacard contains shapes or not
@@ -297,6 +556,16 @@ MB.doModel()
 
         return list(set(allVars))
 
+    def systematicsTable(self, rebuild=False):
+        """
+        Return the SystematicsTable of the systematics of the datacard, from which the nuisances affecting a given bin
+        and process can be retrieved without looping on all of them. It is built at the first call, and must be rebuilt
+        (rebuild=True) after the systematics are modified.
+        """
+        if self.systsTable is None or rebuild:
+            self.systsTable = SystematicsTable(self.systs, self.keyline)
+        return self.systsTable
+
     def add_syst_id(self, lsyst):
         if lsyst in list(self.systIDMap.keys()):
             self.systIDMap[lsyst].append(len(self.systs) - 1)
@@ -1,12 +1,20 @@
 from __future__ import absolute_import, print_function
 
+import array
+import copy
 import fnmatch
+import json
+import os
 import re
+import struct
+import sys
+import zlib
 from sys import stderr
 
+import six
 from six.moves import zip
 
-from HiggsAnalysis.CombinedLimit.Datacard import Datacard
+from HiggsAnalysis.CombinedLimit.Datacard import Datacard, ErrlineColumns, ErrlineRow, SparseErrline
 from HiggsAnalysis.CombinedLimit.NuisanceModifier import doEditNuisance
 
 globalNuisances = re.compile("(lumi|pdf_(qqbar|gg|qg)|QCDscale_(ggH|qqH|VH|ggH1in|ggH2in|VV)|UEPS|FakeRate|CMS_(eff|fake|trigger|scale|res)_([gemtjb]|met))")
@@ -266,6 +274,34 @@ def addDatacardParserOptions(parser):
         action="store_false",
         help="Don't optimize template bins (removes padding from TH1s)",
     )
+    parser.add_option(
+        "--file-cache-size",
+        dest="fileCacheSize",
+        default=250,
+        type="int",
+        help="Maximum number of input files kept open at the same time; the least recently used file is closed when more are needed (default: %default)",
+    )
+    parser.add_option(
+        "--shape-workers",
+        dest="shapeWorkers",
+        default=0,
+        type="int",
+        help="Read the TH1 templates of all channels in a pool of this many worker processes, each input file split in about one chunk per worker, before building the model (default: read them serially)",
+    )
+    parser.add_option(
+        "--reuse-channels-from",
+        dest="reuseChannelsFrom",
+        default=None,
+        type="string",
+        help="Workspace file from a previous build of this datacard: the models of the channels whose datacard entries, options and input files are unchanged are taken from it instead of being rebuilt",
+    )
+    parser.add_option(
+        "--sparse-datacard",
+        dest="sparseDatacard",
+        default=False,
+        action="store_true",
+        help="Store only the entries different from '-' of the systematics lines, to reduce the memory and time needed to parse very large datacards",
+    )
     parser.add_option(
         "--X-pack-asympows",
         dest="packAsymPows",
@@ -343,9 +379,297 @@ def addRateParam(lsyst, f, ret):
     ret.rateParamsOrder.add(lsyst)
 
 
+def parseSystValue(pdf, r, b, p):
+    """Parse the entry r of a systematics line of type pdf for bin b and process p"""
+    if "/" in r:  # "number/number"
+        if (pdf not in ["lnN", "lnU"]) and ("?" not in pdf):
+            raise RuntimeError("Asymmetric errors are allowed only for Log-normals")
+        value = [float(x) for x in r.split("/")]
+        for v in value:
+            if v <= 0.00:
+                raise ValueError('Found "%s" in the nuisances affecting %s for %s. This would lead to NANs later on, so please fix it.' % (r, p, b))
+        return value
+    if r == "-" * len(r):
+        return 0.0
+    value = float(r)
+    # values of 0.0 are treated as 1.0; scrap negative values.
+    if pdf not in ["trG", "dFD", "dFD2"] and value < 0:
+        raise ValueError('Found "%s" in the nuisances affecting %s in %s. This would lead to NANs later on, so please fix it.' % (r, p, b))
+    return value
+
+
+## first bytes of a binary datacard written by writeBinaryCard, and version of its schema
+BINARY_DATACARD_MAGIC = b"#COMBINE-BINARY-DATACARD\n"
+BINARY_DATACARD_VERSION = 3
+
+## options that change the result of parseCard (with their default), and must be the same when writing and reading a binary datacard
+_binaryCardOptions = [
+    ("bin", True),
+    ("stat", False),
+    ("nuisancesToExclude", []),
+    ("evaluateEdits", True),
+    ("flatParamPrior", False),
+    ("sparseDatacard", False),
+]
+
+
+def binaryCardOptions(options):
+    ret = {}
+    for k, default in _binaryCardOptions:
+        v = getattr(options, k, default)
+        if k == "nuisancesToExclude" and v:
+            v = [getattr(x, "pattern", x) for x in v]  # combineCards.py passes compiled patterns
+        ret[k] = v
+    return ret
+
+
+def _encodeCardObject(obj):
+    """
+    Convert the members of a Datacard to plain JSON types. Tuples, sets, dicts whose keys are not all strings and the
+    sparse errlines are written as single-key objects tagged with their type (the key starts with a null character,
+    that cannot be in the names read from a datacard), so that they are read back as they were. The columns of the
+    sparse errlines are not written: they are those of the datacard.
+    """
+    if obj is None or isinstance(obj, (bool, float) + six.integer_types + six.string_types):
+        return obj
+    if isinstance(obj, list):
+        return [_encodeCardObject(x) for x in obj]
+    if isinstance(obj, tuple):
+        return {"\0t": [_encodeCardObject(x) for x in obj]}
+    if isinstance(obj, (set, frozenset)):
+        return {"\0s": [_encodeCardObject(x) for x in obj]}
+    if isinstance(obj, dict):
+        if all([isinstance(k, six.string_types) and not k.startswith("\0") for k in obj]):
+            return dict([(k, _encodeCardObject(v)) for (k, v) in obj.items()])
+        return {"\0d": [[_encodeCardObject(k), _encodeCardObject(v)] for (k, v) in obj.items()]}
+    if isinstance(obj, SparseErrline):
+        return {"\0e": [[col, _encodeCardObject(v)] for (col, v) in obj.values.items()]}
+    if isinstance(obj, ErrlineRow):
+        return _encodeCardObject(dict(obj))
+    if isinstance(obj, ErrlineColumns):
+        return {"\0c": _encodeCardObject([obj.columns, obj.bins, obj.binProcs])}
+    raise RuntimeError("Cannot write an object of type %s in a binary datacard" % type(obj).__name__)
+
+
+def _decodeCardObject(obj):
+    """Revert _encodeCardObject"""
+    if isinstance(obj, list):
+        return [_decodeCardObject(x) for x in obj]
+    if not isinstance(obj, dict):
+        return obj
+    if len(obj) == 1:
+        ((tag, v),) = obj.items()
+        if tag.startswith("\0"):
+            v = _decodeCardObject(v)
+            if tag == "\0t":
+                return tuple(v)
+            if tag == "\0s":
+                return set(v)
+            if tag == "\0d":
+                return dict(v)
+            if tag == "\0e":
+                return SparseErrline(None, dict([(col, x) for (col, x) in v]))
+            if tag == "\0c":
+                ret = ErrlineColumns()
+                ret.columns, ret.bins, ret.binProcs = v
+                ret.index = dict([(bp, col) for (col, bp) in enumerate(ret.columns)])
+                return ret
+            raise RuntimeError("Unknown object type %s in binary datacard" % tag[1:])
+    return dict([(k, _decodeCardObject(v)) for (k, v) in obj.items()])
+
+
+def _packRow(row, values):
+    """Append the values of row to the table values, and return the dict of {index in row : value} of those that are not floats, written as 0 in the table"""
+    if all([type(v) is float for v in row]):
+        values.fromlist(row)
+        return None
+    extra = {}
+    for i, v in enumerate(row):
+        if type(v) is not float:
+            extra[i] = v
+            row[i] = 0.0
+    values.fromlist(row)
+    return extra
+
+
+def _encodeSystematics(DC, values, cols):
+    """
+    Write the systs of the datacard in columns: one list per field, and the values of the errlines in the tables values
+    (floats) and cols (column indices). A dense errline is written as one row of values aligned with the keyline columns
+    (grouped by bin), a sparse errline as its columns and values. The values that are not floats (e.g. asymmetric lnN)
+    are written apart, and the errlines that do not have the layout of the keyline (param, rateParam... and edited ones)
+    as generic objects.
+    """
+    dense = ErrlineColumns(DC.keyline)
+    denseBins = dict([(b, set(dense.binProcs[b])) for b in dense.bins])
+    ret = dict([(k, []) for k in ("tuple", "names", "nofloat", "pdfs", "args", "kinds", "rows", "extras")])
+    for syst in DC.systs:
+        lsyst, nofloat, pdf, args, errline = syst
+        ret["tuple"].append(isinstance(syst, tuple))
+        ret["names"].append(lsyst)
+        ret["nofloat"].append(nofloat)
+        ret["pdfs"].append(pdf)
+        ret["args"].append(_encodeCardObject(args))
+        extra = None
+        if isinstance(errline, SparseErrline) and errline.columns is DC.errlineColumns:
+            kind, row = "s", [len(values), len(cols), len(errline.values)]
+            cols.fromlist(list(errline.values.keys()))
+            extra = _packRow(list(errline.values.values()), values)
+            if extra:
+                # by column instead of by index in the row
+                extra = dict([(cols[row[1] + i], v) for (i, v) in extra.items()])
+        elif isinstance(errline, (dict, ErrlineRow)) and len(errline) == len(denseBins) and all([set(errline.get(b, ())) == procs for (b, procs) in denseBins.items()]):
+            kind, row = "d", len(values)
+            extra = _packRow([errline[b][p] for b in dense.bins for p in dense.binProcs[b]], values)
+        else:
+            kind, row = "o", _encodeCardObject(errline)
+        ret["kinds"].append(kind)
+        ret["rows"].append(row)
+        ret["extras"].append([[k, _encodeCardObject(v)] for (k, v) in extra.items()] if extra else None)
+    return ret
+
+
+def _decodeSystematics(systs, DC, values, cols):
+    """Rebuild the systs of the datacard written by _encodeSystematics. The dicts of the errlines are only created when they are first used."""
+    dense = ErrlineColumns(DC.keyline)
+    slices = {}
+    columns = [(b, p) for b in dense.bins for p in dense.binProcs[b]]
+    first = 0
+    for b in dense.bins:
+        procs = dense.binProcs[b]
+        slices[b] = (procs, first, first + len(procs))
+        first += len(procs)
+    ret = []
+    for isTuple, lsyst, nofloat, pdf, args, kind, row, extra in zip(
+        systs["tuple"], systs["names"], systs["nofloat"], systs["pdfs"], systs["args"], systs["kinds"], systs["rows"], systs["extras"]
+    ):
+        if extra:
+            extra = dict([(k, _decodeCardObject(v)) for (k, v) in extra])
+        if kind == "d":
+            errline = ErrlineRow(slices, columns, values[row : row + first], extra)
+        elif kind == "s":
+            start, colStart, n = row
+            errline = SparseErrline(DC.errlineColumns, packed=(cols[colStart : colStart + n], values[start : start + n], extra))
+        else:
+            errline = _decodeCardObject(row)
+        if args:
+            args = _decodeCardObject(args)
+        syst = [lsyst, nofloat, pdf, args, errline]
+        ret.append(tuple(syst) if isTuple else syst)
+    return ret
+
+
+def isBinaryCard(fname):
+    """Return True if fname is a binary datacard written by writeBinaryCard"""
+    if not isinstance(fname, six.string_types) or not os.path.isfile(fname):
+        return False
+    with open(fname, "rb") as fin:
+        return fin.read(len(BINARY_DATACARD_MAGIC)) == BINARY_DATACARD_MAGIC
+
+
+def writeBinaryCard(DC, fname, options, cardPath=None):
+    """
+    Write the parsed datacard to fname in binary format, that parseCard will then load in place of the text datacard.
+    The file contains a header line, the length and the compressed JSON of the version of the schema and of the
+    variants of the card (the options that affect the parsing and the members of the Datacard, as plain types only:
+    loading a card never runs any code), then the uncompressed tables of the values and columns of the errlines of the
+    systematics (see _encodeSystematics), that are read in one go. If the text datacard cardPath is given and has
+    nuisance edits, the card parsed without evaluating them (as combineCards.py does) is stored as well, so that the
+    binary card can replace the text one for all the tools.
+    """
+    variants = [{"options": binaryCardOptions(options), "fields": DC}]
+    if cardPath is not None and getattr(options, "evaluateEdits", True) and not isBinaryCard(cardPath):
+        noEditOptions = copy.copy(options)
+        noEditOptions.evaluateEdits = False
+        if cardPath.endswith(".gz"):
+            import gzip
+
+            card = gzip.open(cardPath, "rt")
+        else:
+            card = open(cardPath, "r")
+        with card:
+            noEditDC = parseCard(card, noEditOptions)
+        if noEditDC.nuisanceEditLines:
+            variants.append({"options": binaryCardOptions(noEditOptions), "fields": noEditDC})
+        else:
+            # no edits: the card is the same whether they are evaluated or not
+            variants[0]["options"]["evaluateEdits"] = None
+    values, cols = array.array("d"), array.array("i")
+    for variant in variants:
+        card = variant["fields"]
+        variant["systs"] = _encodeSystematics(card, values, cols)
+        # the table is rebuilt on demand
+        variant["fields"] = _encodeCardObject(dict([(k, v) for (k, v) in card.__dict__.items() if k not in ("systs", "systsTable")]))
+    payload = {
+        "version": BINARY_DATACARD_VERSION,
+        "variants": variants,
+        "tables": [len(values), len(cols), cols.itemsize, sys.byteorder],
+    }
+    header = zlib.compress(json.dumps(payload).encode("utf-8"), 1)
+    with open(fname, "wb") as fout:
+        fout.write(BINARY_DATACARD_MAGIC)
+        fout.write(struct.pack("<Q", len(header)))
+        fout.write(header)
+        values.tofile(fout)
+        cols.tofile(fout)
+
+
+def readBinaryCard(fname, options):
+    """Load a datacard written by writeBinaryCard"""
+    with open(fname, "rb") as fin:
+        if fin.read(len(BINARY_DATACARD_MAGIC)) != BINARY_DATACARD_MAGIC:
+            raise RuntimeError("File %s is not a binary datacard" % fname)
+        try:
+            (length,) = struct.unpack("<Q", fin.read(8))
+            payload = json.loads(zlib.decompress(fin.read(length)).decode("utf-8"))
+        except (ValueError, struct.error, zlib.error):
+            raise RuntimeError("Binary datacard %s is not in the format of this version of combine. Please write it again from the text datacard." % fname)
+        if not isinstance(payload, dict) or payload.get("version") != BINARY_DATACARD_VERSION:
+            raise RuntimeError(
+                "Binary datacard %s has version %s of the format, while this version of combine can only read version %d. Please write it again from the text datacard."
+                % (fname, payload.get("version") if isinstance(payload, dict) else None, BINARY_DATACARD_VERSION)
+            )
+        nValues, nCols, colSize, byteorder = payload["tables"]
+        values, cols = array.array("d"), array.array("i")
+        if cols.itemsize != colSize:
+            raise RuntimeError("Binary datacard %s was written on a platform with a different size of integers. Please write it again from the text datacard." % fname)
+        try:
+            values.fromfile(fin, nValues)
+            cols.fromfile(fin, nCols)
+        except EOFError:
+            raise RuntimeError("Binary datacard %s is truncated. Please write it again from the text datacard." % fname)
+        if byteorder != sys.byteorder:
+            values.byteswap()
+            cols.byteswap()
+    wanted = binaryCardOptions(options)
+    for variant in payload["variants"]:
+        stored = variant["options"]
+        if all([stored.get(k) == v or (k == "evaluateEdits" and stored.get(k) is None) for (k, v) in wanted.items()]):
+            break
+    else:
+        raise RuntimeError(
+            "Binary datacard %s was written with parsing options %s, different from the current ones %s. Please write it again with the current options."
+            % (fname, " or ".join([str(v["options"]) for v in payload["variants"]]), wanted)
+        )
+    ret = Datacard()
+    for k, v in _decodeCardObject(variant["fields"]).items():
+        setattr(ret, k, v)
+    ret.systs = _decodeSystematics(variant["systs"], ret, values, cols)
+    if ret.errlineColumns is not None:
+        for syst in ret.systs:
+            if isinstance(syst[4], SparseErrline):
+                syst[4].columns = ret.errlineColumns
+    if options.verbose > 0:
+        stderr.write("Loaded binary datacard %s\n" % fname)
+    return ret
+
+
 def parseCard(file, options):
     if isinstance(file, str):
         raise RuntimeError("You should pass as argument to parseCards a file object, stream or a list of lines, not a string")
+    # binary datacards are loaded directly, so that all the tools reading datacards accept them
+    if isBinaryCard(getattr(file, "name", None)):
+        return readBinaryCard(file.name, options)
     ret = Datacard()
 
     # resetting these here to defaults, parseCard will fill them up
@@ -467,6 +791,10 @@ def parseCard(file, options):
                 for (b, p, s), r in zip(ret.keyline, f[1:]):
                     ret.exp[b][p] = float(r)
                 break  # rate is the last line before nuisances
+        # with sparseDatacard, only the non-null entries of the systematics lines are stored, by keyline column
+        sparse = getattr(options, "sparseDatacard", False)
+        if sparse:
+            ret.errlineColumns = ErrlineColumns(ret.keyline)
         # parse nuisances
         for lineNumber2, l in enumerate(file):
             if l.startswith("--") or l.startswith("#"):
@@ -631,25 +959,20 @@ def parseCard(file, options):
                 raise RuntimeError(
                     "Malformed systematics line %s of length %d: while bins and process lines have length %d" % (lsyst, len(numbers), len(ret.keyline))
                 )
-            errline = dict([(b, {}) for b in ret.bins])
-            nonNullEntries = 0
-            for (b, p, s), r in zip(ret.keyline, numbers):
-                if "/" in r:  # "number/number"
-                    if (pdf not in ["lnN", "lnU"]) and ("?" not in pdf):
-                        raise RuntimeError("Asymmetric errors are allowed only for Log-normals")
-                    errline[b][p] = [float(x) for x in r.split("/")]
-                    for v in errline[b][p]:
-                        if v <= 0.00:
-                            raise ValueError('Found "%s" in the nuisances affecting %s for %s. This would lead to NANs later on, so please fix it.' % (r, p, b))
-                else:
-                    if r == "-" * len(r):
-                        r = 0.0
-                    errline[b][p] = float(r)
-                    # values of 0.0 are treated as 1.0; scrap negative values.
-                    if pdf not in ["trG", "dFD", "dFD2"] and errline[b][p] < 0:
-                        raise ValueError('Found "%s" in the nuisances affecting %s in %s. This would lead to NANs later on, so please fix it.' % (r, p, b))
+            if sparse:
+                errline = SparseErrline(ret.errlineColumns)
+            else:
+                errline = dict([(b, {}) for b in ret.bins])
+            for col, ((b, p, s), r) in enumerate(zip(ret.keyline, numbers)):
+                if sparse and r == "-":
+                    continue
+                value = parseSystValue(pdf, r, b, p)
+                if not sparse:
+                    errline[b][p] = value
+                elif value != 0.0:
+                    errline.values[col] = value
                 # set the rate to epsilon for backgrounds with zero observed sideband events.
-                if pdf == "gmN" and ret.exp[b][p] == 0 and float(r) != 0:
+                if pdf == "gmN" and ret.exp[b][p] == 0 and value != 0:
                     ret.exp[b][p] = 1e-6
             ret.systs.append([lsyst, nofloat, pdf, args, errline])
             ret.add_syst_id(lsyst)
@@ -667,10 +990,15 @@ def parseCard(file, options):
         raise
 
     # check if there are bins with no rate
+    nsig_bin = dict([(b, 0) for b in ret.bins])
+    nbkg_bin = dict([(b, 0) for b in ret.bins])
+    for b, p, s in ret.keyline:
+        if ret.exp[b][p] != 0:
+            (nsig_bin if s else nbkg_bin)[b] += 1
     for b in ret.bins:
-        np_bin = sum([(ret.exp[b][p] != 0) for (b1, p, s) in ret.keyline if b1 == b])
-        ns_bin = sum([(ret.exp[b][p] != 0) for (b1, p, s) in ret.keyline if b1 == b and s])
-        nb_bin = sum([(ret.exp[b][p] != 0) for (b1, p, s) in ret.keyline if b1 == b and not s])
+        ns_bin = nsig_bin[b]
+        nb_bin = nbkg_bin[b]
+        np_bin = ns_bin + nb_bin
         if np_bin == 0:
             raise RuntimeError("Bin %s has no processes contributing to it" % b)
         if ns_bin == 0 and not options.allowNoSignal:
@@ -684,8 +1012,12 @@ def parseCard(file, options):
         if pdf == "param" or pdf == "constr" or pdf == "discrete" or pdf == "rateParam" or pdf == "flatParam":  # this doesn't have an errline
             syst2.append((lsyst, nofloat, pdf, args, errline))
             continue
-        for b, p, s in ret.keyline:
-            r = errline[b][p]
+        if isinstance(errline, SparseErrline):
+            # only the non-null entries need to be checked
+            entries = [(b, p, r) for (b, p, r) in errline.nonNullItems() if p in ret.exp.get(b, {})]
+        else:
+            entries = [(b, p, errline[b][p]) for (b, p, s) in ret.keyline]
+        for b, p, r in entries:
             nullEffect = r == 0.0 or (pdf == "lnN" and r == 1.0)
             if not nullEffect and ret.exp[b][p] != 0:
                 nonNullEntries += 1  # is this a zero background?
@@ -3,6 +3,7 @@ from __future__ import absolute_import, print_function
 import os
 import os.path
 import re
+from collections import OrderedDict
 from functools import reduce
 from math import *
 from sys import exit, stderr, stdout
@@ -11,10 +12,14 @@ import six
 from six.moves import range
 
 import ROOT
+from HiggsAnalysis.CombinedLimit.BuildProfiler import BuildProfiler
 
 ROOFIT_EXPR = "expr"
 ROOFIT_EXPR_PDF = "EXPR"
 
+# file extensions that are read through pandas instead of ROOT
+DATAFRAME_EXTENSIONS = [".csv", ".json", ".html", ".pkl", ".xlsx", ".h5", ".parquet"]
+
 
 class SafeWorkspaceImporter:
     """Class that provides the RooWorkspace::import method, but makes sure we call the proper
@@ -23,8 +28,10 @@ class SafeWorkspaceImporter:
     def __init__(self, wsp):
         self.wsp = wsp
         self.imp = getattr(wsp, "import")
+        self.calls = 0
 
     def __call__(self, *args):
+        self.calls += 1
         if len(args) != 1:
             self.imp(*args)
         elif (
@@ -38,6 +45,81 @@ class SafeWorkspaceImporter:
             self.imp(*args)
 
 
+class FileCache:
+    """Keeps up to maxsize input files open, closing the least recently used one when a new file has to be opened.
+    It also keeps the objects read from them (e.g. the workspaces used for shapes, extArgs and rateParams)"""
+
+    def __init__(self, basedir, maxsize=250):
+        self._basedir = basedir
+        self._maxsize = maxsize
+        self._files = OrderedDict()
+        ## dict of {file name : {object name : object}}
+        self._objects = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytesRead = 0
+
+    def __getitem__(self, fname):
+        if fname in self._files:
+            self.hits += 1
+            # move it to the most recently used end
+            self._files[fname] = self._files.pop(fname)
+            return self._files[fname]
+        self.misses += 1
+        if self._files and len(self._files) >= self._maxsize:
+            evicted, filehandle = self._files.popitem(last=False)
+            # objects owned by the file (e.g. trees) are deleted when it is closed
+            self._objects.pop(evicted, None)
+            self._close(filehandle)
+            self.evictions += 1
+        trueFName = self.resolve(fname)
+        # interpret file from extension - csv, json, html, pkl, xlsx, h5, parquet
+        filepath = trueFName.split(":")[0]
+        filename, ext = os.path.splitext(filepath)
+        if ext in DATAFRAME_EXTENSIONS:
+            from HiggsAnalysis.CombinedLimit.DataFrameWrapper import DataFrameWrapper
+
+            filehandle = DataFrameWrapper(trueFName, ext, lazy=True)
+        else:
+            # fallback to ROOT file
+            filehandle = ROOT.TFile.Open(trueFName)
+        self._files[fname] = filehandle
+        return filehandle
+
+    def getObject(self, fname, objname):
+        """Return the object objname (e.g. a workspace) from the file, reading it only once"""
+        filehandle = self[fname]
+        if not filehandle:
+            return None
+        objects = self._objects.setdefault(fname, {})
+        if objname not in objects:
+            objects[objname] = filehandle.Get(objname)
+        return objects[objname]
+
+    def _close(self, filehandle):
+        if filehandle and isinstance(filehandle, ROOT.TFile):
+            self.bytesRead += filehandle.GetBytesRead()
+            filehandle.Close()
+
+    def stats(self):
+        """Return a summary of the cache usage"""
+        bytesRead = self.bytesRead + sum([f.GetBytesRead() for f in self._files.values() if f and isinstance(f, ROOT.TFile)])
+        return "File cache (max. %d open files): %d hits, %d misses, %d evictions, %.1f MB read from ROOT files" % (
+            self._maxsize,
+            self.hits,
+            self.misses,
+            self.evictions,
+            bytesRead / 1048576.0,
+        )
+
+    def resolve(self, fname):
+        """Return the path of the file, looking also in the base directory for relative paths"""
+        if not os.path.exists(fname) and not os.path.isabs(fname) and os.path.exists(self._basedir + "/" + fname):
+            return self._basedir + "/" + fname
+        return fname
+
+
 class ModelBuilderBase:
     """This class defines the basic stuff for a model builder, and it's an interface on top of RooWorkspace::factory or HLF files"""
 
@@ -45,6 +127,8 @@ class ModelBuilderBase:
         self.options = options
         self.out = stdout
         self.discrete_param_set = []
+        self.factoryCalls = 0
+        self.profiler = BuildProfiler(enabled=False)
         if options.bin:
             if options.out == None:
                 options.out = re.sub(".txt$", "", options.fileName) + ".root"
@@ -87,7 +171,15 @@ class ModelBuilderBase:
         self.objstore[currName].SetName(newName)
         self.objstore[newName] = self.objstore.pop(currName)
 
+    def setProfiler(self, profiler):
+        """Record the time spent in each stage of the building of the model, and the factory calls and imports, in profiler"""
+        self.profiler = profiler
+        self.profiler.addCounter("factoryCalls", lambda: self.factoryCalls)
+        if self.options.bin:
+            self.profiler.addCounter("imports", lambda: self.out.safe_import.calls)
+
     def factory_(self, X):
+        self.factoryCalls += 1
         if self.options.verbose >= 7:
             print("RooWorkspace::factory('%s')" % X)
         if len(X) > 1000:
@@ -155,6 +247,8 @@ class ModelBuilder(ModelBuilderBase):
         self.extraNuisances = []
         self.extraGlobalObservables = []
         self.globalobs = []
+        # input files and the workspaces read from them, shared by the extArgs, rateParams and shapes
+        self._fileCache = FileCache(getattr(options, "baseDir", "."), getattr(options, "fileCacheSize", 250))
 
     def getSafeNormName(self, n):
         # need to be careful in case user has _norm name and wants to auto-create flatPrior
@@ -169,8 +263,10 @@ class ModelBuilder(ModelBuilderBase):
 
     def doModel(self, justCheckPhysicsModel=False):
         if not justCheckPhysicsModel:
-            self.doObservables()
-        self.physics.doParametersOfInterest()
+            with self.profiler.stage("doObservables"):
+                self.doObservables()
+        with self.profiler.stage("doParametersOfInterest"):
+            self.physics.doParametersOfInterest()
 
         # set a group attribute on POI variables
         poiIter = self.out.set("POI").createIterator()
@@ -179,28 +275,44 @@ class ModelBuilder(ModelBuilderBase):
             self.out.var(poi.GetName()).setAttribute("group_POI", True)
             poi = poiIter.Next()
         self.physics.preProcessNuisances(self.DC.systs)
-        self.doNuisances()
-        self.doExtArgs()
-        self.doRateParams()
+        # index of the nuisances affecting each bin and process, used instead of looping on all the systs
+        self.DC.systematicsTable(rebuild=True)
+        with self.profiler.stage("doNuisances"):
+            self.doNuisances()
+        with self.profiler.stage("doExtArgs"):
+            self.doExtArgs()
+        with self.profiler.stage("doRateParams"):
+            self.doRateParams()
         self.doAutoFlatNuisancePriors()
-        self.doFillNuisPdfsAndSets()
-        self.doExpectedEvents()
+        with self.profiler.stage("doFillNuisPdfsAndSets"):
+            self.doFillNuisPdfsAndSets()
+        with self.profiler.stage("doExpectedEvents"):
+            self.doExpectedEvents()
         if justCheckPhysicsModel:
             self.physics.done()
             print("Model is OK")
             exit(0)
-        self.doIndividualModels()
-        self.doNuisancesGroups()  # this needs to be called after both doNuisances and doIndividualModels
-        self.doCombination()
+        with self.profiler.stage("doIndividualModels"):
+            self.doIndividualModels()
+        with self.profiler.stage("doNuisancesGroups"):
+            self.doNuisancesGroups()  # this needs to be called after both doNuisances and doIndividualModels
+        with self.profiler.stage("doCombination"):
+            self.doCombination()
         self.runPostProcesses()
         self.physics.done()
         if self.options.bin:
-            self.doModelConfigs()
+            with self.profiler.stage("doModelConfigs"):
+                self.doModelConfigs()
             if self.options.verbose > 1:
                 self.out.Print("tv")
             if self.options.verbose > 2:
                 self.out.pdf("model_s").graphVizTree(self.options.out + ".dot", "\\n")
                 print("Wrote GraphVizTree of model_s to ", self.options.out + ".dot")
+        # always report the use of the file cache when files had to be closed, so that --file-cache-size can be sized from it
+        if self._fileCache.evictions:
+            stderr.write("%s. Increase --file-cache-size to keep more input files open\n" % self._fileCache.stats())
+        elif self.options.verbose and self._fileCache.misses:
+            stderr.write(self._fileCache.stats() + "\n")
 
     def getRenamingParameters(self):
         toFreeze = []
@@ -220,36 +332,51 @@ class ModelBuilder(ModelBuilderBase):
         for n in self.DC.frozenNuisances:
             self.out.arg(n).setConstant(True)
 
+    def importExternalArgs(self, requests, what):
+        """
+        Import the args [(name, file, workspace name, recycle conflict nodes)] from the external workspaces, with a single import
+        call for all the args taken from the same workspace with RecycleConflictNodes. what is the kind of arg (e.g. extArg), for the error messages.
+        """
+        groups = OrderedDict()
+        for name, fin, wsn, recycle in requests:
+            if not self._fileCache[fin]:
+                raise RuntimeError("No File '%s' found for %s" % (fin, what))
+            wstmp = self._fileCache.getObject(fin, wsn)
+            if not wstmp:
+                raise RuntimeError("Workspace '%s' not in file %s" % (wsn, fin))
+            if not wstmp.arg(name):
+                raise RuntimeError("No parameter '%s' found for %s in workspace %s from file %s" % (name, what, wsn, fin))
+            if recycle:
+                groups.setdefault((fin, wsn), ROOT.RooArgSet()).add(wstmp.arg(name))
+                continue
+            # without RecycleConflictNodes, importing again an arg already imported with another one would fail
+            for args in groups.values():
+                self.out.safe_import(args, ROOT.RooFit.RecycleConflictNodes())
+            groups.clear()
+            if not self.out.arg(name):
+                self.out.safe_import(wstmp.arg(name))
+        for args in groups.values():
+            self.out.safe_import(args, ROOT.RooFit.RecycleConflictNodes())
+
     def doExtArgs(self):
-        open_files = {}
+        toBeImported = []
         for rp in self.DC.extArgs.keys():
-            if self.out.arg(rp):
-                continue
             argv = self.DC.extArgs[rp][-1]
             if ":" in argv:
+                if self.out.arg(rp):
+                    continue
                 split = argv.split(":")
-                importargs = []
-                if "RecycleConflictNodes" in split:
+                recycle = "RecycleConflictNodes" in split
+                if recycle:
                     split.remove("RecycleConflictNodes")
-                    importargs.append(ROOT.RooFit.RecycleConflictNodes())
                 fin, wsn = split
-                if (fin, wsn) in open_files:
-                    wstmp = open_files[(fin, wsn)]
-                    if not wstmp.arg(rp):
-                        raise RuntimeError("No parameter '%s' found for extArg in workspace %s from file %s" % (rp, wsn, fin))
-                    self.out.safe_import(wstmp.arg(rp), *importargs)
-                else:
-                    fitmp = ROOT.TFile.Open(fin)
-                    if not fitmp:
-                        raise RuntimeError("No File '%s' found for extArg" % fin)
-                    wstmp = fitmp.Get(wsn)
-                    if not wstmp:
-                        raise RuntimeError("Workspace '%s' not in file %s" % (wsn, fin))
-                    if not wstmp.arg(rp):
-                        raise RuntimeError("No parameter '%s' found for extArg in workspace %s from file %s" % (rp, wsn, fin))
-                    self.out.safe_import(wstmp.arg(rp), *importargs)
-                    open_files[(fin, wsn)] = wstmp
+                toBeImported.append((rp, fin, wsn, recycle))
             else:
+                # the args imported so far may contain this one
+                self.importExternalArgs(toBeImported, "extArg")
+                toBeImported = []
+                if self.out.arg(rp):
+                    continue
                 param_range = ""
                 param_val = self.DC.extArgs[rp][-1]
                 if len(self.DC.extArgs[rp]) > 3:  # range is included:
@@ -273,12 +400,12 @@ class ModelBuilder(ModelBuilderBase):
                 if setConst:
                     self.out.var(rp).setConstant(True)
                 self.out.var(rp).setAttribute("flatParam")
+        self.importExternalArgs(toBeImported, "extArg")
 
     def doRateParams(self):
         # First support external functions/parameters
-        # keep a map of open files/workspaces
-        open_files = {}
-
+        toBeImported = []
+        seen = set()
         for rp in self.DC.rateParams.keys():
             for rk in range(len(self.DC.rateParams[rp])):
                 type = self.DC.rateParams[rp][rk][0][-1]
@@ -288,26 +415,12 @@ class ModelBuilder(ModelBuilderBase):
                     self.DC.rateParams[rp][rk][0][0],
                     self.DC.rateParams[rp][rk][0][1],
                 )
-                if self.out.arg(argu):
+                if self.out.arg(argu) or argu in seen:
                     continue
+                seen.add(argu)
                 fin, wsn = argv.split(":")
-                if (fin, wsn) in open_files:
-                    wstmp = open_files[(fin, wsn)]
-                    if not wstmp.arg(argu):
-                        raise RuntimeError("No parameter '%s' found for rateParam in workspace %s from file %s" % (argu, wsn, fin))
-                    self.out.safe_import(wstmp.arg(argu), ROOT.RooFit.RecycleConflictNodes())
-                else:
-                    fitmp = ROOT.TFile.Open(fin)
-                    if not fitmp:
-                        raise RuntimeError("No File '%s' found for rateParam" % fin)
-                    wstmp = fitmp.Get(wsn)
-                    if not wstmp:
-                        raise RuntimeError("Workspace '%s' not in file %s" % (wsn, fin))
-                    if not wstmp.arg(argu):
-                        raise RuntimeError("No parameter '%s' found for rateParam in workspace %s from file %s" % (argu, wsn, fin))
-                    self.out.safe_import(wstmp.arg(argu), ROOT.RooFit.RecycleConflictNodes())
-                    open_files[(fin, wsn)] = wstmp
-                    # fitmp.Close()
+                toBeImported.append((argu, fin, wsn, True))
+        self.importExternalArgs(toBeImported, "rateParam")
 
         # First do independant parameters, then expressions
         for rp in self.DC.rateParams.keys():
@@ -359,33 +472,64 @@ class ModelBuilder(ModelBuilderBase):
                 )
                 if self.out.arg(argu):
                     continue
-                if not reduce(
-                    lambda x, y: x * y,
-                    [self.out.arg(a) != None for a in argv.split(",")],
-                    1,
-                ):
-                    toBeCreated.append([argu, arge, argv])
-                else:
-                    self.doExp(argu, arge, argv)
-
-        # by now we 've probably picked up the majority of the, repeat through list until we get them all
-        tbc = toBeCreated[:]
-        while True:
-            toBeCreated = tbc[:]
-            if len(toBeCreated) == 0:
-                break
-            for rp in toBeCreated:
-                argu, arge, argv = rp[0], rp[1], rp[2]
-                if reduce(
-                    lambda x, y: x * y,
-                    [self.out.arg(a) != None for a in argv.split(",")],
-                    1,
-                ):
-                    self.doExp(argu, arge, argv)
-                    tbc.remove([argu, arge, argv])
-            if len(tbc) == len(toBeCreated):
-                print(tbc, " -> ", toBeCreated)
-                raise RuntimeError("Cannot produce following rateParams (dependent parameters not found!) %s" % (",".join([t[0] for t in toBeCreated])))
+                toBeCreated.append([argu, arge, argv])
+        for argu, arge, argv in self.sortRateParamFunctions(toBeCreated):
+            self.doExp(argu, arge, argv)
+
+    def sortRateParamFunctions(self, toBeCreated):
+        """
+        Return the list of rateParam functions [name, expression, arguments] in the order in which they can be created,
+        i.e. each one after the functions it depends on. This is the same order in which they were created by scanning
+        the list repeatedly until all of them are done, but each function and argument is looked at only once.
+        """
+        index = {}
+        functions = []
+        for f in toBeCreated:
+            if f[0] not in index:
+                index[f[0]] = len(functions)
+                functions.append(f)
+        # for each function, the functions it depends on
+        deps = [[] for f in functions]
+        missing = []
+        exists = {}
+        for i, (argu, arge, argv) in enumerate(functions):
+            for a in argv.split(","):
+                if a in index:
+                    deps[i].append(index[a])
+                    continue
+                if a not in exists:
+                    exists[a] = self.out.arg(a) != None
+                if not exists[a]:
+                    missing.append("%s (%s)" % (argu, a))
+        if missing:
+            raise RuntimeError("Cannot produce following rateParams (dependent parameters not found!) %s" % (",".join(missing)))
+        # number of the scan of the list in which each function would be created: a function coming after
+        # all its dependencies in the list is created in the same scan as the last of them, otherwise in the next one
+        users = [[] for f in functions]
+        remaining = [len(set(d)) for d in deps]
+        for i, d in enumerate(deps):
+            for j in set(d):
+                users[j].append(i)
+        scan = [0] * len(functions)
+        ready = [i for i, n in enumerate(remaining) if n == 0]
+        done = 0
+        while ready:
+            j = ready.pop()
+            done += 1
+            for i in users[j]:
+                scan[i] = max(scan[i], scan[j] + (1 if j > i else 0))
+                remaining[i] -= 1
+                if remaining[i] == 0:
+                    ready.append(i)
+        if done != len(functions):
+            # all the functions left depend on at least another one left: follow them until one repeats
+            path = [[i for i, n in enumerate(remaining) if n > 0][0]]
+            while path.count(path[-1]) == 1:
+                path.append([j for j in deps[path[-1]] if remaining[j] > 0][0])
+            cycle = path[path.index(path[-1]) :]
+            raise RuntimeError("Cannot produce following rateParams (circular dependency!) %s" % (" -> ".join([functions[i][0] for i in cycle])))
+        order = sorted(range(len(functions)), key=lambda i: (scan[i], i))
+        return [functions[i] for i in order]
 
     def doObservables(self):
         """create pdf_bin<X> and pdf_bin<X>_bonly for each bin"""
@@ -918,48 +1062,43 @@ class ModelBuilder(ModelBuilderBase):
                         else:
                             raise RuntimeError("No rate parameter found %s, are you sure you defined it correctly in the datacard?" % (argu))
                 selfNormRate = 1.0
-                for n, nofloat, pdf, args, errline in self.DC.systs:
+                for n, nofloat, pdf, args, value in self.DC.systematicsTable().affecting(b, p):
                     if pdf == "param":
                         continue
                     if pdf == "constr":
                         continue
                     if pdf == "rateParam" or pdf == "flatParam":
                         continue
-                    if p not in errline[b]:
-                        continue
-                    if errline[b][p] == 0.0:
-                        continue
                     if pdf.startswith("shape") and pdf.endswith("?"):  # might be a lnN in disguise
                         if not self.isShapeSystematic(b, p, n):
                             pdf = "lnN"
                     if pdf.startswith("shape"):
                         continue
-                    if pdf == "lnN" and errline[b][p] == 1.0:
+                    if pdf == "lnN" and value == 1.0:
                         continue
                     if pdf == "lnN" or pdf == "lnU":
-                        if type(errline[b][p]) == list:
-                            elow, ehigh = errline[b][p]
+                        if isinstance(value, list):
+                            elow, ehigh = value
                             alogNorms.append((elow, ehigh, n))
                         else:
-                            logNorms.append((errline[b][p], n))
+                            logNorms.append((value, n))
                     elif pdf == "gmM":
                         factors.append(n)
                     # elif pdf == "trG" or pdf == "unif" or pdf == "flatParam" or pdf == "dFD" or pdf == "dFD2":
                     elif pdf == "trG" or pdf == "unif" or pdf == "dFD" or pdf == "dFD2":
                         myname = "n_exp_shift_bin%s_proc_%s_%s" % (b, p, n)
-                        self.doObj(myname, ROOFIT_EXPR, "'1+%f*@0', %s" % (errline[b][p], n))
+                        self.doObj(myname, ROOFIT_EXPR, "'1+%f*@0', %s" % (value, n))
                         factors.append(myname)
                     elif pdf == "gmN":
                         factors.append(n)
-                        if abs(errline[b][p] * args[0] - self.DC.exp[b][p]) > max(0.05 * max(self.DC.exp[b][p], 1), errline[b][p]):
+                        if abs(value * args[0] - self.DC.exp[b][p]) > max(0.05 * max(self.DC.exp[b][p], 1), value):
                             raise RuntimeError(
-                                "Values of N = %d, alpha = %g don't match with expected rate %g for systematics %s "
-                                % (args[0], errline[b][p], self.DC.exp[b][p], n)
+                                "Values of N = %d, alpha = %g don't match with expected rate %g for systematics %s " % (args[0], value, self.DC.exp[b][p], n)
                             )
                         if gamma != None:
                             raise RuntimeError("More than one gmN uncertainty for the same bin and process (second one is %s)" % n)
                         gamma = n
-                        nominal = errline[b][p]
+                        nominal = value
                         # The case with N=0 isn't relevant if the process provides its own normalisation,
                         # so we don't need to do anything special to handle it here.
                         if args[0] > 0:
@@ -1062,7 +1201,8 @@ class ModelBuilder(ModelBuilderBase):
         for cpar in self.discrete_param_set:
             discparams.add(self.out.cat(cpar))
         self.out.safe_import(discparams, discparams.GetName())
-        self.out.writeToFile(self.options.out)
+        with self.profiler.stage("writeToFile"):
+            self.out.writeToFile(self.options.out)
 
     def isShapeSystematic(self, channel, process, syst):
         return False
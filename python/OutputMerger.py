@@ -0,0 +1,189 @@
+from __future__ import absolute_import, print_function
+
+import re
+from array import array
+from collections import OrderedDict
+
+import ROOT
+
+# array typecodes of the types of the branches that can be read entry by entry
+_leafTypeCodes = {
+    "Char_t": "b",
+    "UChar_t": "B",
+    "Bool_t": "B",
+    "Short_t": "h",
+    "UShort_t": "H",
+    "Int_t": "i",
+    "UInt_t": "I",
+    "Long64_t": "q",
+    "ULong64_t": "Q",
+    "Float_t": "f",
+    "Double_t": "d",
+}
+
+# branches of the limit tree that differ between two runs of the same point
+_timingBranches = ["t_cpu", "t_real"]
+
+# random _<uniqueId> suffix that HybridNew adds to the names of the HypoTestResults it saves
+_uniqueIdRe = re.compile(r"_\d+$")
+
+
+def gridPointName(name):
+    """Return the name of a HypoTestResult without its _<uniqueId> suffix, which is the same for all the results of a grid point"""
+    return _uniqueIdRe.sub("", name)
+
+
+class CombineOutputMerger(object):
+    """
+    Merges combine output files into a single output file, without running hadd. The files are added one at a time:
+      - the limit trees are concatenated, copying their baskets as they are (like hadd does), or entry by entry
+        when duplicated entries (e.g. from jobs that were run twice) have to be removed
+      - the HypoTestResult objects in the directories (e.g. the toys of HybridNew) of the same grid point, i.e. with the
+        same name but for the random _<uniqueId> suffix, are merged with HypoTestResult::Append, so each point of a grid
+        has a single result with all its toys, written with the name of the first one
+      - all the other objects (e.g. the toy datasets saved with --saveToys) are copied as they are, from every file,
+        like hadd does for the objects that cannot be merged (so the same name can have several cycles)
+    If dedupBranches is not None, an entry of the limit tree is skipped if it has the same values of these branches
+    as one already merged (all branches but the timing ones if dedupBranches is empty).
+    """
+
+    def __init__(self, output, treename="limit", dedupBranches=None):
+        self.output = output
+        self.treename = treename
+        self.dedupBranches = dedupBranches
+        self.fout = None
+        self.tree = None
+        ## dict of {directory path : {grid point name : [key, HypoTestResult]}}
+        self.results = OrderedDict()
+        self._buffers = None
+        self._keyBuffers = None
+        self._seen = set()
+        ## number of files, entries and HypoTestResults merged so far, of duplicated entries skipped and of objects copied
+        self.files = 0
+        self.entries = 0
+        self.hypoTestResults = 0
+        self.duplicates = 0
+        self.copied = 0
+
+    def add(self, fname):
+        """Merge the content of the file fname"""
+        fin = ROOT.TFile.Open(fname)
+        if not fin:
+            raise RuntimeError("Cannot open file %s" % fname)
+        if self.fout is None:
+            self.fout = ROOT.TFile.Open(self.output, "RECREATE")
+            if not self.fout:
+                raise RuntimeError("Cannot create file %s" % self.output)
+        self.addDirectory(fin, "")
+        self.files += 1
+        fin.Close()
+
+    def addTree(self, tin):
+        if self.tree is None:
+            self.fout.cd()
+            self.tree = tin.CloneTree(0)
+        if self.dedupBranches is None:
+            self.tree.CopyEntries(tin, -1, "fast")
+            self.tree.ResetBranchAddresses()
+            self.entries += tin.GetEntries()
+            return
+        if self._buffers is None:
+            self._buffers = OrderedDict()
+            for leaf in self.tree.GetListOfLeaves():
+                typecode = _leafTypeCodes.get(leaf.GetTypeName())
+                if typecode is None or leaf.GetLen() != 1:
+                    raise RuntimeError("Cannot remove the duplicated entries of a tree with branch %s of type %s" % (leaf.GetName(), leaf.GetTypeName()))
+                self._buffers[leaf.GetName()] = array(typecode, [0])
+                self.tree.SetBranchAddress(leaf.GetName(), self._buffers[leaf.GetName()])
+            keys = self.dedupBranches or [b for b in self._buffers if b not in _timingBranches]
+            for k in keys:
+                if k not in self._buffers:
+                    raise RuntimeError("No branch %s in tree %s" % (k, self.treename))
+            self._keyBuffers = [self._buffers[k] for k in keys]
+        for name, buf in self._buffers.items():
+            if tin.SetBranchAddress(name, buf) < 0:
+                raise RuntimeError("Branch %s missing in tree %s of file %s" % (name, self.treename, tin.GetCurrentFile().GetName()))
+        for i in range(tin.GetEntries()):
+            tin.GetEntry(i)
+            key = tuple([b[0] for b in self._keyBuffers])
+            if key in self._seen:
+                self.duplicates += 1
+                continue
+            self._seen.add(key)
+            self.tree.Fill()
+            self.entries += 1
+        tin.ResetBranchAddresses()
+
+    def addDirectory(self, tdir, path):
+        for key in tdir.GetListOfKeys():
+            cls = ROOT.TClass.GetClass(key.GetClassName())
+            name = key.GetName()
+            if cls.InheritsFrom("TDirectory"):
+                self.addDirectory(key.ReadObj(), path + "/" + name if path else name)
+            elif not path and name == self.treename and cls.InheritsFrom("TTree"):
+                # all the cycles of the tree are listed, but only the last one must be merged
+                if key.GetCycle() == tdir.GetKey(name).GetCycle():
+                    self.addTree(key.ReadObj())
+            elif cls.InheritsFrom("RooStats::HypoTestResult"):
+                results = self.results.setdefault(path, OrderedDict())
+                result = key.ReadObj()
+                point = gridPointName(name)
+                if point in results:
+                    results[point][1].Append(result)
+                else:
+                    # HybridNew::readGrid needs the suffix, so the result keeps the name of the first one
+                    results[point] = [name, result]
+                self.hypoTestResults += 1
+            elif cls.InheritsFrom("TTree"):
+                # other trees are copied, again only from their last cycle
+                if key.GetCycle() == tdir.GetKey(name).GetCycle():
+                    self.outputDirectory(path).cd()
+                    key.ReadObj().CloneTree(-1, "fast").Write()
+                    self.copied += 1
+            else:
+                self.outputDirectory(path).WriteTObject(key.ReadObj(), name)
+                self.copied += 1
+
+    def outputDirectory(self, path):
+        outdir = self.fout
+        for name in path.split("/") if path else []:
+            sub = outdir.GetDirectory(name)
+            outdir = sub if sub else outdir.mkdir(name)
+        return outdir
+
+    def close(self):
+        """Write the merged tree and results, and close the output file"""
+        if self.fout is None:
+            return
+        self.fout.cd()
+        if self.tree is not None:
+            self.tree.Write("", ROOT.TObject.kOverwrite)
+        for path, results in self.results.items():
+            tdir = self.outputDirectory(path)
+            for name, result in results.values():
+                tdir.WriteTObject(result, name)
+        self.fout.Close()
+        self.fout = None
+        self.tree = None
+
+    def summary(self):
+        ret = "Merged %d files into %s: %d entries in the %s tree" % (self.files, self.output, self.entries, self.treename)
+        if self.dedupBranches is not None:
+            ret += " (%d duplicated entries removed)" % self.duplicates
+        ntoys = sum([len(r) for r in self.results.values()])
+        if ntoys:
+            ret += ", %d HypoTestResults merged into %d" % (self.hypoTestResults, ntoys)
+        if self.copied:
+            ret += ", %d other objects copied" % self.copied
+        return ret
+
+
+def mergeCombineOutputs(output, inputs, treename="limit", dedupBranches=None, verbose=0):
+    """Merge the combine output files inputs into output, and return the merger"""
+    merger = CombineOutputMerger(output, treename, dedupBranches)
+    for i, fname in enumerate(inputs):
+        if verbose:
+            print("Merging file %d/%d: %s" % (i + 1, len(inputs), fname))
+        merger.add(fname)
+    merger.close()
+    return merger
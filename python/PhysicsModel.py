@@ -1,5 +1,6 @@
 from __future__ import absolute_import, print_function
 
+import functools
 import re
 from abc import ABCMeta, abstractmethod
 
@@ -116,7 +117,12 @@ class MultiSignalModelBase(PhysicsModelBase_NiceSubclasses):
         self.poiMap = []
         self.pois = {}
         self.verbose = False
+        self.quiet = False
         self.factories = []
+        ## list of (compiled pattern, poi name) built from poiMap, in the order in which they have to be tried
+        self.patternDispatch = None
+        ## dict of {(bin, process) : yield scale}
+        self.yieldScales = {}
         super(MultiSignalModelBase, self).__init__()
 
     def setPhysicsOptions(self, physOptions):
@@ -130,10 +136,15 @@ class MultiSignalModelBase(PhysicsModelBase_NiceSubclasses):
     def processPhysicsOptions(self, physOptions):
         processed = []
         physOptions.sort(key=lambda x: x.startswith("verbose"), reverse=True)  # put verbose at the beginning
+        self.patternDispatch = None
+        self.yieldScales = {}
         for po in physOptions:
             if po == "verbose":
                 self.verbose = True
                 processed.append(po)
+            if po == "quiet":
+                self.quiet = True
+                processed.append(po)
             if po.startswith("map="):
                 (maplist, poi) = po.replace("map=", "").split(":", 1)
                 maps = maplist.split(",")
@@ -173,20 +184,38 @@ class MultiSignalModelBase(PhysicsModelBase_NiceSubclasses):
             self.modelBuilder.factory_(pf)
         return poiNames
 
+    def getPatternDispatch(self):
+        """
+        Compile the map patterns once. The last pattern that matches a bin/process wins, so they are returned
+        in reverse order, and the first match can be taken.
+        """
+        if self.patternDispatch is None:
+            self.patternDispatch = []
+            for p, list in self.poiMap:
+                for l in list:
+                    self.patternDispatch.append((re.compile(l), p))
+            self.patternDispatch.reverse()
+        return self.patternDispatch
+
     def getYieldScale(self, bin, process):
+        # this is called for each bin and process both when building the expected yields and the pdfs
+        if (bin, process) in self.yieldScales:
+            return self.yieldScales[(bin, process)]
         string = "%s/%s" % (bin, process)
         poi = None
-        for p, list in self.poiMap:
-            for l in list:
-                if re.match(l, string):
-                    poi = p
+        for pattern, p in self.getPatternDispatch():
+            if pattern.match(string):
+                poi = p
+                break
         if poi == "super":
             poi = super(MultiSignalModelBase, self).getYieldScale(bin, process)
         if poi is None:
             poi = "1"
-        print("Will scale ", string, " by ", poi)
+        if not self.quiet:
+            print("Will scale ", string, " by ", poi)
         if poi in ["1", "0"]:
-            return int(poi)
+            poi = int(poi)
+        self.yieldScales[(bin, process)] = poi
         return poi
 
 
@@ -297,6 +326,42 @@ ALL_HIGGS_DECAYS = SM_HIGG_DECAYS + BSM_HIGGS_DECAYS
 ALL_HIGGS_PROD = SM_HIGG_PROD
 
 
+def memoizeProdDecMode(decoder):
+    """
+    Decorator for the functions returning the (production, decay, energy) of a process, that remembers their results
+    for each bin, process and datacard name. They are called for each bin and process more than once while building the
+    model, so the string scanning (and any warning it prints) is done only once. Errors are not remembered.
+    """
+    cache = {}
+
+    @functools.wraps(decoder)
+    def memoized(bin, process, options):
+        key = (bin, process, options.fileName)
+        if key not in cache:
+            cache[key] = decoder(bin, process, options)
+        return cache[key]
+
+    return memoized
+
+
+def validateProdDecModes(decoder, DC, options):
+    """
+    Decode the production and decay of all the signal processes of the datacard with a non-zero yield in a single pass,
+    and raise an error listing all the ones that can not be decoded.
+    """
+    errors = []
+    for b, p, s in DC.keyline:
+        if not s or DC.exp[b][p] == 0:
+            continue
+        try:
+            decoder(b, p, options)
+        except RuntimeError as ex:
+            errors.append("  bin %s, process %s: %s" % (b, p, ex))
+    if errors:
+        raise RuntimeError("Found %d signal processes whose production and decay mode can not be determined:\n%s" % (len(errors), "\n".join(errors)))
+
+
+@memoizeProdDecMode
 def getHiggsProdDecMode(bin, process, options):
     """Return a triple of (production, decay, energy)"""
     processSource = process
@@ -349,10 +414,18 @@ class SMLikeHiggsModel(PhysicsModel):
     def getHiggsSignalYieldScale(self, production, decay, energy):
         pass
 
+    def validateSignalProcesses(self, decoder=getHiggsProdDecMode):
+        "Check the names of all signal processes up front, the first time a yield scale is requested for this datacard"
+        if getattr(self, "validatedDC", None) is self.DC:
+            return
+        validateProdDecModes(decoder, self.DC, self.options)
+        self.validatedDC = self.DC
+
     def getYieldScale(self, bin, process):
         "Split in production and decay, and call getHiggsSignalYieldScale; return 1 for backgrounds"
         if not self.DC.isSignal[process]:
             return 1
+        self.validateSignalProcesses()
         (processSource, foundDecay, foundEnergy) = getHiggsProdDecMode(bin, process, self.options)
         return self.getHiggsSignalYieldScale(processSource, foundDecay, foundEnergy)
 
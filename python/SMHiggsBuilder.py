@@ -10,6 +10,26 @@ from six.moves import zip
 import ROOT
 from HiggsAnalysis.CombinedLimit.PhysicsModel import ALL_HIGGS_DECAYS
 
+## process-wide cache of the text tables read by textToSpline, as {(path, skipRows) : list of rows (lists of strings)}
+_tableRows = {}
+## process-wide cache of the columns of those tables, as {(path, skipRows, column) : array of doubles}
+_tableColumns = {}
+
+
+def readTableColumn(filename, col, skipRows=1):
+    """
+    Return a column of a whitespace-separated text table as an array of doubles. Each file is read only once per process,
+    and each column converted only once, however many models and splines use them (e.g. BR4.txt, that has one column per decay).
+    """
+    path = os.path.abspath(filename)
+    if (path, skipRows, col) not in _tableColumns:
+        if (path, skipRows) not in _tableRows:
+            with open(filename, "r") as file:
+                lines = [l for l in file]
+            _tableRows[(path, skipRows)] = [line.split() for line in lines[skipRows:] if len(line.strip()) != 0]
+        _tableColumns[(path, skipRows, col)] = array("d", [float(cols[col]) for cols in _tableRows[(path, skipRows)]])
+    return _tableColumns[(path, skipRows, col)]
+
 
 class SMHiggsBuilder:
     def __init__(self, modelBuilder, datadir=None):
@@ -330,24 +350,17 @@ class SMHiggsBuilder:
     def textToSpline(self, name, filename, xvar="MH", ycol=1, xcol=0, skipRows=1, algo="CSPLINE"):
         if self.modelBuilder.out.function(name) != None:
             return
-        x = []
-        y = []
-        file = open(filename, "r")
-        lines = [l for l in file]
-        for line in lines[skipRows:]:
-            if len(line.strip()) == 0:
-                continue
-            cols = line.split()
-            x.append(float(cols[xcol]))
-            y.append(float(cols[ycol]))
+        # the spline copies the values, so the cached arrays can be shared
+        x = readTableColumn(filename, xcol, skipRows)
+        y = readTableColumn(filename, ycol, skipRows)
         xv = self.modelBuilder.out.var(xvar)
         spline = ROOT.RooSpline1D(
             name,
             "file %s, x=%d, y=%d" % (filename, xcol, ycol),
             xv,
             len(x),
-            array("d", x),
-            array("d", y),
+            x,
+            y,
             algo,
         )
         self.modelBuilder.out.safe_import(spline)
@@ -33,6 +33,7 @@ CMS_to_LHCHCG_DecSimple = {
 }
 
 
+@memoizeProdDecMode
 def getSTXSProdDecMode(bin, process, options):
     """Return a triple of (production)"""
     processSource = process
@@ -22,6 +22,7 @@ from HiggsAnalysis.CombinedLimit.SMHiggsBuilder import SMHiggsBuilder
 
 # Global function to extract STXS production, decay mode and energy from process name
 #   * this has changed with STXS under naming convention
+@memoizeProdDecMode
 def getSTXSProdDecMode(bin, process, options):
     matchedDecayString = False  # Boolean
     processSource = process
@@ -74,6 +75,7 @@ class STXStoEFTBaseModel(SMLikeHiggsModel):
         self.useLHCHXSWGNumbers = False
         self.useExtendedVBFScheme = False
         self.linearOnly = False
+        self.compiledScalingFunctions = False  # if True, one RooMultiPolynomial per scaling function instead of one RooProduct per term
         if self.freezeOtherParameters:
             self.parametersOfInterest = [
                 "cG",
@@ -148,6 +150,14 @@ class STXStoEFTBaseModel(SMLikeHiggsModel):
                     "True",
                     "true",
                 ]
+            if po.startswith("compiledScalingFunctions="):
+                self.compiledScalingFunctions = po.replace("compiledScalingFunctions=", "") in [
+                    "yes",
+                    "1",
+                    "Yes",
+                    "True",
+                    "true",
+                ]
 
         # Output options to screen
         print(" --> [STXStoEFT] Theory uncertainties in partial widths: %s" % self.doBRU)
@@ -166,6 +176,8 @@ class STXStoEFTBaseModel(SMLikeHiggsModel):
             print(" --> [STXStoEFT] Using LHCHXSWG numbers for stage 1 scaling functions")
         if self.linearOnly:
             print(" --> [STXStoEFT] Only linear terms (Ai)")
+        if self.compiledScalingFunctions:
+            print(" --> [STXStoEFT] Building scaling functions as RooMultiPolynomials")
 
     def doMH(self):
         if self.floatMass:
@@ -186,6 +198,7 @@ class STXStoEFTBaseModel(SMLikeHiggsModel):
         "Split in production and decay, and call getHiggsSignalYieldScale; return 1 for backgrounds"
         if not self.DC.isSignal[process]:
             return 1
+        self.validateSignalProcesses(getSTXSProdDecMode)
         (processSource, foundDecay, foundEnergy) = getSTXSProdDecMode(bin, process, self.options)
         # Return 1 for fixed processes and scaling for non-fixed
         if processSource in self.fixProcesses:
@@ -271,27 +284,14 @@ class STXStoEFTBaseModel(SMLikeHiggsModel):
         file_in.close()
 
     # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-    # Function to make scaling function in workspace from string
-    #   > defines each terms as RooProduct
-    #   > sum of terms as RooAddition
-    def makeScalingFunction(self, what, STXSstage=""):
-        # if in processes/decays extract formula from corresponding dict
-        if what in self.STXSScalingFunctions:
-            formula = self.STXSScalingFunctions[what]
-        elif what in self.DecayScalingFunctions:
-            formula = self.DecayScalingFunctions[what]
-        else:
-            if STXSstage != "":
-                raise ValueError("[ERROR] Scaling function for %s does not exist for STXS Stage %s" % (what, STXSstage))
-            else:
-                raise ValueError("[ERROR] Scaling function for %s does not exist" % what)
-
+    # Function to split the formula string into terms
+    #   > returns for each term the list of constituents (numbers and parameter names) after replacing them by POIs
+    def scalingFunctionTerms(self, formula):
         # replace "-" in formula string by "+-" and then turn into list, splitting by delimeter "+"
         formula = re.sub("-", "+-", formula).split("+")
 
-        # define list to hold name of terms
-        formulaTerms = []
-        _termIdx = 0
+        # define list to hold the terms
+        terms = []
 
         # loop over terms in formula (ignoring first term which is just 1 [perturbation theory])
         for term in formula[1:]:
@@ -314,16 +314,44 @@ class STXStoEFTBaseModel(SMLikeHiggsModel):
                         scaled_constituents.extend(self.poi_scaling[c].split("*"))
                     else:
                         scaled_constituents.append(c)
-                # define string for term: RooProduct (factory)
-                termStr = "prod::term_%s_%g(" % (what, _termIdx)
-                for sc in scaled_constituents:
-                    termStr += "%s," % sc
-                termStr = termStr[:-1] + ")"
-                # add term to model and dictionary
-                self.modelBuilder.factory_(termStr)
-                formulaTerms.append("term_%s_%g" % (what, _termIdx))
-                # add one to the iterator
-                _termIdx += 1
+                terms.append(scaled_constituents)
+        return terms
+
+    # Function to make scaling function in workspace from string
+    #   > by default defines each terms as RooProduct, and sum of terms as RooAddition
+    #   > with --PO compiledScalingFunctions=yes, as a single RooMultiPolynomial (see makeCompiledScalingFunction)
+    def makeScalingFunction(self, what, STXSstage=""):
+        # if in processes/decays extract formula from corresponding dict
+        if what in self.STXSScalingFunctions:
+            formula = self.STXSScalingFunctions[what]
+        elif what in self.DecayScalingFunctions:
+            formula = self.DecayScalingFunctions[what]
+        else:
+            if STXSstage != "":
+                raise ValueError("[ERROR] Scaling function for %s does not exist for STXS Stage %s" % (what, STXSstage))
+            else:
+                raise ValueError("[ERROR] Scaling function for %s does not exist" % what)
+
+        terms = self.scalingFunctionTerms(formula)
+        if self.compiledScalingFunctions:
+            self.makeCompiledScalingFunction(what, terms)
+            return
+
+        # define list to hold name of terms
+        formulaTerms = []
+        _termIdx = 0
+
+        for scaled_constituents in terms:
+            # define string for term: RooProduct (factory)
+            termStr = "prod::term_%s_%g(" % (what, _termIdx)
+            for sc in scaled_constituents:
+                termStr += "%s," % sc
+            termStr = termStr[:-1] + ")"
+            # add term to model and dictionary
+            self.modelBuilder.factory_(termStr)
+            formulaTerms.append("term_%s_%g" % (what, _termIdx))
+            # add one to the iterator
+            _termIdx += 1
 
         # split up sums into sizeable chunks: 15 terms max
         sumTerms = {}
@@ -357,6 +385,43 @@ class STXStoEFTBaseModel(SMLikeHiggsModel):
         # Add scaling function as RooAddition into model
         self.modelBuilder.factory_(totalStr)
 
+    # Function to make scaling function as a single RooMultiPolynomial
+    #   > numerical constituents of each term are multiplied into its coefficient
+    #   > the other constituents are the parameters (POIs or functions of them) already in the workspace
+    def makeCompiledScalingFunction(self, what, terms):
+        if (what in self.DecayScalingFunctions) & (what != "tot"):
+            name = "scaling_partial_%s" % what
+        else:
+            name = "scaling_%s" % what
+        varNames = []
+        coefficients = ROOT.std.vector("double")()
+        termSizes = ROOT.std.vector("int")()
+        termVars = ROOT.std.vector("int")()
+        for scaled_constituents in terms:
+            coefficient = 1.0
+            factors = []
+            for sc in scaled_constituents:
+                try:
+                    coefficient *= float(sc)
+                    continue
+                except ValueError:
+                    pass
+                if sc not in varNames:
+                    varNames.append(sc)
+                factors.append(varNames.index(sc))
+            coefficients.push_back(coefficient)
+            termSizes.push_back(len(factors))
+            for f in factors:
+                termVars.push_back(f)
+        variables = ROOT.RooArgList()
+        for v in varNames:
+            arg = self.modelBuilder.out.arg(v)
+            if not arg:
+                raise RuntimeError("[ERROR] Parameter %s of the scaling function for %s is not defined" % (v, what))
+            variables.add(arg)
+        polynomial = ROOT.RooMultiPolynomial(name, "", variables, coefficients, termSizes, termVars, 1.0)
+        self.modelBuilder.out.safe_import(polynomial)
+
     # Function to make BR scaling functions: partial width/total width
     def makeBRScalingFunction(self, what):
         self.modelBuilder.factory_('expr::scaling_BR_%s("@0/@1", scaling_partial_%s, scaling_tot)' % (what, what))
@@ -1,16 +1,19 @@
 from __future__ import absolute_import, print_function
 
 from __future__ import division
+import hashlib
+import multiprocessing
 import os.path
 from collections import defaultdict
 from math import *
-from sys import exit, stderr, stdout
+from sys import exit, modules, stderr, stdout
 
 import six
 from six.moves import range
 
 import ROOT
-from HiggsAnalysis.CombinedLimit.ModelTools import ModelBuilder
+from HiggsAnalysis.CombinedLimit.ModelTools import DATAFRAME_EXTENSIONS, FileCache, ModelBuilder
+from HiggsAnalysis.CombinedLimit.WorkspaceCache import codeSignature, fileSignature, optionsSignature
 
 from .DataFrameWrapper import DataFrameWrapper
 
@@ -27,40 +30,28 @@ def RooArgSet_add_patched(self, obj, *args, **kwargs):
 ROOT.RooArgSet.add = RooArgSet_add_patched
 
 
-class FileCache:
-    def __init__(self, basedir, maxsize=250):
-        self._basedir = basedir
-        self._maxsize = maxsize
-        self._files = {}
-        self._hits = defaultdict(int)
-        self._total = 0
-
-    def __getitem__(self, fname):
-        self._total += 1
-        if fname not in self._files:
-            if len(self._files) >= self._maxsize:
-                print("Flushing file cache of size %d" % len(self._files))
-                keys = list(self._files.keys())
-                keys.sort(key=lambda k: self._files[k][1] + 10 * self._hits[k])
-                for k in keys[: self._maxsize // 2]:
-                    self._files[k][0].Close()
-                    del self._files[k]
-            trueFName = fname
-            if not os.path.exists(trueFName) and not os.path.isabs(trueFName) and os.path.exists(self._basedir + "/" + trueFName):
-                trueFName = self._basedir + "/" + trueFName
-            # interpret file from extension - csv, json, html, pkl, xlsx, h5, parquet
-            filepath = trueFName.split(":")[0]
-            filename, ext = os.path.splitext(filepath)
-            if ext in [".csv", ".json", ".html", ".pkl", ".xlsx", ".h5", ".parquet"]:
-                filehandle = DataFrameWrapper(trueFName, ext)
-            else:
-                # fallback to ROOT file
-                filehandle = ROOT.TFile.Open(trueFName)
-            self._files[fname] = [filehandle, self._total]
+def _readShapeObjects(task):
+    """Worker for ShapeBuilder.prefetchShapes: read the requested objects (a chunk of those of the file) from one ROOT file.
+    Returns the file name, a list of (key, object) pairs, where the object is None if missing
+    and False if it is not a TH1 (those are left to the serial path in ShapeBuilder.getShape),
+    and the number of bytes read"""
+    fname, requests = task
+    fin = ROOT.TFile.Open(fname)
+    if not fin:
+        return fname, None, 0
+    ret = []
+    for key, objname in requests:
+        obj = fin.Get(objname)
+        if not obj:
+            ret.append((key, None))
+        elif obj.InheritsFrom("TH1"):
+            obj.SetDirectory(0)
+            ret.append((key, obj))
         else:
-            self._files[fname][1] = self._total
-        self._hits[fname] += 1
-        return self._files[fname][0]
+            ret.append((key, False))
+    bytesRead = fin.GetBytesRead()
+    fin.Close()
+    return fname, ret, bytesRead
 
 
 class ShapeBuilder(ModelBuilder):
@@ -71,11 +62,23 @@ class ShapeBuilder(ModelBuilder):
         if options.libs:
             for lib in options.libs:
                 ROOT.gSystem.Load(lib)
-        self.wspnames = {}
         self.wsp = None
         self.extraImports = []
         self.norm_rename_map = {}
-        self._fileCache = FileCache(self.options.baseDir)
+        self._prefetchedShapes = {}
+        self._reuseWsp = None
+        if getattr(options, "reuseChannelsFrom", None):
+            if os.path.abspath(options.reuseChannelsFrom) == os.path.abspath(options.out):
+                raise RuntimeError("The workspace to reuse channels from must be different from the output file %s" % options.out)
+            self._reuseFile = ROOT.TFile.Open(options.reuseChannelsFrom)
+            if not self._reuseFile:
+                raise RuntimeError("Cannot open file %s" % options.reuseChannelsFrom)
+            self._reuseWsp = self._reuseFile.Get("w")
+            if not self._reuseWsp:
+                raise RuntimeError("Workspace 'w' not in file %s" % options.reuseChannelsFrom)
+        # the channel hashes are only needed to reuse channels, or to be able to reuse them from a cached workspace
+        self._storeChannelHashes = bool(self._reuseWsp or getattr(options, "workspaceCache", None))
+        self._channelHashInputs = None
 
     ## ------------------------------------------
     ## -------- ModelBuilder interface ----------
@@ -83,7 +86,8 @@ class ShapeBuilder(ModelBuilder):
     def doObservables(self):
         if self.options.verbose > 2:
             stderr.write("Using shapes: qui si parra' la tua nobilitate\n")
-        self.prepareAllShapes()
+        with self.profiler.stage("prepareAllShapes"):
+            self.prepareAllShapes()
         if len(self.DC.bins) > 1 or not self.options.forceNonSimPdf:
             ## start with just a few channels
             strexpr = "CMS_channel[" + ",".join(["%s=%d" % (l, i) for i, l in enumerate(self.DC.bins[:5])]) + "]"
@@ -101,15 +105,18 @@ class ShapeBuilder(ModelBuilder):
             self.out.obs = self.out.binVars
         self.doSet("observables", self.out.obs)
         if len(self.DC.obs) != 0 and not self.options.noData:
-            self.doCombinedDataset()
+            with self.profiler.stage("doCombinedDataset"):
+                self.doCombinedDataset()
 
     def doIndividualModels(self):
         if self.options.verbose:
             stderr.write("Creating pdfs for individual modes (%d): " % len(self.DC.bins))
             stderr.flush()
         bbb_names = []
+        nreused = 0
         for i, b in enumerate(self.DC.bins):
             # print "  + Getting model for bin %s" % (b)
+            self.profiler.begin(b)
             pdfs = ROOT.RooArgList()
             bgpdfs = ROOT.RooArgList()
             coeffs = ROOT.RooArgList()
@@ -120,177 +127,189 @@ class ShapeBuilder(ModelBuilder):
             channelBinParFlag = b in list(self.DC.binParFlags.keys())
             if channelBinParFlag:
                 print("Channel %s will use autoMCStats with settings: event-threshold=%g, include-signal=%i, hist-mode=%i" % ((b,) + self.DC.binParFlags[b]))
-            for p in self.DC.exp[b].keys():  # so that we get only self.DC.processes contributing to this bin
-                if self.DC.exp[b][p] == 0:
-                    continue
-                if self.physics.getYieldScale(b, p) == 0:
-                    continue  # exclude really the pdf
-                # print "  +--- Getting pdf for %s in bin %s" % (p,b)
-                (pdf, coeff) = (
-                    self.getPdf(b, p),
-                    self.out.function("n_exp_bin%s_proc_%s" % (b, p)),
-                )
-                if self.options.optimizeExistingTemplates:
-                    pdf1 = self.optimizeExistingTemplates(pdf)
-                    if pdf1 != pdf:
-                        self.out.dont_delete.append(pdf1)
-                        pdf = pdf1
-                extranorm = self.getExtraNorm(b, p)
-                if extranorm:
-                    if self.options.packAsymPows:
-                        if coeff.ClassName() == "ProcessNormalization":
-                            pass  # nothing to do
-                        elif coeff.ClassName() == "RooRealVar":
+            channelHash = self.channelHash(b) if self._storeChannelHashes else None
+            channelBinPars = []
+            reused = self.reuseChannelModel(b, channelHash, binconstraints, bbb_names)
+            if reused:
+                sum_s, sum_b = reused
+                nreused += 1
+            else:
+                for p in self.DC.exp[b].keys():  # so that we get only self.DC.processes contributing to this bin
+                    if self.DC.exp[b][p] == 0:
+                        continue
+                    if self.physics.getYieldScale(b, p) == 0:
+                        continue  # exclude really the pdf
+                    # print "  +--- Getting pdf for %s in bin %s" % (p,b)
+                    (pdf, coeff) = (
+                        self.getPdf(b, p),
+                        self.out.function("n_exp_bin%s_proc_%s" % (b, p)),
+                    )
+                    if self.options.optimizeExistingTemplates:
+                        pdf1 = self.optimizeExistingTemplates(pdf)
+                        if pdf1 != pdf:
+                            self.out.dont_delete.append(pdf1)
+                            pdf = pdf1
+                    extranorm = self.getExtraNorm(b, p)
+                    if extranorm:
+                        if self.options.packAsymPows:
+                            if coeff.ClassName() == "ProcessNormalization":
+                                pass  # nothing to do
+                            elif coeff.ClassName() == "RooRealVar":
+                                coeff = self.addObj(
+                                    ROOT.ProcessNormalization,
+                                    "n_exp_final_bin%s_proc_%s" % (b, p),
+                                    "",
+                                    coeff.getVal(),
+                                )
+                            else:
+                                raise RuntimeError("packAsymPows: can't work with a coefficient of kind %s for %s %s" % (coeff.ClassName(), b, p))
+                            for X in extranorm:
+                                if type(X) == tuple:
+                                    (klo, khi, syst) = X
+                                    coeff.addAsymmLogNormal(klo, khi, self.out.var(syst))
+                                else:
+                                    if self.out.function(X):
+                                        coeff.addOtherFactor(self.out.function(X))
+                                    else:
+                                        coeff.addOtherFactor(self.getObj(X))
+                        else:
+                            prodset = ROOT.RooArgList(self.out.function("n_exp_bin%s_proc_%s" % (b, p)))
+                            for X in extranorm:
+                                # X might already be in the workspace (e.g. _norm term)...
+                                if self.out.function(X):
+                                    prodset.add(self.out.function(X))
+                                # ... but usually it's only in our object store (e.g. AsymPow for shape systs)
+                                else:
+                                    prodset.add(self.getObj(X))
                             coeff = self.addObj(
-                                ROOT.ProcessNormalization,
+                                ROOT.RooProduct,
                                 "n_exp_final_bin%s_proc_%s" % (b, p),
                                 "",
-                                coeff.getVal(),
+                                prodset,
                             )
-                        else:
-                            raise RuntimeError("packAsymPows: can't work with a coefficient of kind %s for %s %s" % (coeff.ClassName(), b, p))
-                        for X in extranorm:
-                            if type(X) == tuple:
-                                (klo, khi, syst) = X
-                                coeff.addAsymmLogNormal(klo, khi, self.out.var(syst))
-                            else:
-                                if self.out.function(X):
-                                    coeff.addOtherFactor(self.out.function(X))
-                                else:
-                                    coeff.addOtherFactor(self.getObj(X))
+                    pdf.setStringAttribute("combine.process", p)
+                    pdf.setStringAttribute("combine.channel", b)
+                    pdf.setAttribute("combine.signal", self.DC.isSignal[p])
+                    if channelBinParFlag and self.DC.isSignal[p] and not self.DC.binParFlags[b][1]:
+                        pdf.setAttribute("skipForErrorSum")
+                    coeff.setStringAttribute("combine.process", p)
+                    coeff.setStringAttribute("combine.channel", b)
+                    coeff.setAttribute("combine.signal", self.DC.isSignal[p])
+                    pdfs.add(pdf)
+                    coeffs.add(coeff)
+                    if not self.DC.isSignal[p]:
+                        bgpdfs.add(pdf)
+                        bgcoeffs.add(coeff)
                     else:
-                        prodset = ROOT.RooArgList(self.out.function("n_exp_bin%s_proc_%s" % (b, p)))
-                        for X in extranorm:
-                            # X might already be in the workspace (e.g. _norm term)...
-                            if self.out.function(X):
-                                prodset.add(self.out.function(X))
-                            # ... but usually it's only in our object store (e.g. AsymPow for shape systs)
-                            else:
-                                prodset.add(self.getObj(X))
-                        coeff = self.addObj(
-                            ROOT.RooProduct,
-                            "n_exp_final_bin%s_proc_%s" % (b, p),
+                        sigcoeffs.append(coeff)
+                if self.options.verbose > 1:
+                    print("Creating RooAddPdf %s with %s elements" % ("pdf_bin" + b, coeffs.getSize()))
+                if channelBinParFlag:
+                    if self.options.useCMSHistSum:
+                        prop = self.addObj(
+                            ROOT.CMSHistSum,
+                            "prop_bin%s" % b,
                             "",
-                            prodset,
+                            pdfs.at(0).getXVar(),
+                            pdfs,
+                            coeffs,
                         )
-                pdf.setStringAttribute("combine.process", p)
-                pdf.setStringAttribute("combine.channel", b)
-                pdf.setAttribute("combine.signal", self.DC.isSignal[p])
-                if channelBinParFlag and self.DC.isSignal[p] and not self.DC.binParFlags[b][1]:
-                    pdf.setAttribute("skipForErrorSum")
-                coeff.setStringAttribute("combine.process", p)
-                coeff.setStringAttribute("combine.channel", b)
-                coeff.setAttribute("combine.signal", self.DC.isSignal[p])
-                pdfs.add(pdf)
-                coeffs.add(coeff)
-                if not self.DC.isSignal[p]:
-                    bgpdfs.add(pdf)
-                    bgcoeffs.add(coeff)
-                else:
-                    sigcoeffs.append(coeff)
-            if self.options.verbose > 1:
-                print("Creating RooAddPdf %s with %s elements" % ("pdf_bin" + b, coeffs.getSize()))
-            if channelBinParFlag:
-                if self.options.useCMSHistSum:
-                    prop = self.addObj(
-                        ROOT.CMSHistSum,
-                        "prop_bin%s" % b,
-                        "",
-                        pdfs.at(0).getXVar(),
-                        pdfs,
-                        coeffs,
-                    )
-                    prop.setAttribute("CachingPdf_NoClone", True)
-                else:
-                    prop = self.addObj(
-                        ROOT.CMSHistErrorPropagator,
-                        "prop_bin%s" % b,
-                        "",
-                        pdfs.at(0).getXVar(),
-                        pdfs,
-                        coeffs,
-                    )
-                prop.setAttribute("CachingPdf_Direct", True)
-                if self.DC.binParFlags[b][0] >= 0.0:
-                    bbb_args = prop.setupBinPars(self.DC.binParFlags[b][0])
-                    for bidx in range(bbb_args.getSize()):
-                        arg = bbb_args.at(bidx)
-                        n = arg.GetName()
-                        bbb_names.append(n)
-                        parname = n
-                        self.out.safe_import(arg)
-                        if arg.getAttribute("createGaussianConstraint"):
-                            if self.options.noOptimizePdf:
-                                self.doObj(
-                                    "%s_Pdf" % n,
-                                    "Gaussian",
-                                    "%s, %s_In[0,%s], %s" % (n, n, "-7,7", "1.0"),
-                                    True,
-                                )
-                            else:
+                        prop.setAttribute("CachingPdf_NoClone", True)
+                    else:
+                        prop = self.addObj(
+                            ROOT.CMSHistErrorPropagator,
+                            "prop_bin%s" % b,
+                            "",
+                            pdfs.at(0).getXVar(),
+                            pdfs,
+                            coeffs,
+                        )
+                    prop.setAttribute("CachingPdf_Direct", True)
+                    if self.DC.binParFlags[b][0] >= 0.0:
+                        bbb_args = prop.setupBinPars(self.DC.binParFlags[b][0])
+                        for bidx in range(bbb_args.getSize()):
+                            arg = bbb_args.at(bidx)
+                            n = arg.GetName()
+                            bbb_names.append(n)
+                            parname = n
+                            self.out.safe_import(arg)
+                            if arg.getAttribute("createGaussianConstraint"):
+                                if self.options.noOptimizePdf:
+                                    self.doObj(
+                                        "%s_Pdf" % n,
+                                        "Gaussian",
+                                        "%s, %s_In[0,%s], %s" % (n, n, "-7,7", "1.0"),
+                                        True,
+                                    )
+                                else:
+                                    self.doObj(
+                                        "%s_Pdf" % n,
+                                        "SimpleGaussianConstraint",
+                                        "%s, %s_In[0,%s], %s" % (n, n, "-7,7", "1.0"),
+                                        True,
+                                    )
+                                self.out.var(n).setVal(0)
+                                self.out.var(n).setError(1)
+                                if self.options.optimizeBoundNuisances:
+                                    self.out.var(n).setAttribute("optimizeBounds")
+                            elif arg.getAttribute("createPoissonConstraint"):
+                                nom = arg.getVal()
+                                pval = ROOT.Math.normal_cdf_c(7)
+                                minObs = nom
+                                while minObs > 0 and (ROOT.TMath.Poisson(minObs, nom + 1) > pval):
+                                    minObs -= sqrt(nom) if nom > 10 else 1
+                                maxObs = nom + 2
+                                while ROOT.TMath.Poisson(maxObs, nom + 1) > pval:
+                                    # print "Poisson(maxObs = %d, %f) = %g > 1e-12" % (maxObs, args[0]+1, ROOT.TMath.Poisson(maxObs, args[0]+1))
+                                    maxObs += sqrt(nom) if nom > 10 else 2
                                 self.doObj(
                                     "%s_Pdf" % n,
-                                    "SimpleGaussianConstraint",
-                                    "%s, %s_In[0,%s], %s" % (n, n, "-7,7", "1.0"),
-                                    True,
+                                    "Poisson",
+                                    "%s_In[%d,%f,%f], %s, 1" % (n, nom, minObs, maxObs, n),
                                 )
-                            self.out.var(n).setVal(0)
-                            self.out.var(n).setError(1)
-                            if self.options.optimizeBoundNuisances:
-                                self.out.var(n).setAttribute("optimizeBounds")
-                        elif arg.getAttribute("createPoissonConstraint"):
-                            nom = arg.getVal()
-                            pval = ROOT.Math.normal_cdf_c(7)
-                            minObs = nom
-                            while minObs > 0 and (ROOT.TMath.Poisson(minObs, nom + 1) > pval):
-                                minObs -= sqrt(nom) if nom > 10 else 1
-                            maxObs = nom + 2
-                            while ROOT.TMath.Poisson(maxObs, nom + 1) > pval:
-                                # print "Poisson(maxObs = %d, %f) = %g > 1e-12" % (maxObs, args[0]+1, ROOT.TMath.Poisson(maxObs, args[0]+1))
-                                maxObs += sqrt(nom) if nom > 10 else 2
-                            self.doObj(
-                                "%s_Pdf" % n,
-                                "Poisson",
-                                "%s_In[%d,%f,%f], %s, 1" % (n, nom, minObs, maxObs, n),
-                            )
-                            if n.endswith("_prod"):
-                                parname = n[:-5]
-                        binconstraints.add(self.out.pdf("%s_Pdf" % n))
-                        self.out.var("%s_In" % n).setConstant(True)
-                        self.extraNuisances.append(self.out.var("%s" % parname))
-                        self.extraGlobalObservables.append(self.out.var("%s_In" % n))
-                if not self.out.var("ONE"):
-                    self.doVar("ONE[1.0]")
-                sum_s = self.addObj(
-                    ROOT.RooRealSumPdf,
-                    "pdf_bin%s" % b,
-                    "",
-                    ROOT.RooArgList(prop),
-                    ROOT.RooArgList(self.out.var("ONE")),
-                    True,
-                )
-                if not self.options.noBOnly:
-                    if not self.out.var("ZERO"):
-                        self.doVar("ZERO[0.0]")
-                    customizer = ROOT.RooCustomizer(prop, "")
-                    for arg in sigcoeffs:
-                        customizer.replaceArg(arg, self.out.var("ZERO"))
-                    prop_b = customizer.build(True)
-                    if len(sigcoeffs):
-                        prop_b.SetName("prop_bin%s_bonly" % b)
-                    self.objstore[prop_b.GetName()] = prop_b
-                    sum_b = self.addObj(
+                                if n.endswith("_prod"):
+                                    parname = n[:-5]
+                            channelBinPars.append((n, parname))
+                            binconstraints.add(self.out.pdf("%s_Pdf" % n))
+                            self.out.var("%s_In" % n).setConstant(True)
+                            self.extraNuisances.append(self.out.var("%s" % parname))
+                            self.extraGlobalObservables.append(self.out.var("%s_In" % n))
+                    if not self.out.var("ONE"):
+                        self.doVar("ONE[1.0]")
+                    sum_s = self.addObj(
                         ROOT.RooRealSumPdf,
-                        "pdf_bin%s_bonly" % b,
+                        "pdf_bin%s" % b,
                         "",
-                        ROOT.RooArgList(prop_b),
+                        ROOT.RooArgList(prop),
                         ROOT.RooArgList(self.out.var("ONE")),
                         True,
                     )
-            else:
-                sum_s = self.addObj(ROOT.RooAddPdf, "pdf_bin%s" % b, "", pdfs, coeffs)
-                if not self.options.noBOnly:
-                    sum_b = self.addObj(ROOT.RooAddPdf, "pdf_bin%s_bonly" % b, "", bgpdfs, bgcoeffs)
+                    if not self.options.noBOnly:
+                        if not self.out.var("ZERO"):
+                            self.doVar("ZERO[0.0]")
+                        customizer = ROOT.RooCustomizer(prop, "")
+                        for arg in sigcoeffs:
+                            customizer.replaceArg(arg, self.out.var("ZERO"))
+                        prop_b = customizer.build(True)
+                        if len(sigcoeffs):
+                            prop_b.SetName("prop_bin%s_bonly" % b)
+                        self.objstore[prop_b.GetName()] = prop_b
+                        sum_b = self.addObj(
+                            ROOT.RooRealSumPdf,
+                            "pdf_bin%s_bonly" % b,
+                            "",
+                            ROOT.RooArgList(prop_b),
+                            ROOT.RooArgList(self.out.var("ONE")),
+                            True,
+                        )
+                else:
+                    sum_s = self.addObj(ROOT.RooAddPdf, "pdf_bin%s" % b, "", pdfs, coeffs)
+                    if not self.options.noBOnly:
+                        sum_b = self.addObj(ROOT.RooAddPdf, "pdf_bin%s_bonly" % b, "", bgpdfs, bgcoeffs)
+                if channelHash is not None:
+                    # keep track of what the channel was built from, so that it can be reused with --reuse-channels-from
+                    sum_s.setStringAttribute("combine.channelHash", channelHash)
+                    sum_s.setStringAttribute("combine.binPars", ",".join(["%s:%s" % (n, parname) for (n, parname) in channelBinPars]))
             sum_s.setAttribute("MAIN_MEASUREMENT")  # useful for plain ROOFIT optimization on ATLAS side
             if b in self.pdfModes:
                 sum_s.setAttribute("forceGen" + self.pdfModes[b].title())
@@ -348,7 +367,7 @@ class ShapeBuilder(ModelBuilder):
                         stderr.write("\b\b\b\b\b")
                     stderr.write(". %4d" % (i + 1))
                     stderr.flush()
-            if channelBinParFlag and not self.options.noHistFuncWrappers:
+            if channelBinParFlag and not self.options.noHistFuncWrappers and not reused:
                 for idx in range(pdfs.getSize()):
                     wrapper = ROOT.CMSHistFuncWrapper(
                         pdfs[idx].GetName() + "_wrapper",
@@ -367,6 +386,8 @@ class ShapeBuilder(ModelBuilder):
                         pdfs.at(idx).getStringAttribute("combine.channel"),
                     )
                     self.extraImports.append(wrapper)
+                sum_s.setStringAttribute("combine.wrappers", ",".join([pdfs.at(idx).GetName() + "_wrapper" for idx in range(pdfs.getSize())]))
+            self.profiler.end()
 
         if len(bbb_names) > 0:
             bbb_nuisanceargset = ROOT.RooArgSet()
@@ -379,6 +400,8 @@ class ShapeBuilder(ModelBuilder):
             self.out.defineSet("group_autoMCStats", bbb_nuisanceargset)
         if self.options.verbose:
             stderr.write("\b\b\b\bdone.\n")
+            if self._reuseWsp:
+                stderr.write("Reused the model of %d out of %d channels from %s\n" % (nreused, len(self.DC.bins), self.options.reuseChannelsFrom))
             stderr.flush()
 
     def doCombination(self):
@@ -447,6 +470,46 @@ class ShapeBuilder(ModelBuilder):
                 if arg.InheritsFrom("RooRealVar") and arg.GetName() != "r":
                     arg.setConstant(True)
 
+    def reuseChannelModel(self, channel, channelHash, binconstraints, bbb_names):
+        """
+        Take the model of a channel from the workspace given with --reuse-channels-from, if it was built from the same inputs.
+        The autoMCStats parameters and their constraints are imported, and the CMSHistFuncWrappers are queued for import.
+        Returns the s+b and b-only pdfs of the channel (before multiplying by the constraints), or None if it has to be rebuilt.
+        """
+        if not self._reuseWsp:
+            return None
+        # the channel pdf is renamed to pdf_bin<X>_nuis when it is multiplied by the constraint terms
+        for postfix in ["_nuis", ""]:
+            sum_s = self._reuseWsp.pdf("pdf_bin%s%s" % (channel, postfix))
+            if sum_s:
+                break
+        if not sum_s or sum_s.getStringAttribute("combine.channelHash") != channelHash:
+            return None
+        sum_b = self._reuseWsp.pdf("pdf_bin%s_bonly%s" % (channel, postfix))
+        if not sum_b and not self.options.noBOnly:
+            return None
+        if self.options.verbose > 1:
+            stderr.write("Reusing the model of channel %s from %s\n" % (channel, self.options.reuseChannelsFrom))
+        binPars = sum_s.getStringAttribute("combine.binPars")
+        for binPar in binPars.split(",") if binPars else []:
+            n, parname = binPar.split(":")
+            self.out.safe_import(self._reuseWsp.pdf("%s_Pdf" % n), ROOT.RooFit.RecycleConflictNodes())
+            bbb_names.append(n)
+            binconstraints.add(self.out.pdf("%s_Pdf" % n))
+            self.extraNuisances.append(self.out.var("%s" % parname))
+            self.extraGlobalObservables.append(self.out.var("%s_In" % n))
+        wrappers = sum_s.getStringAttribute("combine.wrappers")
+        if wrappers and not self.options.noHistFuncWrappers:
+            for wrapper in wrappers.split(","):
+                self.extraImports.append(self._reuseWsp.arg(wrapper))
+        # work on copies, so that the names and attributes of the pdfs in the reused workspace are not modified
+        sum_s = sum_s.Clone("pdf_bin%s" % channel)
+        self.objstore[sum_s.GetName()] = sum_s
+        if sum_b:
+            sum_b = sum_b.Clone("pdf_bin%s_bonly" % channel)
+            self.objstore[sum_b.GetName()] = sum_b
+        return sum_s, sum_b
+
     def RenameDupObjs(self, dupObjs, dupNames, newObj, postFix):
         # print 'Checking for duplicates in %s' % newObj.GetName()
         branchNodes = ROOT.RooArgList()
@@ -467,6 +530,9 @@ class ShapeBuilder(ModelBuilder):
     ## -------- High level helpers ----------
     ## --------------------------------------
     def prepareAllShapes(self):
+        if getattr(self.options, "shapeWorkers", 0) > 1:
+            with self.profiler.stage("prefetchShapes"):
+                self.prefetchShapes()
         shapeTypes = []
         shapeBins = {}
         shapeObs = {}
@@ -618,6 +684,65 @@ class ShapeBuilder(ModelBuilder):
         # keep hold of pdf_norm renaming
         self.DC.pdfnorms = self.norm_rename_map.copy()
 
+    def prefetchShapes(self):
+        """Read the nominal and Up/Down TH1 templates of all channels in a pool of worker processes,
+        so that getShape can pick them up without touching the input files.
+        Objects from workspaces, trees and dataframes are still loaded serially by getShape."""
+        tasks = defaultdict(list)
+        requested = {}
+        for b in self.DC.bins:
+            for p in [self.options.dataname] + list(self.DC.exp[b].keys()):
+                if len(self.DC.obs) == 0 and p == self.options.dataname:
+                    continue
+                if p != self.options.dataname and self.DC.exp[b][p] == 0:
+                    continue
+                systs = [("", False)]
+                if p != self.options.dataname:
+                    for syst, nofloat, pdf, args, value in self.DC.systematicsTable().affecting(b, p):
+                        if "shape" not in pdf:
+                            continue
+                        systShapeName = self.DC.systematicsShapeMap.get((syst, b, p), syst)
+                        systs += [(systShapeName + "Up", pdf[-1] == "?"), (systShapeName + "Down", pdf[-1] == "?")]
+                for syst, allowNoSyst in systs:
+                    resolved = self.resolveShapeNames(b, p, syst, allowNoSyst=True)
+                    if resolved is None:
+                        continue
+                    names, finalNames = resolved
+                    if ":" in finalNames[1] or os.path.splitext(finalNames[0].split(":")[0])[1] in DATAFRAME_EXTENSIONS:
+                        continue
+                    tasks[self._fileCache.resolve(finalNames[0])].append(((b, p, syst), finalNames[1]))
+                    requested[(b, p, syst)] = (names, finalNames, allowNoSyst)
+        if not tasks:
+            return
+        # split the objects of each file in about one chunk per worker, so that a file shared by all the channels
+        # is read by all the workers, each of them opening it once per chunk
+        chunks = []
+        for fname, requests in six.iteritems(tasks):
+            size = -(-len(requests) // self.options.shapeWorkers)
+            chunks += [(fname, requests[i : i + size]) for i in range(0, len(requests), size)]
+        if self.options.verbose:
+            stderr.write(
+                "Reading %d shapes from %d files in %d tasks with %d workers\n" % (len(requested), len(tasks), len(chunks), self.options.shapeWorkers)
+            )
+        # the workers are forked, so that they inherit the ROOT setup (libraries, options) of this process
+        context = multiprocessing.get_context("fork") if hasattr(multiprocessing, "get_context") else multiprocessing
+        pool = context.Pool(self.options.shapeWorkers)
+        try:
+            for fname, results, bytesRead in pool.imap_unordered(_readShapeObjects, chunks):
+                if results is None:
+                    raise RuntimeError("Cannot open file %s" % fname)
+                self._fileCache.bytesRead += bytesRead
+                for key, obj in results:
+                    names, finalNames, allowNoSyst = requested[key]
+                    if obj is None and not allowNoSyst:
+                        raise RuntimeError("Failed to find %s in file %s (from pattern %s, %s)" % (finalNames[1], finalNames[0], names[1], names[0]))
+                    if obj:
+                        self._prefetchedShapes[key] = obj
+        finally:
+            # do not wait for the outstanding reads if a template is missing
+            pool.terminate()
+            pool.join()
+
     def doCombinedDataset(self):
         if len(self.DC.bins) == 1 and self.options.forceNonSimPdf:
             data = self.getData(self.DC.bins[0], self.options.dataname).Clone(self.options.dataname)
@@ -676,44 +801,17 @@ class ShapeBuilder(ModelBuilder):
                 )
             return _cache[(channel, process, syst)]
         postFix = "Sig" if (process in self.DC.isSignal and self.DC.isSignal[process]) else "Bkg"
-        bentry = None
-        if channel in self.DC.shapeMap:
-            bentry = self.DC.shapeMap[channel]
-        elif "*" in self.DC.shapeMap:
-            bentry = self.DC.shapeMap["*"]
-        else:
-            raise KeyError("Shape map has no entry for channel '%s'" % (channel))
-        names = []
-        if process in bentry:
-            names = bentry[process]
-        elif "*" in bentry:
-            names = bentry["*"]
-        elif process in self.DC.shapeMap["*"]:
-            names = self.DC.shapeMap["*"][process]
-        elif "*" in self.DC.shapeMap["*"]:
-            names = self.DC.shapeMap["*"]["*"]
-        else:
-            raise KeyError("Shape map has no entry for process '%s', channel '%s'" % (process, channel))
-        if len(names) == 1 and names[0] == "FAKE":
+        resolved = self.resolveShapeNames(channel, process, syst, allowNoSyst)
+        if resolved is None:
             return None
-        if syst != "":
-            if len(names) == 2:
-                if allowNoSyst:
-                    return None
-                raise RuntimeError("Can't find systematic " + syst + " for process '%s', channel '%s'" % (process, channel))
-            names = [names[0], names[2]]
-        else:
-            names = [names[0], names[1]]
-        strmass = "%d" % self.options.mass if self.options.mass % 1 == 0 else str(self.options.mass)
-        finalNames = [x.replace("$PROCESS", process).replace("$CHANNEL", channel).replace("$SYSTEMATIC", syst).replace("$MASS", strmass) for x in names]
-        for mp in self.options.modelparams:
-            if len(mp.split("=")) != 2:
-                raise RuntimeError("No value found for keyword in %s (use --keyword-value WORD=VALUE)" % mp)
-            mpname, mpv = mp.split("=")
-            protected_kwords = ["PROCESS", "CHANNEL", "SYSTEMATIC", "MASS"]
-            if mpname in protected_kwords:
-                raise RuntimeError("Cannot use the following keywords (already assigned in combine): $" + " $".join(protected_kwords))
-            finalNames = [fn.replace("$%s" % mpname, mpv) for fn in finalNames]
+        names, finalNames = resolved
+        ret = self._prefetchedShapes.pop((channel, process, syst), None)
+        if ret is not None:
+            ret.SetName("shape%s_%s_%s%s" % (postFix, process, channel, "_" + syst if syst else ""))
+            if self.options.verbose > 2:
+                print("import prefetched (%s,%s) -> %s\n" % (finalNames[0], finalNames[1], ret.GetName()))
+            _cache[(channel, process, syst)] = ret
+            return ret
         file = self._fileCache[finalNames[0]]
         objname = finalNames[1]
         if not file:
@@ -722,9 +820,7 @@ class ShapeBuilder(ModelBuilder):
         # follow histogram routine if file is a dataframe and load dataframe as histograms
         if ":" in objname and not isinstance(file, DataFrameWrapper):  # workspace:obj or ttree:xvar or th1::xvar
             (wname, oname) = objname.split(":")
-            if (file, wname) not in self.wspnames:
-                self.wspnames[(file, wname)] = file.Get(wname)
-            self.wsp = self.wspnames[(file, wname)]
+            self.wsp = self._fileCache.getObject(finalNames[0], wname)
             if not self.wsp:
                 raise RuntimeError("Failed to find %s in file %s (from pattern %s, %s)" % (wname, finalNames[0], names[1], names[0]))
             if self.wsp.ClassName() == "RooWorkspace":
@@ -849,6 +945,121 @@ class ShapeBuilder(ModelBuilder):
             _cache[(channel, process, syst)] = ret
             return ret
 
+    def channelShapeNames(self, channel, filesOnly=False):
+        """
+        Return the list of (process, variation, file name, object name), with all keywords replaced, of the shapes of a
+        channel: the nominal ones and the Up/Down ones of its shape systematics. With filesOnly, the variations are only
+        resolved when the file name depends on the systematic.
+        """
+        ret = []
+        for p in [self.options.dataname] + list(self.DC.exp[channel].keys()):
+            if len(self.DC.obs) == 0 and p == self.options.dataname:
+                continue
+            if p != self.options.dataname and self.DC.exp[channel][p] == 0:
+                continue
+            resolved = self.resolveShapeNames(channel, p)
+            if resolved is None:
+                continue
+            names, finalNames = resolved
+            ret.append((p, "", finalNames[0], finalNames[1]))
+            if filesOnly and "$SYSTEMATIC" not in names[0]:
+                continue
+            for syst, nofloat, pdf, args, value in self.DC.systematicsTable().affecting(channel, p):
+                if "shape" not in pdf:
+                    continue
+                systShapeName = self.DC.systematicsShapeMap.get((syst, channel, p), syst)
+                for shift in ["Up", "Down"]:
+                    resolved = self.resolveShapeNames(channel, p, systShapeName + shift, allowNoSyst=True)
+                    if resolved is not None:
+                        ret.append((p, systShapeName + shift, resolved[1][0], resolved[1][1]))
+        return ret
+
+    def channelInputFiles(self, channel):
+        """Return the set of files the shapes of a channel are read from"""
+        # dataframe inputs can carry an internal path after the file name
+        return set([self._fileCache.resolve(f.split(":")[0]) for (p, syst, f, objname) in self.channelShapeNames(channel, filesOnly=True)])
+
+    def channelHash(self, channel):
+        """
+        Return a hash of everything the model of a channel is built from: the build options, the binning of the observable,
+        the datacard entries for the channel, the names of the objects it reads and the size and modification time of its input files, of the physics model module
+        and of the combine python modules.
+        It is only computed with --reuse-channels-from or --workspace-cache.
+        """
+        if self._channelHashInputs is None:
+            # what does not depend on the channel, and the keyline and shape renamings split by channel, are computed once
+            channelProcs, shapeMap = {}, {}
+            for b, p, s in self.DC.keyline:
+                channelProcs.setdefault(b, []).append((p, s))
+            for k, v in six.iteritems(self.DC.systematicsShapeMap):
+                shapeMap.setdefault(k[1], []).append((k, v))
+            # the yield scalings of the physics model are part of the channel model, so a change of its code must change the hash
+            physModFile = getattr(modules.get(type(self.physics).__module__), "__file__", None)
+            signature = optionsSignature(self.options) + repr((physModFile, fileSignature(physModFile) if physModFile else None)) + codeSignature()
+            self._channelHashInputs = (signature.encode("utf-8"), channelProcs, shapeMap)
+        signature, channelProcs, shapeMap = self._channelHashInputs
+        h = hashlib.sha1()
+        h.update(signature)
+        h.update(repr((getattr(self.out, "maxbins", None), getattr(self, "TH1Observables", {}).get(channel), self.DC.binParFlags.get(channel))).encode("utf-8"))
+        procs = [(p, s, self.DC.exp[channel][p]) for (p, s) in channelProcs.get(channel, [])]
+        h.update(repr(procs).encode("utf-8"))
+        h.update(repr([self.DC.rateParams.get("%sAND%s" % (channel, p)) for (p, s, e) in procs]).encode("utf-8"))
+        h.update(repr(sorted(shapeMap.get(channel, []))).encode("utf-8"))
+        systs = []
+        for p, s, e in procs:
+            for syst, nofloat, pdf, args, value in self.DC.systematicsTable().affecting(channel, p):
+                systs.append((syst, nofloat, pdf, args, p, value))
+        h.update(repr(systs).encode("utf-8"))
+        # the names of the objects read, as a shapes line can be changed without changing the files
+        h.update(repr(self.channelShapeNames(channel)).encode("utf-8"))
+        for fname in sorted(self.channelInputFiles(channel)):
+            h.update(repr((fname, fileSignature(fname))).encode("utf-8"))
+        return h.hexdigest()
+
+    def resolveShapeNames(self, channel, process, syst="", allowNoSyst=False):
+        """Return the file and object name patterns from the shapes line, and the same names with all keywords replaced,
+        for a given channel, process and systematic variation. Returns None for FAKE shapes, or for variations that
+        have no pattern in the shapes line when allowNoSyst is set."""
+        bentry = None
+        if channel in self.DC.shapeMap:
+            bentry = self.DC.shapeMap[channel]
+        elif "*" in self.DC.shapeMap:
+            bentry = self.DC.shapeMap["*"]
+        else:
+            raise KeyError("Shape map has no entry for channel '%s'" % (channel))
+        names = []
+        if process in bentry:
+            names = bentry[process]
+        elif "*" in bentry:
+            names = bentry["*"]
+        elif process in self.DC.shapeMap["*"]:
+            names = self.DC.shapeMap["*"][process]
+        elif "*" in self.DC.shapeMap["*"]:
+            names = self.DC.shapeMap["*"]["*"]
+        else:
+            raise KeyError("Shape map has no entry for process '%s', channel '%s'" % (process, channel))
+        if len(names) == 1 and names[0] == "FAKE":
+            return None
+        if syst != "":
+            if len(names) == 2:
+                if allowNoSyst:
+                    return None
+                raise RuntimeError("Can't find systematic " + syst + " for process '%s', channel '%s'" % (process, channel))
+            names = [names[0], names[2]]
+        else:
+            names = [names[0], names[1]]
+        strmass = "%d" % self.options.mass if self.options.mass % 1 == 0 else str(self.options.mass)
+        finalNames = [x.replace("$PROCESS", process).replace("$CHANNEL", channel).replace("$SYSTEMATIC", syst).replace("$MASS", strmass) for x in names]
+        for mp in self.options.modelparams:
+            if len(mp.split("=")) != 2:
+                raise RuntimeError("No value found for keyword in %s (use --keyword-value WORD=VALUE)" % mp)
+            mpname, mpv = mp.split("=")
+            protected_kwords = ["PROCESS", "CHANNEL", "SYSTEMATIC", "MASS"]
+            if mpname in protected_kwords:
+                raise RuntimeError("Cannot use the following keywords (already assigned in combine): $" + " $".join(protected_kwords))
+            finalNames = [fn.replace("$%s" % mpname, mpv) for fn in finalNames]
+        return names, finalNames
+
     def getData(self, channel, process, syst="", _cache={}):
         return self.shape2Data(self.getShape(channel, process, syst), channel, process)
 
@@ -863,11 +1074,9 @@ class ShapeBuilder(ModelBuilder):
         morphs = []
         shapeAlgo = None
         channelBinParFlag = channel in list(self.DC.binParFlags.keys())
-        for syst, nofloat, pdf, args, errline in self.DC.systs:
+        for syst, nofloat, pdf, args, value in self.DC.systematicsTable().affecting(channel, process):
             if "shape" not in pdf:
                 continue
-            if errline[channel][process] == 0:
-                continue
             allowNoSyst = pdf[-1] == "?"
             pdf = pdf.replace("?", "")
             if pdf[-1] == "U":
@@ -878,7 +1087,7 @@ class ShapeBuilder(ModelBuilder):
                 errmsg = "ERROR for channel %s, process %s. " % (channel, process)
                 errmsg += "Requesting morphing %s  for systematic %s after having requested %s. " % (pdf, syst, shapeAlgo)
                 raise RuntimeError(errmsg + " One can use only one morphing algorithm for a given shape")
-            if errline[channel][process] != 0:
+            if value != 0:
                 if allowNoSyst and not self.isShapeSystematic(channel, process, syst):
                     continue
                 systShapeName = syst
@@ -894,13 +1103,13 @@ class ShapeBuilder(ModelBuilder):
                     morphs.append(
                         (
                             syst,
-                            errline[channel][process],
+                            value,
                             self.shape2Pdf(shapeUp, channel, process),
                             self.shape2Pdf(shapeDown, channel, process),
                         )
                     )
                 else:
-                    morphs.append((syst, errline[channel][process], shapeUp, shapeDown))
+                    morphs.append((syst, value, shapeUp, shapeDown))
         if len(morphs) == 0:
             if self.options.useHistPdf == "always":
                 return nominalPdf
@@ -1130,10 +1339,10 @@ class ShapeBuilder(ModelBuilder):
             return None
         if normNominal == 0:
             raise RuntimeError("Null norm for channel %s, process %s" % (channel, process))
-        for syst, nofloat, pdf, args, errline in self.DC.systs:
+        for syst, nofloat, pdf, args, value in self.DC.systematicsTable().affecting(channel, process):
             if "shape" not in pdf:
                 continue
-            if errline[channel][process] != 0:
+            if value != 0:
                 if pdf[-1] == "?" and not self.isShapeSystematic(channel, process, syst):
                     continue
                 systShapeName = syst
@@ -1158,9 +1367,9 @@ class ShapeBuilder(ModelBuilder):
                 kappaDown /= normNominal
                 if abs(kappaUp - 1) < 1e-3 and abs(kappaDown - 1) < 1e-3:
                     continue
-                # if errline[channel][process] == <x> it means the gaussian should be scaled by <x> before doing pow
+                # if value == <x> it means the gaussian should be scaled by <x> before doing pow
                 # for convenience, we scale the kappas
-                kappasScaled = [pow(x, errline[channel][process]) for x in (kappaDown, kappaUp)]
+                kappasScaled = [pow(x, value) for x in (kappaDown, kappaUp)]
                 if self.options.packAsymPows:
                     terms.append((kappasScaled[0], kappasScaled[1], syst))
                 else:
@@ -1189,25 +1398,13 @@ class ShapeBuilder(ModelBuilder):
         return terms if terms else None
 
     def rebinH1(self, shape):
-        if self.options.optimizeTemplateBins:
-            rebinh1 = ROOT.TH1F(
-                shape.GetName() + "_rebin",
-                "",
-                self.out.maxbins,
-                0.0,
-                float(self.out.maxbins),
-            )
-            for i in range(1, min(shape.GetNbinsX(), self.out.maxbins) + 1):
-                rebinh1.SetBinContent(i, shape.GetBinContent(i))
-                rebinh1.SetBinError(i, shape.GetBinError(i))
-            rebinh1._original_bins = shape.GetNbinsX()
-        else:
-            shapeNbins = shape.GetNbinsX()
-            rebinh1 = ROOT.TH1F(shape.GetName() + "_rebin", "", shapeNbins, 0.0, float(shapeNbins))
-            for i in range(1, shapeNbins + 1):
-                rebinh1.SetBinContent(i, shape.GetBinContent(i))
-                rebinh1.SetBinError(i, shape.GetBinError(i))
-            rebinh1._original_bins = shapeNbins
+        # the bin contents and errors are copied in C++ (th1ToUnitBins), as a per-bin loop
+        # in python is too slow for templates with many bins and many shape systematics
+        shapeNbins = shape.GetNbinsX()
+        nbins = self.out.maxbins if self.options.optimizeTemplateBins else shapeNbins
+        rebinh1 = ROOT.th1ToUnitBins(shape.GetName() + "_rebin", shape, nbins)
+        ROOT.SetOwnership(rebinh1, True)
+        rebinh1._original_bins = shapeNbins
         return rebinh1
 
     def shape2Data(self, shape, channel, process, _cache={}):
@@ -622,6 +622,7 @@ class TrilinearHiggsKappaVKappaFSTXS12(LHCHCGBaseModel):
 
         if not self.DC.isSignal[process]:
             return 1
+        self.validateSignalProcesses(getSTXSProdDecMode)
         (processSource, foundDecay, foundEnergy) = getSTXSProdDecMode(bin, process, self.options)
         # convert decay string back to CMS default syntax
         if foundDecay in list(LHCHCG_DecSimple_to_CMS.keys()):
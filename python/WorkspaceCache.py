@@ -0,0 +1,115 @@
+from __future__ import absolute_import, print_function
+
+import hashlib
+import os
+import shutil
+from sys import modules, stderr
+
+import six
+
+# options that do not change the content of the workspace
+_ignoredOptions = [
+    "out",
+    "fileName",
+    "baseDir",
+    "verbose",
+    "dumpCard",
+    "shapeWorkers",
+    "workspaceCache",
+    "reuseChannelsFrom",
+    "sparseDatacard",
+    "profileStages",
+    "saveBinaryCard",
+]
+
+
+def optionsSignature(options):
+    """Return a string with the values of all options that affect the content of the workspace"""
+    return repr(sorted([(k, repr(v)) for (k, v) in six.iteritems(vars(options)) if k not in _ignoredOptions]))
+
+
+def inputFiles(DC, MB, options):
+    """
+    Return the set of files read when building the workspace for this datacard: the shape inputs
+    referenced in the shapes lines, and the external workspaces used by extArg and rateParam lines.
+    """
+    files = set()
+    if DC.hasShapes:
+        for b in DC.bins:
+            files.update(MB.channelInputFiles(b))
+    # the external workspaces are looked up like the shape inputs, also in the base directory of the datacard
+    for argv in six.itervalues(DC.extArgs):
+        if ":" in argv[-1]:
+            files.add(MB._fileCache.resolve(argv[-1].split(":")[0]))
+    for rateParams in six.itervalues(DC.rateParams):
+        for rp in rateParams:
+            if rp[0][-1] == 2:
+                files.add(MB._fileCache.resolve(rp[0][1].split(":")[0]))
+    return files
+
+
+def fileSignature(fname):
+    """Return the size and modification time of a file, or None if it does not exist"""
+    try:
+        st = os.stat(fname)
+    except OSError:
+        return None
+    return (st.st_size, st.st_mtime)
+
+
+def codeSignature():
+    """
+    Return a string with the size and modification time of the source of every HiggsAnalysis.CombinedLimit
+    python module loaded so far: the model builders, the datacard parser, the physics models and what they import
+    """
+    sources = []
+    for name, module in sorted(list(modules.items()), key=lambda item: item[0]):
+        if not name.startswith("HiggsAnalysis.CombinedLimit"):
+            continue
+        fname = getattr(module, "__file__", None)
+        if fname:
+            sources.append((name, fileSignature(fname)))
+    return repr(sources)
+
+
+def workspaceCacheKey(cardPath, DC, MB, options, extraFiles=[]):
+    """
+    Return the key of the workspace in the cache. It is a hash of the datacard text, of all the options
+    that affect the workspace (including the physics model and its --PO options), of the size and
+    modification time of every input file and of the extraFiles (e.g. the physics model module), and of
+    the python code of combine that is loaded (see codeSignature).
+    """
+    h = hashlib.sha1()
+    with open(cardPath, "rb") as card:
+        h.update(card.read())
+    h.update(optionsSignature(options).encode("utf-8"))
+    h.update(codeSignature().encode("utf-8"))
+    for fname in sorted(inputFiles(DC, MB, options)) + list(extraFiles):
+        h.update(repr((fname, fileSignature(fname))).encode("utf-8"))
+    return h.hexdigest()
+
+
+def fetchFromWorkspaceCache(cacheDir, key, out, verbose=0):
+    """Copy the cached workspace with this key to out. Returns False if there is none."""
+    cached = os.path.join(cacheDir, key + ".root")
+    if not os.path.exists(cached):
+        if verbose:
+            stderr.write("Workspace %s not found in cache %s, will build it\n" % (key, cacheDir))
+        return False
+    if verbose:
+        stderr.write("Workspace %s found in cache %s, copying it to %s\n" % (key, cacheDir, out))
+    shutil.copyfile(cached, out)
+    return True
+
+
+def storeInWorkspaceCache(cacheDir, key, out, verbose=0):
+    """Copy the workspace just written to out in the cache, under this key"""
+    if not os.path.isdir(cacheDir):
+        os.makedirs(cacheDir)
+    cached = os.path.join(cacheDir, key + ".root")
+    # copy then rename, so that concurrent jobs never pick up a partially written file
+    tmp = "%s.%d.tmp" % (cached, os.getpid())
+    shutil.copyfile(out, tmp)
+    os.rename(tmp, cached)
+    if verbose:
+        stderr.write("Stored workspace %s in cache %s\n" % (key, cacheDir))
@@ -1,13 +1,19 @@
 #!/usr/bin/env python3
 from __future__ import absolute_import, print_function
 
+import atexit
+import json
 import os.path
 import re
+import sqlite3
+import sys
+import tempfile
+from collections import OrderedDict
 from optparse import OptionParser
 from sys import argv, exit
 
 import six
-from six.moves import range
+from six.moves import map, range
 
 from HiggsAnalysis.CombinedLimit.DatacardParser import *
 
@@ -92,6 +98,29 @@ parser.add_option(
     action="store_true",
     help="Drop regularization terms that would not be correctly combined.",
 )
+parser.add_option(
+    "--parse-workers",
+    dest="parseWorkers",
+    default=0,
+    type="int",
+    help="Parse the input datacards in a pool of this many worker processes (default: parse them serially). The output is the same as in the serial case",
+)
+parser.add_option(
+    "-o",
+    "--output",
+    type="string",
+    dest="output",
+    default=None,
+    help="Write the combined datacard to this file instead of the standard output (gzipped if the name ends with .gz)",
+)
+parser.add_option(
+    "--stream",
+    dest="stream",
+    default=False,
+    action="store_true",
+    help="Keep the effects of the systematics in a temporary file instead of in memory, and write the combined datacard one systematic at a time. "
+    + "Useful for combinations with a very large number of bins and processes",
+)
 
 (options, args) = parser.parse_args()
 options.bin = True  # fake that is a binary output, so that we parse shape lines
@@ -117,7 +146,7 @@ shapeLines = []
 paramSysts = {}
 flatParamNuisances = {}
 discreteNuisances = {}
-groups = {}
+groups = OrderedDict()
 rateParamsPerCard = []
 extArgs = {}
 binParFlags = {}
@@ -144,10 +173,13 @@ def compareParamSystLines(a, b):
     return True
 
 
-cmax = 5  # column width
-if not args:
-    raise RuntimeError("No input datacards specified.")
-for ich, fname in enumerate(args):
+def parseAndRelabelCard(task):
+    """
+    Parse one input datacard and relabel its bins, returning everything the merge needs as plain python objects.
+    This only depends on the card itself, so it can run in a worker process.
+    """
+    ich, fname, options = task
+    card = {"cmax": 0, "obskeyline": [], "keyline": [], "expline": [], "systs": [], "regularization": []}
     label = "ch%d" % (ich + 1)
     if "=" in fname:
         (label, fname) = fname.split("=")
@@ -161,6 +193,7 @@ for ich, fname in enumerate(args):
     else:
         file = open(fname, "r")
     DC = parseCard(file, options)
+    card["fname"] = fname
     singlebin = len(DC.bins) == 1
     if label == ".":
         label = DC.bins[0] if singlebin else ""
@@ -173,29 +206,24 @@ for ich, fname in enumerate(args):
             continue
         if not isIncluded(b_in, options.channelIncludes):
             continue
-        obskeyline.append(bout)
+        card["obskeyline"].append(bout)
         for p, e in DC.exp[b].items():  # so that we get only self.DC.processes contributing to this bin
             if not DC.isSignal[p]:
                 continue
             # print "in DC.exp.items:b,p", b,p
-            expline.append("%s" % FloatToString(e)) if (e == 0 or e > 1e-3) else expline.append("%s" % FloatToStringScientific(e))
-            keyline.append((bout, p, DC.isSignal[p]))
+            card["expline"].append("%s" % FloatToString(e)) if (e == 0 or e > 1e-3) else card["expline"].append("%s" % FloatToStringScientific(e))
+            card["keyline"].append((bout, p, DC.isSignal[p]))
         for p, e in DC.exp[b].items():  # so that we get only self.DC.processes contributing to this bin
             if DC.isSignal[p]:
                 continue
             # print "in DC.exp.items:b,p", b,p
-            expline.append("%s" % FloatToString(e)) if (e == 0 or e > 1e-3) else expline.append("%s" % FloatToStringScientific(e))
-            keyline.append((bout, p, DC.isSignal[p]))
+            card["expline"].append("%s" % FloatToString(e)) if (e == 0 or e > 1e-3) else card["expline"].append("%s" % FloatToStringScientific(e))
+            card["keyline"].append((bout, p, DC.isSignal[p]))
     # systematics
     for lsyst, nofloat, pdf, pdfargs, errline in DC.systs:
         systeffect = {}
         if pdf == "param":
-            if lsyst in paramSysts:
-                # if paramSysts[lsyst] != pdfargs:
-                if not compareParamSystLines(paramSysts[lsyst], pdfargs):
-                    raise RuntimeError("Parameter uncerainty %s mismatch between cards, %g != %g" % lsyst)
-            else:
-                paramSysts[lsyst] = pdfargs
+            card["systs"].append((lsyst, nofloat, pdf, pdfargs, None))
             continue
         for b in DC.bins:
             bout = label if singlebin else label + b
@@ -209,26 +237,12 @@ for ich, fname in enumerate(args):
             for p in DC.exp[b].keys():  # so that we get only self.DC.processes contributing to this bin
                 # Catch the case in which the datacard has constraint terms at the end in the form:
                 # constr0 constr @3*(@0-2*@1+@2) r_0,r_1,r_2,regularize[0.] delta[10.]
-                # these elements will not be used in the combination, hence raise a warning and store them in a list
-                # that will be printed at the end
+                # these elements will not be used in the combination, the merge will raise a warning and
+                # store them in a list that will be printed at the end
                 try:
                     r = str(errline[b][p])
                 except TypeError:
-                    import warnings
-
-                    warning_message = (
-                        "\nYou probably have one or more regularization term(s) in datacard {}.\n".format(fname)
-                        + "A constraint term is a line that looks like the following:\n\n"
-                        + "\tconstr0 constr @3*(@0-2*@1+@2) r_0,r_1,r_2,regularize[0.] delta[10.]\n\n"
-                    )
-                    if options.drop_regularization_terms:
-                        warning_message += "It (they) will be dropped."
-                    else:
-                        warning_message += "It (they) will be appended to the datacard."
-                        line = " ".join([lsyst, pdf] + pdfargs)
-                        if line not in constraint_terms:
-                            constraint_terms.append(line)
-                    warnings.warn(warning_message, RuntimeWarning)
+                    card["regularization"].append(" ".join([lsyst, pdf] + pdfargs))
                     break
                 if type(errline[b][p]) == list:
                     r = "%s/%s" % (
@@ -239,52 +253,19 @@ for ich, fname in enumerate(args):
                     r = "%s" % FloatToString(errline[b][p])
                 if errline[b][p] == 0:
                     r = "-"
-                if len(r) > cmax:
-                    cmax = len(r)  # get max col length, as it's more tricky to do it later with a map
+                if len(r) > card["cmax"]:
+                    card["cmax"] = len(r)  # get max col length, as it's more tricky to do it later with a map
                 systeffect[bout][p] = r
-        if lsyst in systlines:
-            (otherpdf, otherargs, othereffect, othernofloat) = systlines[lsyst]
-            if otherpdf != pdf:
-                if pdf == "lnN" and otherpdf.startswith("shape"):
-                    if systlines[lsyst][0][-1] != "?":
-                        systlines[lsyst][0] += "?"
-                    for b, v in systeffect.items():
-                        othereffect[b] = v
-                elif pdf.startswith("shape") and otherpdf == "lnN":
-                    if pdf[-1] != "?":
-                        pdf += "?"
-                    systlines[lsyst][0] = pdf
-                    for b, v in systeffect.items():
-                        othereffect[b] = v
-                elif (pdf == otherpdf + "?") or (pdf + "?" == otherpdf):
-                    systlines[lsyst][0] = pdf.replace("?", "") + "?"
-                    for b, v in systeffect.items():
-                        othereffect[b] = v
-                else:
-                    raise RuntimeError(
-                        "File %s defines systematic %s as using pdf %s, while a previous file defines it as using %s" % (fname, lsyst, pdf, otherpdf)
-                    )
-            else:
-                if pdf == "gmN" and int(pdfargs[0]) != int(otherargs[0]):
-                    raise RuntimeError(
-                        "File %s defines systematic %s as using gamma with %s events in sideband, while a previous file has %s"
-                        % (fname, lsyst, pdfargs[0], otherargs[0])
-                    )
-                for b, v in systeffect.items():
-                    othereffect[b] = v
-        else:
-            pdfargs = [str(x) for x in pdfargs]
-            systlines[lsyst] = [pdf, pdfargs, systeffect, nofloat]
+        card["systs"].append((lsyst, nofloat, pdf, pdfargs, systeffect))
     # flat params
-    for K in six.iterkeys(DC.flatParamNuisances):
-        flatParamNuisances[K] = True
-    for K in DC.extArgs.keys():
-        extArgs[K] = DC.extArgs[K]
+    card["flatParamNuisances"] = list(six.iterkeys(DC.flatParamNuisances))
+    card["extArgs"] = [(K, DC.extArgs[K]) for K in DC.extArgs.keys()]
+    card["binParFlags"] = []
     for K in six.iterkeys(DC.binParFlags):
         tbin = label if singlebin else label + K
-        binParFlags[tbin] = DC.binParFlags[K]
-        bpf_new2old[tbin] = K
+        card["binParFlags"].append((tbin, DC.binParFlags[K], K))
     # rate params (sort to provide consistent per-card ordering)
+    card["rateParams"] = []
     for K in sorted(DC.rateParams):
         tbin, tproc = K.split("AND")[0], K.split("AND")[1]
         b_in = tbin
@@ -293,14 +274,11 @@ for ich, fname in enumerate(args):
             continue
         if not isIncluded(b_in, options.channelIncludes):
             continue
-        rateParamsPerCard.append((tbin, tproc, DC.rateParams[K]))
+        card["rateParams"].append((tbin, tproc, DC.rateParams[K]))
     # discrete nuisance
-    for K in DC.discretes:
-        if K in discreteNuisances:
-            raise RuntimeError("Cannot currently correlate discrete nuisances across categories. Rename %s in one." % K)
-        else:
-            discreteNuisances[K] = True
+    card["discretes"] = DC.discretes
     # put shapes, if available
+    card["shapeLines"] = []
     if len(DC.shapeMap):
         for b in DC.bins:
             bout = label if singlebin else label + b
@@ -315,22 +293,23 @@ for ich, fname in enumerate(args):
                 xrep = [xi.replace("$CHANNEL", b) for xi in x]
                 if xrep[0] != "FAKE" and dirname != "" and not xrep[0].startswith("/"):
                     xrep[0] = dirname + "/" + xrep[0]
-                shapeLines.append((p, bout, xrep))
+                card["shapeLines"].append((p, bout, xrep))
             for p, x in p2sMapD.items():
                 if p in p2sMap:
                     continue
                 xrep = [xi.replace("$CHANNEL", b) for xi in x]
                 if xrep[0] != "FAKE" and dirname != "" and not xrep[0].startswith("/"):
                     xrep[0] = dirname + "/" + xrep[0]
-                shapeLines.append((p, bout, xrep))
+                card["shapeLines"].append((p, bout, xrep))
     elif options.shape:
         for b in DC.bins:
             bout = label if singlebin else label + b
-            shapeLines.append(("*", bout, ["FAKE"]))
-    # combine observations, but remove line if any of the datacards doesn't have it
+            card["shapeLines"].append(("*", bout, ["FAKE"]))
+    # observations, None if the datacard doesn't have them
     if len(DC.obs) == 0:
-        obsline = None
-    elif obsline != None:
+        card["obsline"] = None
+    else:
+        card["obsline"] = []
         for b in DC.bins:
             bout = label if singlebin else label + b
             b_in = label if singlebin else b
@@ -338,20 +317,21 @@ for ich, fname in enumerate(args):
                 continue
             if not isIncluded(b_in, options.channelIncludes):
                 continue
-            obsline += [FloatToString(DC.obs[b])]
-    # get the groups - keep nuisances in a set so that they are never repetitions
-    for groupName, nuisanceNames in six.iteritems(DC.groups):
-        if groupName in groups:
-            groups[groupName].update(set(nuisanceNames))
-        else:
-            groups[groupName] = set(nuisanceNames)
+            card["obsline"] += [FloatToString(DC.obs[b])]
+    # the nuisances of each group are sets in the datacard: list them in the order of the systematics of the card (and
+    # then alphabetically for the other parameters), so that the output does not depend on the iteration order of sets
+    systOrder = dict([(syst[0], i) for (i, syst) in enumerate(DC.systs)])
+    card["groups"] = [
+        (groupName, sorted(nuisanceNames, key=lambda n: (systOrder.get(n, len(systOrder)), n))) for (groupName, nuisanceNames) in six.iteritems(DC.groups)
+    ]
 
     # Finally report nuisance edits propagated to end of card
+    card["nuisanceEdits"] = []
     for editline in DC.nuisanceEditLines:
         if len(editline) == 2:
-            nuisanceEdits.append("%s %s" % (editline[0], " ".join(editline[1])))
+            card["nuisanceEdits"].append("%s %s" % (editline[0], " ".join(editline[1])))
         elif len(editline) == 4 and not editline[3]:
-            nuisanceEdits.append(" ".join(editline[0:3]))
+            card["nuisanceEdits"].append(" ".join(editline[0:3]))
         else:
             tmp_chan = editline[2]
             tmp_proc = editline[1]
@@ -365,8 +345,179 @@ for ich, fname in enumerate(args):
                 tmp_proc = "(%s)" % ("|".join(p for p in DC.processes))
                 if "ifexists" not in editline[3]:
                     editline[3].append("ifexists")
-            nuisanceEdits.append("%s %s %s %s" % (editline[0], tmp_proc, tmp_chan, " ".join(editline[3])))
+            card["nuisanceEdits"].append("%s %s %s %s" % (editline[0], tmp_proc, tmp_chan, " ".join(editline[3])))
+    return card
+
+
+class SystEffects(object):
+    """The effects of the systematics on each output bin and process, as {systematic : {bin : {process : value}}}"""
+
+    def __init__(self):
+        self.effects = {}
 
+    def update(self, lsyst, systeffect):
+        """Set the effects of this systematic in the bins of systeffect, replacing those from previous cards"""
+        if lsyst not in self.effects:
+            self.effects[lsyst] = {}
+        self.effects[lsyst].update(systeffect)
+
+    def get(self, lsyst):
+        return self.effects[lsyst]
+
+    def close(self):
+        self.effects = {}
+
+
+class StreamedSystEffects(SystEffects):
+    """
+    Same as SystEffects, but the effects are stored in a temporary sqlite file, one row per systematic and bin,
+    so that only the effects of the systematic being written are ever in memory.
+    """
+
+    def __init__(self):
+        fd, self.fname = tempfile.mkstemp(prefix="combineCards_", suffix=".sqlite")
+        os.close(fd)
+        self.db = sqlite3.connect(self.fname)
+        self.db.execute("PRAGMA journal_mode = OFF")
+        self.db.execute("PRAGMA synchronous = OFF")
+        self.db.execute("CREATE TABLE effects (syst TEXT, seq INTEGER, bin TEXT, effect TEXT)")
+        self.seq = 0
+        self.indexed = False
+
+    def update(self, lsyst, systeffect):
+        rows = []
+        for b, v in systeffect.items():
+            self.seq += 1
+            rows.append((lsyst, self.seq, b, json.dumps(v)))
+        self.db.executemany("INSERT INTO effects VALUES (?, ?, ?, ?)", rows)
+
+    def get(self, lsyst):
+        if not self.indexed:
+            self.db.execute("CREATE INDEX effects_syst ON effects (syst, seq)")
+            self.db.commit()
+            self.indexed = True
+        effect = {}
+        # the rows are read in the order they were written, so that later cards replace the bins of previous ones
+        for b, v in self.db.execute("SELECT bin, effect FROM effects WHERE syst = ? ORDER BY seq", (lsyst,)):
+            effect[b] = json.loads(v)
+        return effect
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+            os.remove(self.fname)
+
+
+systEffects = StreamedSystEffects() if options.stream else SystEffects()
+atexit.register(systEffects.close)
+
+cmax = 5  # column width
+if not args:
+    raise RuntimeError("No input datacards specified.")
+tasks = [(ich, fname, options) for ich, fname in enumerate(args)]
+if options.parseWorkers > 1:
+    import multiprocessing
+
+    # the workers are forked, as this script has no __main__ guard and would be run again by spawned workers
+    context = multiprocessing.get_context("fork") if hasattr(multiprocessing, "get_context") else multiprocessing
+    pool = context.Pool(options.parseWorkers)
+    # imap returns the cards in the order of the command line, so that the merge is the same as in the serial case
+    cards = pool.imap(parseAndRelabelCard, tasks)
+else:
+    pool = None
+    cards = map(parseAndRelabelCard, tasks)
+try:
+    for card in cards:
+        fname = card["fname"]
+        cmax = max(cmax, card["cmax"])
+        obskeyline += card["obskeyline"]
+        keyline += card["keyline"]
+        expline += card["expline"]
+        # systematics
+        for lsyst, nofloat, pdf, pdfargs, systeffect in card["systs"]:
+            if pdf == "param":
+                if lsyst in paramSysts:
+                    # if paramSysts[lsyst] != pdfargs:
+                    if not compareParamSystLines(paramSysts[lsyst], pdfargs):
+                        raise RuntimeError("Parameter uncerainty %s mismatch between cards, %g != %g" % lsyst)
+                else:
+                    paramSysts[lsyst] = pdfargs
+                continue
+            if lsyst in systlines:
+                (otherpdf, otherargs, othernofloat) = systlines[lsyst]
+                if otherpdf != pdf:
+                    if pdf == "lnN" and otherpdf.startswith("shape"):
+                        if systlines[lsyst][0][-1] != "?":
+                            systlines[lsyst][0] += "?"
+                    elif pdf.startswith("shape") and otherpdf == "lnN":
+                        if pdf[-1] != "?":
+                            pdf += "?"
+                        systlines[lsyst][0] = pdf
+                    elif (pdf == otherpdf + "?") or (pdf + "?" == otherpdf):
+                        systlines[lsyst][0] = pdf.replace("?", "") + "?"
+                    else:
+                        raise RuntimeError(
+                            "File %s defines systematic %s as using pdf %s, while a previous file defines it as using %s" % (fname, lsyst, pdf, otherpdf)
+                        )
+                else:
+                    if pdf == "gmN" and int(pdfargs[0]) != int(otherargs[0]):
+                        raise RuntimeError(
+                            "File %s defines systematic %s as using gamma with %s events in sideband, while a previous file has %s"
+                            % (fname, lsyst, pdfargs[0], otherargs[0])
+                        )
+            else:
+                pdfargs = [str(x) for x in pdfargs]
+                systlines[lsyst] = [pdf, pdfargs, nofloat]
+            systEffects.update(lsyst, systeffect)
+        # regularization terms, that will not be used in the combination
+        for line in card["regularization"]:
+            import warnings
+
+            warning_message = (
+                "\nYou probably have one or more regularization term(s) in datacard {}.\n".format(fname)
+                + "A constraint term is a line that looks like the following:\n\n"
+                + "\tconstr0 constr @3*(@0-2*@1+@2) r_0,r_1,r_2,regularize[0.] delta[10.]\n\n"
+            )
+            if options.drop_regularization_terms:
+                warning_message += "It (they) will be dropped."
+            else:
+                warning_message += "It (they) will be appended to the datacard."
+                if line not in constraint_terms:
+                    constraint_terms.append(line)
+            warnings.warn(warning_message, RuntimeWarning)
+        # flat params
+        for K in card["flatParamNuisances"]:
+            flatParamNuisances[K] = True
+        for K, v in card["extArgs"]:
+            extArgs[K] = v
+        for tbin, flags, K in card["binParFlags"]:
+            binParFlags[tbin] = flags
+            bpf_new2old[tbin] = K
+        rateParamsPerCard += card["rateParams"]
+        # discrete nuisance
+        for K in card["discretes"]:
+            if K in discreteNuisances:
+                raise RuntimeError("Cannot currently correlate discrete nuisances across categories. Rename %s in one." % K)
+            else:
+                discreteNuisances[K] = True
+        shapeLines += card["shapeLines"]
+        # combine observations, but remove line if any of the datacards doesn't have it
+        if card["obsline"] is None:
+            obsline = None
+        elif obsline != None:
+            obsline += card["obsline"]
+        # get the groups - keep nuisances in an ordered dict so that they are never repetitions, and always in the same order
+        for groupName, nuisanceNames in card["groups"]:
+            group = groups.setdefault(groupName, OrderedDict())
+            for nuisanceName in nuisanceNames:
+                group[nuisanceName] = True
+        nuisanceEdits += card["nuisanceEdits"]
+finally:
+    if pool is not None:
+        # all the cards are merged, or the merge failed: either way the workers are not needed anymore
+        pool.terminate()
+        pool.join()
 
 bins = []
 check_processes = {}
@@ -398,27 +549,36 @@ for b, p, s in keyline:
 if process_errors:
     raise RuntimeError("ERROR: mismatch between process signal labels:\n%s" % ("\n".join(process_errors)))
 
-print("Combination of", "  ".join(args))
-print("imax %d number of bins" % len(bins))
-print("jmax %d number of processes minus 1" % (len(signals) + len(backgrounds) - 1))
-print("kmax %d number of nuisance parameters" % (len(systlines) + len(paramSysts)))
-print("-" * 130)
+if options.output is None:
+    out = sys.stdout
+elif options.output.endswith(".gz"):
+    import gzip
+
+    out = gzip.open(options.output, "wt")
+else:
+    out = open(options.output, "w")
+
+print("Combination of", "  ".join(args), file=out)
+print("imax %d number of bins" % len(bins), file=out)
+print("jmax %d number of processes minus 1" % (len(signals) + len(backgrounds) - 1), file=out)
+print("kmax %d number of nuisance parameters" % (len(systlines) + len(paramSysts)), file=out)
+print("-" * 130, file=out)
 
 if shapeLines:
     chmax = max([max(len(p), len(c)) for p, c, x in shapeLines])
     cfmt = "%-" + str(chmax) + "s "
     shapeLines.sort(key=lambda x: (x[1], x[0]))
     for process, channel, stuff in shapeLines:
-        print("shapes", cfmt % process, cfmt % channel, " ".join(stuff))
-    print("-" * 130)
+        print("shapes", cfmt % process, cfmt % channel, " ".join(stuff), file=out)
+    print("-" * 130, file=out)
 
 if obsline:
     cmax = max([cmax] + [len(l) for l in obskeyline] + [len(x) for x in obsline])
     cfmt = "%-" + str(cmax) + "s"
-    print("bin         ", "  ".join([cfmt % x for x in obskeyline]))
-    print("observation ", "  ".join([cfmt % x for x in obsline]))
+    print("bin         ", "  ".join([cfmt % x for x in obskeyline]), file=out)
+    print("observation ", "  ".join([cfmt % x for x in obsline]), file=out)
 
-print("-" * 130)
+print("-" * 130, file=out)
 
 pidline = []
 signals = []
@@ -438,20 +598,21 @@ for b, p, s in keyline:
             backgrounds.append(p)
         pidline.append(1 + backgrounds.index(p))
 cmax = max([cmax] + [max(len(p), len(b)) for p, b, s in keyline] + [len(e) for e in expline])
-hmax = max([10] + [len("%-12s[nofloat]  %s %s" % (l, p, a)) for l, (p, a, e, nf) in systlines.items()])
+hmax = max([10] + [len("%-12s[nofloat]  %s %s" % (l, p, a)) for l, (p, a, nf) in systlines.items()])
 cfmt = "%-" + str(cmax) + "s"
 hfmt = "%-" + str(hmax) + "s  "
-print(hfmt % "bin", "  ".join([cfmt % p for p, b, s in keyline]))
-print(hfmt % "process", "  ".join([cfmt % b for p, b, s in keyline]))
-print(hfmt % "process", "  ".join([cfmt % x for x in pidline]))
-print(hfmt % "rate", "  ".join([cfmt % x for x in expline]))
+print(hfmt % "bin", "  ".join([cfmt % p for p, b, s in keyline]), file=out)
+print(hfmt % "process", "  ".join([cfmt % b for p, b, s in keyline]), file=out)
+print(hfmt % "process", "  ".join([cfmt % x for x in pidline]), file=out)
+print(hfmt % "rate", "  ".join([cfmt % x for x in expline]), file=out)
 
-print("-" * 130)
+print("-" * 130, file=out)
 
 sysnamesSorted = list(systlines.keys())
 sysnamesSorted.sort()
 for name in sysnamesSorted:
-    (pdf, pdfargs, effect, nofloat) = systlines[name]
+    (pdf, pdfargs, nofloat) = systlines[name]
+    effect = systEffects.get(name)
     if nofloat:
         name += "[nofloat]"
     systline = []
@@ -463,32 +624,33 @@ for name in sysnamesSorted:
     print(
         hfmt % ("%-21s   %s  %s" % (name, pdf, " ".join(pdfargs))),
         "  ".join([cfmt % x for x in systline]),
+        file=out,
     )
 for pname, pargs in paramSysts.items():
-    print("%-12s  param  %s" % (pname, " ".join(pargs)))
+    print("%-12s  param  %s" % (pname, " ".join(pargs)), file=out)
 
 for pname in six.iterkeys(flatParamNuisances):
-    print("%-12s  flatParam" % pname)
+    print("%-12s  flatParam" % pname, file=out)
 for tbin, tproc, params in rateParamsPerCard:
     for param in params:
-        print("%-12s  rateParam %s %s %s" % (param[0][0], tbin + " " + tproc, " ".join(param[0][1:-1]), param[1]))
+        print("%-12s  rateParam %s %s %s" % (param[0][0], tbin + " " + tproc, " ".join(param[0][1:-1]), param[1]), file=out)
         # param[0][-1] is parameter type, see DatacardParser:addRateParam()
 for dname in six.iterkeys(discreteNuisances):
-    print("%-12s  discrete" % dname)
+    print("%-12s  discrete" % dname, file=out)
 for ext in six.iterkeys(extArgs):
-    print("%s" % " ".join(extArgs[ext]))
+    print("%s" % " ".join(extArgs[ext]), file=out)
 for groupName, nuisanceNames in six.iteritems(groups):
     nuisances = " ".join(nuisanceNames)
-    print("%(groupName)s group = %(nuisances)s" % locals())
+    print("%(groupName)s group = %(nuisances)s" % locals(), file=out)
 for bpf in six.iterkeys(binParFlags):
     if isVetoed(bpf_new2old[bpf], options.channelVetos) or not isIncluded(bpf_new2old[bpf], options.channelIncludes):
         continue
     if len(binParFlags[bpf]) == 1:
-        print("%s autoMCStats %g" % (bpf, binParFlags[bpf][0]))
+        print("%s autoMCStats %g" % (bpf, binParFlags[bpf][0]), file=out)
     if len(binParFlags[bpf]) == 2:
-        print("%s autoMCStats %g %i" % (bpf, binParFlags[bpf][0], binParFlags[bpf][1]))
+        print("%s autoMCStats %g %i" % (bpf, binParFlags[bpf][0], binParFlags[bpf][1]), file=out)
     if len(binParFlags[bpf]) == 3:
-        print("%s autoMCStats %g %i %i" % (bpf, binParFlags[bpf][0], binParFlags[bpf][1], binParFlags[bpf][2]))
+        print("%s autoMCStats %g %i %i" % (bpf, binParFlags[bpf][0], binParFlags[bpf][1], binParFlags[bpf][2]), file=out)
 
 nuisanceEdits = set(nuisanceEdits)
 nuisanceEdits_lengths = [[len(e.split()), e] for e in nuisanceEdits]
@@ -497,12 +659,16 @@ nuisanceEdits = [e[1] for e in nuisanceEdits_lengths]
 nuisanceEdits_lengths = 0
 
 for edit in nuisanceEdits:
-    print("nuisance edit ", edit)
+    print("nuisance edit ", edit, file=out)
 
 if options.editNuisFile:
     file = open(options.editNuisFile, "r")
     str = file.read()
-    print(str)
+    print(str, file=out)
 
 for ct in constraint_terms:
-    print(ct)
+    print(ct, file=out)
+
+if out is not sys.stdout:
+    out.close()
+systEffects.close()
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+
+from __future__ import absolute_import, print_function
+
+from optparse import OptionParser
+from sys import exit, stderr
+
+import ROOT
+
+from HiggsAnalysis.CombinedLimit.ColumnarOutput import COLUMNAR_EXTENSIONS, treeToArrays, writeColumnar
+
+ROOT.gROOT.SetBatch(True)
+
+parser = OptionParser(
+    usage="usage: %prog [options] -o output.npz input1.root input2.root ...",
+    description="Export the limit tree of combine output files (e.g. the points of a likelihood scan, with deltaNLL, the POIs, quantileExpected and the tracked parameters) to a numpy npz or a parquet file, which the plotting scripts can load as arrays much faster than the ROOT files.",
+)
+parser.add_option("-o", "--output", dest="output", default=None, type="string", help="Output file (%s)" % ", ".join(COLUMNAR_EXTENSIONS))
+parser.add_option("-t", "--tree", dest="tree", default="limit", type="string", help="Name of the tree to export [Default: %default]")
+parser.add_option("-b", "--branches", dest="branches", default=None, type="string", help="Comma separated list of branches to export [Default: all]")
+parser.add_option(
+    "-s", "--selection", dest="selection", default="", type="string", help="Export only the entries passing this selection (e.g. 'quantileExpected > -1.5')"
+)
+parser.add_option("--compress", dest="compress", default=False, action="store_true", help="Compress the output (smaller, but slower to load)")
+options, args = parser.parse_args()
+
+if not options.output:
+    parser.error("the output file must be given with -o")
+if not args:
+    parser.error("no input files")
+
+branches = options.branches.split(",") if options.branches else None
+try:
+    arrays = treeToArrays(args, options.tree, branches, options.selection)
+    writeColumnar(arrays, options.output, options.compress)
+except RuntimeError as e:
+    stderr.write("Error: %s\n" % e)
+    exit(1)
+nentries = len(next(iter(arrays.values()))) if arrays else 0
+print("Exported %d entries of %d branches (%s) to %s" % (nentries, len(arrays), ", ".join(arrays.keys()), options.output))
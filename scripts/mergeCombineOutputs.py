@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+from __future__ import absolute_import, print_function
+
+from optparse import OptionParser
+from sys import exit, stderr
+
+import ROOT
+
+from HiggsAnalysis.CombinedLimit.OutputMerger import mergeCombineOutputs
+
+ROOT.gROOT.SetBatch(True)
+
+parser = OptionParser(
+    usage="usage: %prog [options] -o output.root input1.root input2.root ...",
+    description="Merge the output files of combine into a single file, replacing hadd. The limit trees are concatenated, and the HypoTestResults of the same grid point in the toys directories (the results of HybridNew --saveHybridResult from different jobs, whose names differ only by their random suffix) are merged into one. All the other objects (e.g. the toys saved with --saveToys) are copied from every file, as hadd does. Optionally, the duplicated entries of the limit tree (e.g. from jobs that were run twice) are removed.",
+)
+parser.add_option("-o", "--output", dest="output", default=None, type="string", help="Output file")
+parser.add_option("-t", "--tree", dest="tree", default="limit", type="string", help="Name of the tree to merge [Default: %default]")
+parser.add_option(
+    "-l",
+    "--input-list",
+    dest="inputList",
+    default=None,
+    type="string",
+    help="Text file with the input files, one per line (in addition to those given as arguments)",
+)
+parser.add_option(
+    "--dedup", dest="dedup", default=False, action="store_true", help="Remove the duplicated entries of the tree (all branches but the timing ones equal)"
+)
+parser.add_option(
+    "--dedup-branches",
+    dest="dedupBranches",
+    default=None,
+    type="string",
+    help="Remove the entries of the tree with the same values of this comma separated list of branches as an entry already merged (implies --dedup)",
+)
+parser.add_option("-v", "--verbose", dest="verbose", default=0, type="int", help="Verbosity level")
+options, args = parser.parse_args()
+
+if not options.output:
+    parser.error("the output file must be given with -o")
+inputs = args[:]
+if options.inputList:
+    with open(options.inputList) as flist:
+        inputs += [l.strip() for l in flist if l.strip() and not l.startswith("#")]
+if not inputs:
+    parser.error("no input files")
+if options.output in inputs:
+    parser.error("the output file %s is also an input" % options.output)
+
+dedupBranches = None
+if options.dedupBranches:
+    dedupBranches = options.dedupBranches.split(",")
+elif options.dedup:
+    dedupBranches = []
+
+try:
+    merger = mergeCombineOutputs(options.output, inputs, options.tree, dedupBranches, options.verbose)
+except RuntimeError as e:
+    stderr.write("Error: %s\n" % e)
+    exit(1)
+print(merger.summary())
@@ -6,10 +6,12 @@ from optparse import OptionParser
 from sys import argv, exit, modules, stderr, stdout
 
 import ROOT
+from HiggsAnalysis.CombinedLimit.BuildProfiler import BuildProfiler
 from HiggsAnalysis.CombinedLimit.DatacardParser import *
 from HiggsAnalysis.CombinedLimit.ModelTools import *
 from HiggsAnalysis.CombinedLimit.PhysicsModel import *
 from HiggsAnalysis.CombinedLimit.ShapeTools import *
+from HiggsAnalysis.CombinedLimit.WorkspaceCache import fetchFromWorkspaceCache, storeInWorkspaceCache, workspaceCacheKey
 
 # import ROOT with a fix to get batch mode (http://root.cern.ch/phpBB3/viewtopic.php?t=3198)
 argv.append("-b-")
@@ -60,6 +62,27 @@ parser.add_option(
     action="store_true",
     help="Swap multipdf pdfs with their current index pdf",
 )
+parser.add_option(
+    "--workspace-cache",
+    dest="workspaceCache",
+    default=None,
+    type="string",
+    help="Directory with a cache of built workspaces. If the datacard, the options and the input files (by size and modification time) are unchanged since a previous build, the cached workspace is copied to the output instead of being rebuilt. The python modules of combine and the physics model module are also checked (by size and modification time); changes to the compiled combine library, or to other python modules imported by a physics model from outside combine, are not detected and need the cache to be cleared.",
+)
+parser.add_option(
+    "--profile-stages",
+    dest="profileStages",
+    default=None,
+    type="string",
+    help="Write to this JSON file the wall and cpu time, number of factory calls and imports, and peak memory of each stage of the building of the workspace (and of each channel). On a --workspace-cache hit, only the parsing of the datacard and the cache lookup are profiled",
+)
+parser.add_option(
+    "--save-binary-card",
+    dest="saveBinaryCard",
+    default=None,
+    type="string",
+    help="Save the parsed datacard in binary format to this file. It can then be given in place of the text datacard to text2workspace.py, combineCards.py and the other tools reading datacards, and loads much faster. It must be read with the same parsing options (combineCards.py can always read it, as the card without evaluating the nuisance edits is saved too).",
+)
 (options, args) = parser.parse_args()
 
 if len(args) == 0:
@@ -67,6 +90,7 @@ if len(args) == 0:
     exit(1)
 
 options.fileName = args[0]
+cardPath = options.fileName
 if options.fileName.endswith(".gz"):
     import gzip
 
@@ -75,8 +99,23 @@ if options.fileName.endswith(".gz"):
 else:
     file = open(options.fileName, "r")
 
+profiler = BuildProfiler(enabled=options.profileStages is not None)
+
+
+def writeProfile():
+    if options.profileStages:
+        profiler.write(options.profileStages)
+        if options.verbose:
+            stderr.write(profiler.summary() + "\n")
+        stderr.write("Profile of the build stages written to %s\n" % options.profileStages)
+
+
 ## Parse text file
-DC = parseCard(file, options)
+with profiler.stage("parseCard"):
+    DC = parseCard(file, options)
+
+if options.saveBinaryCard:
+    writeBinaryCard(DC, options.saveBinaryCard, options, cardPath)
 
 if options.dumpCard:
     DC.print_structure()
@@ -84,10 +123,12 @@ if options.dumpCard:
 
 ## Load tools to build workspace
 MB = None
-if DC.hasShapes:
-    MB = ShapeBuilder(DC, options)
-else:
-    MB = CountingModelBuilder(DC, options)
+with profiler.stage("createModelBuilder"):
+    if DC.hasShapes:
+        MB = ShapeBuilder(DC, options)
+    else:
+        MB = CountingModelBuilder(DC, options)
+MB.setProfiler(profiler)
 
 ## Load physics model
 (physModMod, physModName) = options.physModel.split(":")
@@ -98,7 +139,24 @@ if mod == None:
     raise RuntimeError("Physics model module %s not found" % physModMod)
 if physics == None or not isinstance(physics, PhysicsModelBase):
     raise RuntimeError("Physics model %s in module %s not found, or not inheriting from PhysicsModelBase" % (physModName, physModMod))
+
+## Look for an identical build in the cache
+cacheKey = None
+if options.workspaceCache and options.bin and not options.justCheckPhysicsModel:
+    with profiler.stage("workspaceCache"):
+        cacheKey = workspaceCacheKey(cardPath, DC, MB, options, extraFiles=[mod.__file__])
+        cacheHit = fetchFromWorkspaceCache(options.workspaceCache, cacheKey, options.out, options.verbose)
+    if cacheHit:
+        writeProfile()
+        exit(0)
+
 physics.setPhysicsOptions(options.physOpt)
 ## Attach to the tools, and run
 MB.setPhysics(physics)
-MB.doModel(justCheckPhysicsModel=options.justCheckPhysicsModel)
+with profiler.stage("doModel"):
+    MB.doModel(justCheckPhysicsModel=options.justCheckPhysicsModel)
+
+if cacheKey:
+    storeInWorkspaceCache(options.workspaceCache, cacheKey, options.out, options.verbose)
+
+writeProfile()
@@ -0,0 +1,65 @@
+#include "../interface/RooMultiPolynomial.h"
+#include <stdexcept>
+
+RooMultiPolynomial::RooMultiPolynomial(const char *name, const char *title, const RooArgList &vars, const std::vector<double> &coefficients,
+                                       const std::vector<int> &termSizes, const std::vector<int> &termVars, double constant) :
+    RooAbsReal(name,title),
+    vars_("!vars","Variables of the polynomial",this),
+    constant_(constant),
+    coefficients_(coefficients),
+    termSizes_(termSizes),
+    termVars_(termVars)
+{
+    for (RooAbsArg *a : vars) {
+        RooAbsReal *rar = dynamic_cast<RooAbsReal *>(a);
+        if (!rar) {
+            throw std::invalid_argument(std::string("Variable ")+a->GetName()+" of RooMultiPolynomial is a "+a->ClassName());
+        }
+        vars_.add(*rar);
+    }
+    if (termSizes_.size() != coefficients_.size()) {
+        throw std::invalid_argument(std::string("RooMultiPolynomial ")+name+": the number of coefficients and of term sizes differ");
+    }
+    unsigned int nfactors = 0;
+    for (int size : termSizes_) nfactors += size;
+    if (nfactors != termVars_.size()) {
+        throw std::invalid_argument(std::string("RooMultiPolynomial ")+name+": the term sizes do not add up to the number of factors");
+    }
+    for (int index : termVars_) {
+        if (index < 0 || index >= vars_.getSize()) {
+            throw std::invalid_argument(std::string("RooMultiPolynomial ")+name+": variable index out of range");
+        }
+    }
+}
+
+RooMultiPolynomial::RooMultiPolynomial(const RooMultiPolynomial& other, const char* name) :
+    RooAbsReal(other, name),
+    vars_("!vars",this,other.vars_),
+    constant_(other.constant_),
+    coefficients_(other.coefficients_),
+    termSizes_(other.termSizes_),
+    termVars_(other.termVars_)
+{
+}
+
+Double_t RooMultiPolynomial::evaluate() const
+{
+    // the variables are looked up in vars_ at each evaluation, so that the servers redirected by a customizer
+    // or by an import with RecycleConflictNodes are picked up
+    values_.resize(vars_.getSize());
+    for (unsigned int i = 0, n = values_.size(); i < n; ++i) {
+        values_[i] = static_cast<const RooAbsReal &>(vars_[i]).getVal();
+    }
+    double ret = constant_;
+    const int *index = termVars_.empty() ? 0 : &termVars_[0];
+    for (unsigned int i = 0, n = coefficients_.size(); i < n; ++i) {
+        double term = coefficients_[i];
+        for (int j = 0; j < termSizes_[i]; ++j, ++index) {
+            term *= values_[*index];
+        }
+        ret += term;
+    }
+    return ret;
+}
+
+ClassImp(RooMultiPolynomial)
@@ -0,0 +1,21 @@
+#include "../interface/th1ToUnitBins.h"
+
+#include <algorithm>
+
+TH1F *th1ToUnitBins(const char *name, const TH1 &hist, Int_t nbins)
+{
+  Int_t nsrc = hist.GetNbinsX();
+  if (nbins <= 0) nbins = nsrc;
+  TH1F *ret = new TH1F(name, "", nbins, 0.0, double(nbins));
+  ret->Sumw2();
+  Float_t *values = ret->GetArray();
+  Double_t *errors2 = ret->GetSumw2()->GetArray();
+  Int_t n = std::min(nsrc, nbins);
+  for (Int_t i = 1; i <= n; ++i) {
+    values[i] = hist.GetBinContent(i);
+    Double_t err = hist.GetBinError(i);
+    errors2[i] = err * err;
+  }
+  ret->SetEntries(n);
+  return ret;
+}
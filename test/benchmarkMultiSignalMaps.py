@@ -0,0 +1,60 @@
+from __future__ import absolute_import, print_function
+
+import re
+import sys
+import time
+from optparse import OptionParser
+
+from HiggsAnalysis.CombinedLimit.PhysicsModel import MultiSignalModel
+
+parser = OptionParser(
+    usage="usage: %prog [options]  \n"
+    "Compare the time taken by the MultiSignalModel to find the scaling of each bin and process of a large STXS-like card\n"
+    "(called twice per bin and process by text2workspace, in doExpectedEvents and doIndividualModels) with a loop on all\n"
+    "the map patterns for each call and with the precompiled and memoized patterns."
+)
+parser.add_option("--bins", dest="bins", default=500, type="int", help="Number of bins (categories) of the card")
+parser.add_option("--maps", dest="maps", default=300, type="int", help="Number of STXS bins, each with its own map pattern")
+(options, args) = parser.parse_args()
+
+decays = ["hgg", "hzz", "hww", "htt"]
+stxs = ["ggH_PTH_%d_%d" % (10 * i, 10 * (i + 1)) for i in range(options.maps // 3)]
+stxs += ["qqH_MJJ_%d_%d" % (100 * i, 100 * (i + 1)) for i in range(options.maps // 3)]
+stxs += ["ttH_PTH_%d_%d" % (10 * i, 10 * (i + 1)) for i in range(options.maps - 2 * (options.maps // 3))]
+bins = ["%s_cat%d_13TeV" % (decays[i % len(decays)], i) for i in range(options.bins)]
+# each category is populated by a handful of STXS bins, and by a few backgrounds
+pairs = []
+for i, b in enumerate(bins):
+    pairs += [(b, "%s_%s" % (stxs[(i + j) % len(stxs)], b.split("_")[0])) for j in range(10)]
+    pairs += [(b, bkg) for bkg in ("bkg_mass", "qcd", "dy")]
+physOptions = ["map=.*/%s_.*:r_%s[1,0,10]" % (s, s) for s in stxs] + ["map=hzz.*/ggH.*:r_ggH_hzz[1,0,10]"]
+
+
+def getYieldScaleLoop(poiMap, bin, process):
+    string = "%s/%s" % (bin, process)
+    poi = None
+    for p, list in poiMap:
+        for l in list:
+            if re.match(l, string):
+                poi = p
+    if poi is None:
+        poi = "1"
+    if poi in ["1", "0"]:
+        return int(poi)
+    return poi
+
+
+model = MultiSignalModel()
+model.setPhysicsOptions(physOptions + ["quiet"])
+print("Card with %d bins, %d bin/process pairs and %d map patterns" % (len(bins), len(pairs), len(physOptions)))
+
+start = time.time()
+loop = [getYieldScaleLoop(model.poiMap, b, p) for (b, p) in pairs + pairs]
+print("%-25s: %8.3f s" % ("loop on the patterns", time.time() - start))
+start = time.time()
+memoized = [model.getYieldScale(b, p) for (b, p) in pairs + pairs]
+print("%-25s: %8.3f s" % ("compiled and memoized", time.time() - start))
+if loop != memoized:
+    print("The two methods give different scalings")
+    sys.exit(1)
+print("The outputs are identical")
@@ -0,0 +1,85 @@
+from __future__ import absolute_import, print_function
+
+import time
+from optparse import OptionParser
+from sys import exit
+
+from six.moves import range
+
+# import ROOT with a fix to get batch mode (http://root.cern.ch/phpBB3/viewtopic.php?t=3198)
+import ROOT
+
+ROOT.gROOT.SetBatch(True)
+
+parser = OptionParser(
+    usage="usage: %prog [options] [shapes.root]  \n"
+    "Compare the time taken to convert TH1 templates to unit binning (as done by text2workspace for each nominal and Up/Down template)\n"
+    "with a per-bin python loop and with the bulk th1ToUnitBins helper. If a file is given, all the TH1s in it are used as templates,\n"
+    "otherwise random templates are generated."
+)
+parser.add_option("-b", "--bins", dest="bins", default=1000, type="int", help="Number of bins of the generated templates")
+parser.add_option("-n", "--templates", dest="templates", default=500, type="int", help="Number of generated templates")
+parser.add_option(
+    "--pad", dest="pad", default=0, type="int", help="Pad the templates to this number of bins, as done for the channels with fewer bins than the largest one"
+)
+options, args = parser.parse_args()
+
+ROOT.gSystem.Load("libHiggsAnalysisCombinedLimit")
+ROOT.TH1.AddDirectory(False)
+
+
+def collectTemplates(tdir, templates):
+    for key in tdir.GetListOfKeys():
+        obj = key.ReadObj()
+        if obj.InheritsFrom("TDirectory"):
+            collectTemplates(obj, templates)
+        elif obj.InheritsFrom("TH1") and obj.GetDimension() == 1:
+            templates.append(obj)
+
+
+def rebinLoop(shape, nbins):
+    rebinh1 = ROOT.TH1F(shape.GetName() + "_rebin", "", nbins, 0.0, float(nbins))
+    for i in range(1, min(shape.GetNbinsX(), nbins) + 1):
+        rebinh1.SetBinContent(i, shape.GetBinContent(i))
+        rebinh1.SetBinError(i, shape.GetBinError(i))
+    return rebinh1
+
+
+def rebinBulk(shape, nbins):
+    rebinh1 = ROOT.th1ToUnitBins(shape.GetName() + "_rebin", shape, nbins)
+    ROOT.SetOwnership(rebinh1, True)
+    return rebinh1
+
+
+templates = []
+if args:
+    fin = ROOT.TFile.Open(args[0])
+    if not fin:
+        print("Could not open %s" % args[0])
+        exit(1)
+    collectTemplates(fin, templates)
+else:
+    ROOT.gRandom.SetSeed(42)
+    for t in range(options.templates):
+        h = ROOT.TH1D("template_%d" % t, "", options.bins, 0.0, 1.0)
+        h.FillRandom("gaus", 10 * options.bins)
+        templates.append(h)
+if not templates:
+    print("No TH1 templates found")
+    exit(1)
+
+nbinsTot = sum(h.GetNbinsX() for h in templates)
+print("Converting %d templates with %d bins in total" % (len(templates), nbinsTot))
+
+results = {}
+for label, func in ("python loop", rebinLoop), ("th1ToUnitBins", rebinBulk):
+    start = time.time()
+    results[label] = [func(h, options.pad if options.pad > 0 else h.GetNbinsX()) for h in templates]
+    print("%-15s: %8.3f s" % (label, time.time() - start))
+
+for h1, h2 in zip(results["python loop"], results["th1ToUnitBins"]):
+    for i in range(0, h1.GetNbinsX() + 2):
+        if h1.GetBinContent(i) != h2.GetBinContent(i) or h1.GetBinError(i) != h2.GetBinError(i):
+            print("Mismatch in bin %d of %s" % (i, h1.GetName()))
+            exit(1)
+print("The outputs are identical")
@@ -0,0 +1,86 @@
+from __future__ import absolute_import, print_function
+
+import os
+import random
+import time
+from optparse import OptionParser, Values
+from sys import exit
+
+# import ROOT with a fix to get batch mode (http://root.cern.ch/phpBB3/viewtopic.php?t=3198)
+import ROOT
+
+ROOT.gROOT.SetBatch(True)
+
+from HiggsAnalysis.CombinedLimit.ModelTools import ModelBuilderBase
+from HiggsAnalysis.CombinedLimit.STXStoEFTModel import AllStagesToEFTModel
+
+parser = OptionParser(
+    usage="usage: %prog [options]  \n"
+    "Compare the STXS to EFT scaling functions built as one RooProduct per term summed in RooAdditions of 15 terms,\n"
+    "and as one RooMultiPolynomial per STXS bin and decay: number of nodes in the workspace, time to build them and\n"
+    "time to evaluate all of them for random values of the parameters."
+)
+parser.add_option(
+    "--datadir",
+    dest="datadir",
+    default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data", "lhc-hxswg"),
+    help="Directory with the eft/HEL inputs",
+)
+parser.add_option("--stage", dest="stage", default="stage1_1", help="STXS stage of the scaling functions")
+parser.add_option("-n", "--evaluations", dest="evaluations", default=1000, type="int", help="Number of random points at which the functions are evaluated")
+(options, args) = parser.parse_args()
+
+ROOT.gSystem.Load("libHiggsAnalysisCombinedLimit")
+ROOT.RooMsgService.instance().setGlobalKillBelow(ROOT.RooFit.ERROR)
+
+
+def build(compiled):
+    builderOptions = Values({"bin": True, "out": "benchmark.root", "fileName": "benchmark.txt", "verbose": 0, "cexpr": False})
+    builder = ModelBuilderBase(builderOptions)
+    model = AllStagesToEFTModel()
+    model.modelBuilder = builder
+    model.freezeOtherParameters = False
+    model.compiledScalingFunctions = compiled
+    model.textToPOIList(os.path.join(options.datadir, "eft/HEL/pois.txt"))
+    for poi, poiRange in model.pois.items():
+        builder.doVar("%s%s" % (poi, poiRange))
+    builder.factory_('expr::cWW_x02("0.5*(@0+@1)",cWWPluscB_x02,cWWMinuscB_x02)')
+    builder.factory_('expr::cB_x02("0.5*(@0-@1)",cWWPluscB_x02,cWWMinuscB_x02)')
+    model.poi_scaling["cWW"] = "0.01*cWW_x02"
+    model.poi_scaling["cB"] = "0.01*cB_x02"
+    model.textToSTXSScalingFunctions(os.path.join(options.datadir, "eft/HEL/%s_xs.txt" % options.stage))
+    model.textToDecayScalingFunctions(os.path.join(options.datadir, "eft/HEL/decay.txt"))
+    start = time.time()
+    for what in list(model.STXSScalingFunctions.keys()) + list(model.DecayScalingFunctions.keys()):
+        model.makeScalingFunction(what)
+    buildTime = time.time() - start
+    names = ["scaling_%s" % what for what in model.STXSScalingFunctions]
+    names += ["scaling_partial_%s" % what if what != "tot" else "scaling_tot" for what in model.DecayScalingFunctions]
+    return builder.out, model, names, buildTime
+
+
+results = {}
+for label, compiled in ("RooProduct terms", False), ("RooMultiPolynomial", True):
+    w, model, names, buildTime = build(compiled)
+    functions = [w.function(n) for n in names]
+    pois = [w.var(p) for p in model.pois]
+    random.seed(42)
+    values = []
+    start = time.time()
+    for i in range(options.evaluations):
+        for p in pois:
+            p.setVal(random.uniform(p.getMin(), p.getMax()))
+        values.append([f.getVal() for f in functions])
+    evalTime = time.time() - start
+    results[label] = values
+    print(
+        "%-20s: %6d functions in the workspace, built in %7.3f s, %d evaluations of %d scaling functions in %7.3f s"
+        % (label, w.allFunctions().getSize(), buildTime, options.evaluations, len(functions), evalTime)
+    )
+
+for v1, v2 in zip(results["RooProduct terms"], results["RooMultiPolynomial"]):
+    for x1, x2 in zip(v1, v2):
+        if abs(x1 - x2) > 1e-9 * max(1.0, abs(x1)):
+            print("Mismatch: %g != %g" % (x1, x2))
+            exit(1)
+print("The scaling functions agree")
@@ -0,0 +1,62 @@
+from __future__ import absolute_import, print_function
+
+import glob
+import os
+import time
+from optparse import OptionParser
+from sys import exit
+
+from HiggsAnalysis.CombinedLimit.DatacardParser import addDatacardParserOptions, parseCard
+
+parser = OptionParser(
+    usage="usage: %prog [options] [datacard.txt ...]  \n"
+    "Compare the time taken to find the nuisances affecting each bin and process of datacards (as done by text2workspace\n"
+    "in doExpectedEvents and getPdf) by looping on all the systematics and with the per-(bin, process) index of\n"
+    "Datacard.systematicsTable(). By default the datacards in data/benchmarks are used."
+)
+addDatacardParserOptions(parser)
+parser.add_option("-n", "--repeat", dest="repeat", default=1, type="int", help="Repeat each lookup this many times")
+(options, args) = parser.parse_args()
+options.bin = True
+
+if not args:
+    benchmarks = os.path.join(os.environ.get("CMSSW_BASE", "."), "src/HiggsAnalysis/CombinedLimit/data/benchmarks")
+    if not os.path.isdir(benchmarks):
+        benchmarks = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data", "benchmarks"))
+    args = sorted(glob.glob(os.path.join(benchmarks, "*", "*", "*.txt")) + glob.glob(os.path.join(benchmarks, "*.txt")))
+
+
+def affectingLoop(DC, b, p):
+    return [(n, nofloat, pdf, args, errline[b][p]) for (n, nofloat, pdf, args, errline) in DC.systs if errline and errline[b].get(p, 0) != 0]
+
+
+def affectingIndex(DC, b, p):
+    return DC.systematicsTable().affecting(b, p)
+
+
+totals = {"loop": 0.0, "index": 0.0}
+print("%-60s %6s %6s %10s %10s" % ("datacard", "systs", "procs", "loop [s]", "index [s]"))
+for fname in args:
+    options.fileName = fname
+    try:
+        with open(fname) as fin:
+            DC = parseCard(fin, options)
+    except Exception as ex:
+        print("%-60s skipped (%s)" % (fname[-60:], ex))
+        continue
+    times = {}
+    results = {}
+    for label, func in ("loop", affectingLoop), ("index", affectingIndex):
+        start = time.time()
+        if label == "index":
+            # building the index is part of the cost
+            DC.systematicsTable(rebuild=True)
+        for i in range(options.repeat):
+            results[label] = [func(DC, b, p) for (b, p, s) in DC.keyline]
+        times[label] = time.time() - start
+        totals[label] += times[label]
+    if results["loop"] != results["index"]:
+        print("Mismatch for %s" % fname)
+        exit(1)
+    print("%-60s %6d %6d %10.4f %10.4f" % (fname[-60:], len(DC.systs), len(DC.keyline), times["loop"], times["index"]))
+print("%-60s %6s %6s %10.4f %10.4f" % ("total", "", "", totals["loop"], totals["index"]))
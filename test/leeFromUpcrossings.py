@@ -8,6 +8,7 @@ from sys import argv, exit, stderr, stdout
 from six.moves import range
 
 import ROOT
+from HiggsAnalysis.CombinedLimit.ColumnarOutput import isColumnar, readColumnar
 
 # import ROOT with a fix to get batch mode (http://root.cern.ch/phpBB3/viewtopic.php?t=3198)
 argv.append("-b-")
@@ -16,7 +17,12 @@ ROOT.gROOT.SetBatch(True)
 argv.remove("-b-")
 
 
-parser = OptionParser(usage="usage: %prog [options] bands.root graph [min max]")
+parser = OptionParser(
+    usage="usage: %prog [options] bands.root graph [min max]\n"
+    "   or: %prog [options] scan.npz column [min max]\n"
+    "where scan.npz (or .parquet) is the export made with limitTreeToColumnar.py of a scan of the p-value vs mass: column\n"
+    "is then the column with the p-values (e.g. limit), and the graph is made against the column given with --xvar"
+)
 parser.add_option(
     "-l",
     "--level",
@@ -33,36 +39,62 @@ parser.add_option(
     type="string",
     help="Name of the graph of the best fit signal strength, to count upcrossings at zero",
 )
+parser.add_option(
+    "-x",
+    "--xvar",
+    dest="xvar",
+    default="mh",
+    type="string",
+    help="Column of the mass, for the columnar inputs",
+)
 (options, args) = parser.parse_args()
 if len(args) not in [2, 4]:
     parser.print_usage()
     exit(1)
 
-file = ROOT.TFile(args[0])
-if file == None:
-    raise RuntimeError("Cannot open %s" % args[0])
 
-graph = file.Get(args[1])
-if graph == None:
-    raise RuntimeError("Cannot find %s in %s" % (args[1], args[0]))
+def graphPoints(graph):
+    return [(graph.GetX()[i], graph.GetY()[i]) for i in range(graph.GetN())]
+
 
-graphUp = graph
-if options.level == 0:
-    if options.fit == None:
-        raise RuntimeError("Must specify a the graph of fitted signal strength to count upcrossings at zero")
-    graphUp = file.Get(options.fit)
-    if graphUp == None:
-        raise RuntimeError("Cannot find %s in %s" % (options.fit, args[0]))
+if isColumnar(args[0]):
+    columns = [options.xvar, args[1]]
+    if options.level == 0:
+        if options.fit == None:
+            raise RuntimeError("Must specify a the column of fitted signal strength to count upcrossings at zero")
+        columns.append(options.fit)
+    scan = readColumnar(args[0], columns)
+    order = scan[options.xvar].argsort(kind="stable")
+    points = list(zip(scan[options.xvar][order].tolist(), scan[args[1]][order].tolist()))
+    pointsUp = points
+    if options.level == 0:
+        pointsUp = list(zip(scan[options.xvar][order].tolist(), scan[options.fit][order].tolist()))
+else:
+    file = ROOT.TFile(args[0])
+    if file == None:
+        raise RuntimeError("Cannot open %s" % args[0])
+
+    graph = file.Get(args[1])
+    if graph == None:
+        raise RuntimeError("Cannot find %s in %s" % (args[1], args[0]))
+
+    graphUp = graph
+    if options.level == 0:
+        if options.fit == None:
+            raise RuntimeError("Must specify a the graph of fitted signal strength to count upcrossings at zero")
+        graphUp = file.Get(options.fit)
+        if graphUp == None:
+            raise RuntimeError("Cannot find %s in %s" % (options.fit, args[0]))
+    points = graphPoints(graph)
+    pointsUp = graphPoints(graphUp)
 
 (mhmin, mhmax) = (0, 999)
 if len(args) == 4:
     mhmin = float(args[2])
     mhmax = float(args[3])
 
-n = graph.GetN()
-n2 = graphUp.GetN()
-pvals = [graph.GetY()[i] for i in range(n) if (graph.GetX()[i] >= mhmin and graph.GetX()[i] <= mhmax)]
-valsUp = [graphUp.GetY()[i] for i in range(n) if (graphUp.GetX()[i] >= mhmin and graphUp.GetX()[i] <= mhmax)]
+pvals = [y for (x, y) in points if (x >= mhmin and x <= mhmax)]
+valsUp = [y for (x, y) in pointsUp if (x >= mhmin and x <= mhmax)]
 # print "Selected ",len(pvals)," p-values."
 
 pmin = min(pvals)
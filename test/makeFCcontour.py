@@ -12,12 +12,17 @@
 
 from __future__ import absolute_import, print_function
 
+import math
+import multiprocessing
 import os
 import sys
 from array import array
 from optparse import OptionParser
 
+import numpy
+
 import ROOT
+from HiggsAnalysis.CombinedLimit.ColumnarOutput import loadArrays
 
 ROOT.gROOT.SetBatch(1)
 
@@ -132,7 +137,7 @@ parser.add_option(
     dest="datafile",
     default="",
     type=str,
-    help="Input data (ie NLL scan) to use instead of from jobs",
+    help="Input data (ie NLL scan, ROOT file or npz/parquet export) to use instead of from jobs",
 )
 parser.add_option(
     "",
@@ -150,6 +155,14 @@ parser.add_option(
     action="store_true",
     help="Keep histograms of the llr for toys (and the datavalue) in the output file (warning, increases run time)",
 )
+parser.add_option(
+    "-j",
+    "--jobs",
+    dest="jobs",
+    default=1,
+    type=int,
+    help="Read the files of toys in this many parallel processes",
+)
 # parser.add_option("-f","--filesdir",dest="filesdir",default='',type=str,help="Directory to recursively search for toys, use dir:reg to search fo regular expression inside dir")
 parser.add_option(
     "-f",
@@ -243,6 +256,20 @@ class physicsPoint:
         else:
             self.toys.append(val)
 
+    def commit_toys(self, vals):
+        # same as commit_toy for each of the values in the numpy array vals
+        keep = ~(numpy.abs(vals) > 10000)
+        if self.onesided:
+            keep &= ~(vals < 0)
+        vals = vals[keep]
+        if self.hasdata:
+            self.nToysPass += int(numpy.count_nonzero(vals >= self.data))
+            self.nToys += len(vals)
+            if self.savetoys:
+                self.toys.extend(vals.tolist())
+        else:
+            self.toys.extend(vals.tolist())
+
     def set_data(self, dat):
         if self.hasdata and self.data > -999.0:
             return
@@ -254,9 +281,7 @@ class physicsPoint:
         self.data = dat
         self.hasdata = True
 
-        for v in self.toys:
-            if v >= self.data:
-                self.nToysPass += 1
+        self.nToysPass += int(numpy.count_nonzero(numpy.asarray(self.toys, dtype=float) >= self.data))
         # Clean up unless we want to keep toys
         if not self.savetoys:
             self.nToys += len(self.toys)
@@ -314,6 +339,36 @@ class physicsPoint:
         return htoys.Clone(), hdata.Clone()
 
 
+class pointIndex:
+    # finds the first point of a list for which is_point(x,y) is true, looking only at the
+    # points in the neighbouring cells of a grid instead of scanning the whole list
+    def __init__(self, points=None):
+        # cells slightly larger than the matching distance, so that matching points are always in neighbouring cells
+        self.cellSize = max(errLevel, options.overlap) * (1 + 1e-6)
+        self.cells = {}
+        # the list of points is extended in place by add
+        self.points = [] if points is None else points
+        for k, p in enumerate(self.points):
+            self.cells.setdefault(self.cell(p.x, p.y), []).append(k)
+
+    def cell(self, x, y):
+        return (int(math.floor(x / self.cellSize)), int(math.floor(y / self.cellSize)))
+
+    def find(self, x, y):
+        cx, cy = self.cell(x, y)
+        best = None
+        for i in (cx - 1, cx, cx + 1):
+            for j in (cy - 1, cy, cy + 1):
+                for k in self.cells.get((i, j), []):
+                    if (best is None or k < best) and self.points[k].is_point(x, y):
+                        best = k
+        return None if best is None else self.points[best]
+
+    def add(self, point):
+        self.cells.setdefault(self.cell(point.x, point.y), []).append(len(self.points))
+        self.points.append(point)
+
+
 def findStringValue(fullstr, substr):
     si = fullstr.find(substr)
     if si == -1:
@@ -325,6 +380,7 @@ def findStringValue(fullstr, substr):
 
 def getPoints(tree, varx, vary):
     gPoints = []
+    gIndex = pointIndex(gPoints)
 
     # grab all the distributions:
     hypoResults = tree.GetListOfKeys()
@@ -348,22 +404,15 @@ def getPoints(tree, varx, vary):
             if (cutGridy) and (dumy > options.yrange[1] + errLevel or dumy < options.yrange[0] - errLevel):
                 continue
 
-        pointExists = False
-
         dataval = result.GetTestStatisticData()
-        toys = result.GetAltDistribution().GetSamplingDistribution()
-
-        for gp in gPoints:
-            if gp.is_point(dumx, dumy):
-                pointExists = True
-                if not gp.has_data():
-                    gp.set_data(dataval)
-
-                for tv in toys:
-                    gp.commit_toy(tv)
-                break
+        toys = numpy.array(result.GetAltDistribution().GetSamplingDistribution(), dtype=float)
 
-        if not pointExists:
+        gp = gIndex.find(dumx, dumy)
+        if gp is not None:
+            if not gp.has_data():
+                gp.set_data(dataval)
+            gp.commit_toys(toys)
+        else:
             newPoint = physicsPoint([dumx, dumy])
             if options.storeToys:
                 newPoint.save_toys()
@@ -374,13 +423,29 @@ def getPoints(tree, varx, vary):
             if options.datafile:
                 newPoint.set_data_nll(gDataNLL)
             newPoint.set_data(dataval)
-            for tv in toys:
-                newPoint.commit_toy(tv)
-            gPoints.append(newPoint)
+            newPoint.commit_toys(toys)
+            gIndex.add(newPoint)
 
     return gPoints
 
 
+def readPoints(fileName):
+    # returns the file name, the points found in it (None if it could not be read) and an error message
+    tFile = ROOT.TFile.Open(fileName)
+    if tFile == None:
+        return fileName, None, "File Corrupted, skipping"
+    tToys = tFile.Get(treeName)
+    if tToys == None:
+        return fileName, None, "File doesn't contain %s" % treeName
+
+    if options.oned:
+        cpoints = getPoints(tToys, xvar, "")
+    else:
+        cpoints = getPoints(tToys, xvar, yvar)
+    tFile.Close()
+    return fileName, cpoints, ""
+
+
 def findRange(mySet, index):
     if index == 0:
         myList = [m.x for m in mySet]
@@ -406,25 +471,19 @@ exampleDone = False
 points = []
 
 
-def mergePoints(original, appended):
-    # take 2 lists of physics points and merge the second into the first
+def mergePoints(original, appended, index):
+    # take 2 lists of physics points and merge the second into the first (index is the pointIndex of the first)
     for p in appended:
-        pointexists = False
-        for po in original:
-            if po.is_point(p.x, p.y):
-                pointexists = True
-
-                if p.has_data() and not options.storeToys:
-                    po.nToys += p.nToys
-                    po.nToysPass += p.nToysPass
-                    po.set_data(p.data)  # if po already has data, this wont do anything
-                else:
-                    for toy in p.toys:
-                        po.commit_toy(toy)  # this will just do the right thing
-                break
-
-        if not pointexists:
-            original.append(p)
+        po = index.find(p.x, p.y)
+        if po is not None:
+            if p.has_data() and not options.storeToys:
+                po.nToys += p.nToys
+                po.nToysPass += p.nToysPass
+                po.set_data(p.data)  # if po already has data, this wont do anything
+            else:
+                po.commit_toys(numpy.asarray(p.toys, dtype=float))  # this will just do the right thing
+        else:
+            index.add(p)
 
 
 def findInterval(pts, cl):
@@ -501,11 +560,11 @@ yvar = options.yvar
 
 # Optional use of NLL from pre-performed scan
 if options.datafile and options.oned:
-    tFileNLL = ROOT.TFile(options.datafile)
-    # Draw the graph
-    nlltree = tFileNLL.Get("limit")
-    nlltree.Draw("deltaNLL:%s" % xvar)
-    gDataNLL = ROOT.gPad.FindObject("Graph").Clone()
+    # the scan can be a ROOT file or its columnar export (see limitTreeToColumnar.py)
+    scan = loadArrays([options.datafile], [xvar, "deltaNLL"])
+    scanx = numpy.ascontiguousarray(scan[xvar], dtype=numpy.float64)
+    scany = numpy.ascontiguousarray(scan["deltaNLL"], dtype=numpy.float64)
+    gDataNLL = ROOT.TGraph(len(scanx), scanx, scany)
 
 if options.oned:
     print("Calculating 1D FC interval for ", xvar)
@@ -519,26 +578,25 @@ print("Grabbing all points from files (Getting Points can be very slow if all co
 
 n_tot_files = len(allFiles)
 failedFiles = []
-for f_it, fileName in enumerate(allFiles):
+pointsIndex = pointIndex(points)
+if options.jobs > 1:
+    # the worker processes are forked, so that they see the options and the points classes
+    context = multiprocessing.get_context("fork") if hasattr(multiprocessing, "get_context") else multiprocessing
+    pool = context.Pool(options.jobs)
+    results = pool.imap(readPoints, allFiles)
+else:
+    results = (readPoints(fileName) for fileName in allFiles)
+# the points are merged in the order of the files, whatever the number of jobs
+for f_it, (fileName, cpoints, error) in enumerate(results):
     print("Opening File (%d/%d) -- " % (f_it, n_tot_files), fileName)
-
-    tFile = ROOT.TFile.Open(fileName)
-    if tFile == None:
-        print("File Corrupted, skipping")
-        failedFiles.append(fileName)
-        continue
-    tToys = tFile.Get(treeName)
-    if tToys == None:
-        print("File doesn't contain ", treeName)
+    if cpoints is None:
+        print(error)
         failedFiles.append(fileName)
         continue
-
-    if options.oned:
-        cpoints = getPoints(tToys, xvar, "")
-    else:
-        cpoints = getPoints(tToys, xvar, yvar)
-    mergePoints(points, cpoints)
-    tFile.Close()
+    mergePoints(points, cpoints, pointsIndex)
+if options.jobs > 1:
+    pool.close()
+    pool.join()
 
 outFile = ROOT.TFile(options.out, "RECREATE")
 
@@ -265,7 +265,7 @@ for i, x in enumerate(points):
         )
 
 script.write("\n")
-script.write("hadd %s.root higgsCombine*.root\n" % options.out)
+script.write("mergeCombineOutputs.py -o {out}.root higgsCombine*.root || hadd -f {out}.root higgsCombine*.root\n".format(out=options.out))
 if options.diagnosticRun:
     script.write("hadd mlfit%s.root mlfit*.root\n" % options.out)
 script.write('echo "## Done at $(date)"\n')
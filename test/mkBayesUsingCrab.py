@@ -157,7 +157,7 @@ for i, (w, m) in enumerate(zip(workspaces, masses)):
         )
     )
 script.write("done\n\n")
-script.write("hadd %s.root higgsCombine*.root\n" % options.out)
+script.write("mergeCombineOutputs.py -o {out}.root higgsCombine*.root || hadd -f {out}.root higgsCombine*.root\n".format(out=options.out))
 script.write('echo "## Done at $(date)"\n')
 script.close()
 os.system("chmod +x %s.sh" % options.out)
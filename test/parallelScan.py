@@ -4,22 +4,28 @@
 ##  run combine -M MultiDimFit scans in multiple local jobs in parallel
 ##  usage: just replace "combine" with "parallelScan.py" in the command line
 ##         and add a "-j" to select how many threads to use
+##  the points are split in small blocks (of --block points), which are given to the jobs as they become free,
+##  and failed blocks are retried up to --retries times. With --hadd the output of the blocks is merged as they
+##  finish, in the order of the points, into a single file.
 from __future__ import absolute_import, print_function
 
 from __future__ import division
+import glob
 import os
 import subprocess
 import sys
+import time
 from math import ceil
 from re import match
 
 from six.moves import range
 
 if len(sys.argv) < 3:
-    print("usage: parallelScan.py <arguments to combine>  [ -j processes ]")
+    print("usage: parallelScan.py <arguments to combine>  [ -j processes ] [ --block points ] [ --retries n ] [ --hadd ]")
     exit()
 
 jobs, points, name, method, mass, hadd = 0, 0, "Test", None, 120, False
+block, retries = 0, 1
 ## take out the -n and -j; find the --points
 args = []
 i = 1
@@ -54,6 +60,12 @@ while i < len(sys.argv):
     elif sys.argv[i] == "--hadd":
         hadd = True
         i += 1
+    elif sys.argv[i] == "--block":
+        block = int(sys.argv[i + 1])
+        i += 2
+    elif sys.argv[i] == "--retries":
+        retries = int(sys.argv[i + 1])
+        i += 2
     else:
         args.append(sys.argv[i])
         i += 1
@@ -76,35 +88,71 @@ if hadd:
         print("Cannot understand what method of combine you are using, so cannot do hadd")
         exit()
 
-workers = []
-for j in range(jobs):
-    start = int(ceil(points * j / float(jobs)))
-    end = int(ceil(points * (j + 1) / float(jobs)) - 1)
-    myargs = (
-        ["combine"]
-        + args[:]
-        + [
-            "-n",
-            "%s.%d" % (name, j),
-            "--firstPoint",
-            str(start),
-            "--lastPoint",
-            str(end),
-        ]
-    )
-    print("spawning %s" % (" ".join(myargs)))
-    workers.append(subprocess.Popen(myargs))
+if block <= 0:
+    # a few blocks per job, so that the jobs that get the fast points take more of them
+    block = int(ceil(points / (4.0 * jobs)))
+blocks = [(start, min(start + block, points) - 1) for start in range(0, points, block)]
+
 
-for w in workers:
-    w.wait()
+def blockOutputs(b):
+    # combine can add to the name the seed, the quantile or the values of --keyword-value, so the file is looked up
+    return sorted(glob.glob("higgsCombine%s.%d.%s.*.root" % (name, b, method)))
 
+
+merger = None
 if hadd:
-    if not method:
-        print("Cannot understand what method of combine you are using, so cannot do hadd")
-    else:
-        output = "higgsCombine%s.%s.mH%g.root" % (name, method, mass)
-        input = "  ".join(["higgsCombine%s.%d.%s.mH%g.root" % (name, j, method, mass) for j in range(jobs)])
-        print("All workers done, doing the hadd to make %s out of higgsCombine%s.{0..%d}.%s.mH%g.root" % (output, name, jobs - 1, method, mass))
-        os.system("hadd -f %s %s" % (output, input))
+    from HiggsAnalysis.CombinedLimit.OutputMerger import CombineOutputMerger
+
+    output = "higgsCombine%s.%s.mH%g.root" % (name, method, mass)
+    merger = CombineOutputMerger(output)
+
+queue = list(range(len(blocks)))
+attempts = [0] * len(blocks)
+done = [False] * len(blocks)
+failed = []
+nextToMerge = 0
+## block files merged so far: they are only removed once the merged output is written
+merged = []
+workers = {}
+while queue or workers:
+    # hand out the next blocks to the free jobs
+    while queue and len(workers) < jobs:
+        b = queue.pop(0)
+        attempts[b] += 1
+        start, end = blocks[b]
+        myargs = ["combine"] + args[:] + ["-n", "%s.%d" % (name, b), "--firstPoint", str(start), "--lastPoint", str(end)]
+        print("spawning %s" % (" ".join(myargs)))
+        workers[b] = subprocess.Popen(myargs)
+    time.sleep(0.2)
+    for b, w in list(workers.items()):
+        if w.poll() is None:
+            continue
+        del workers[b]
+        if w.returncode == 0:
+            done[b] = True
+        elif attempts[b] <= retries:
+            print("Points %d-%d failed (exit code %d), retrying them" % (blocks[b] + (w.returncode,)))
+            queue.insert(0, b)
+        else:
+            print("Points %d-%d failed (exit code %d) after %d attempts" % (blocks[b] + (w.returncode, attempts[b])))
+            failed.append(b)
+    # merge the finished blocks, in the order of the points
+    while merger and nextToMerge < len(blocks) and (done[nextToMerge] or nextToMerge in failed):
+        if done[nextToMerge]:
+            outputs = blockOutputs(nextToMerge)
+            if not outputs:
+                print("No output file found for points %d-%d" % blocks[nextToMerge])
+            for fname in outputs:
+                merger.add(fname)
+                merged.append(fname)
+        nextToMerge += 1
+
+if failed:
+    print("The following points failed: %s" % ", ".join(["%d-%d" % blocks[b] for b in sorted(failed)]))
+if merger:
+    merger.close()
+    for fname in merged:
+        os.remove(fname)
+    print("All workers done. %s" % merger.summary())
 else:
     print("All workers done, now you have to hadd the results yourself.")
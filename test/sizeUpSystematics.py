@@ -10,12 +10,12 @@ import json
 import os
 import os.path
 import re
+import resource
+import subprocess
+import time
 from datetime import datetime, timedelta
-from functools import reduce
 from itertools import combinations
-
-# make a pool of workers
-from multiprocessing import Pool
+from multiprocessing import cpu_count
 from optparse import OptionParser
 from pprint import pprint
 from sys import argv, exit, stderr, stdout
@@ -23,8 +23,8 @@ from sys import argv, exit, stderr, stdout
 import six.moves.cPickle as pickle
 from six.moves import range
 
-import rankSystematics
 import ROOT
+from HiggsAnalysis.CombinedLimit.BuildProfiler import peakRSS
 from HiggsAnalysis.CombinedLimit.DatacardParser import *
 
 
@@ -58,6 +58,77 @@ def mkdir_p(path):
             raise
 
 
+def availableMemory():
+    """Return the memory available for new processes in MB, or None if it cannot be known"""
+    try:
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) / 1024.0
+    except IOError:
+        pass
+    return None
+
+
+class JobEngine:
+    """
+    Runs shell commands in parallel, starting a new one only when there is a free cpu and enough memory for it.
+    The memory needed by a job is estimated as the largest peak memory of the jobs finished so far (and at least
+    jobMemory MB), and the jobs running together must fit in maxMemory MB and in the memory currently available.
+    """
+
+    def __init__(self, jobs, maxMemory, jobMemory):
+        self.jobs = jobs
+        self.maxMemory = maxMemory
+        self.jobMemory = jobMemory
+        self.running = dict()
+
+    def memoryPerJob(self):
+        return max(self.jobMemory, peakRSS(resource.RUSAGE_CHILDREN))
+
+    def canStart(self):
+        if not self.running:
+            return True
+        if len(self.running) >= self.jobs:
+            return False
+        need = self.memoryPerJob()
+        if (len(self.running) + 1) * need > self.maxMemory:
+            return False
+        avail = availableMemory()
+        return avail is None or avail >= need
+
+    def run(self, tasks, callback):
+        """Run the list of (key, command), calling callback(key, return code) as each of them finishes"""
+        queue = list(tasks)
+        start = time.time()
+        done = 0
+        while queue or self.running:
+            while queue and self.canStart():
+                key, cmd = queue.pop(0)
+                if not cmd:
+                    done += 1
+                    callback(key, 0)
+                    continue
+                self.running[key] = subprocess.Popen(cmd, shell=True)
+            time.sleep(0.2)
+            for key, proc in list(self.running.items()):
+                if proc.poll() is None:
+                    continue
+                del self.running[key]
+                done += 1
+                callback(key, proc.returncode)
+                self.progress(done, len(tasks), start)
+
+    def progress(self, done, total, start):
+        elapsed = time.time() - start
+        eta = elapsed / done * (total - done)
+        print(
+            "[%d/%d done, %d running, %.0f MB per job] elapsed %s, ETA %s"
+            % (done, total, len(self.running), self.memoryPerJob(), timedelta(seconds=int(elapsed)), timedelta(seconds=int(eta)))
+        )
+        stdout.flush()
+
+
 # import ROOT with a fix to get batch mode (http://root.cern.ch/phpBB3/viewtopic.php?t=3198)
 argv.append("-b-")
 
@@ -104,6 +175,35 @@ parser.add_option(
     default=False,
     help="When excluding nuisances, do not exclude standard nuisances that are correlated CMS-wide even if their effect is small.",
 )
+parser.add_option(
+    "-j",
+    "--jobs",
+    dest="jobs",
+    default=0,
+    type="int",
+    help="Number of jobs to run in parallel (default: the number of cpus).",
+)
+parser.add_option(
+    "--max-memory",
+    dest="maxMemory",
+    default=0,
+    type="float",
+    help="Memory in MB that the jobs running in parallel can use together (default: the memory available at start).",
+)
+parser.add_option(
+    "--job-memory",
+    dest="jobMemory",
+    default=1000,
+    type="float",
+    help="Memory in MB needed by a job, until the memory used by the finished jobs is known.",
+)
+parser.add_option(
+    "--remove-workspaces",
+    dest="removeWorkspaces",
+    action="store_true",
+    default=False,
+    help="Remove the workspace of each combination once its limits are harvested, to save disk space.",
+)
 addDatacardParserOptions(parser)
 (options, args) = parser.parse_args()
 
@@ -183,11 +283,14 @@ for combo in combinationsToRemove:
     fName = "Syst.%s" % combinationsHash[combo]
 
     tempOut = "%s.root" % fName
-    filterCmd = "text2workspace.py --verbose=2 %s -m %f  --X-exclude-nuisance='%s' -o root/%s &> log/%s.log" % (
+    # written under a temporary name first, so that an interrupted job does not leave a workspace that looks complete
+    filterCmd = "text2workspace.py --verbose=2 %s -m %f  --X-exclude-nuisance='%s' -o root/%s.part.root > log/%s.log 2>&1 && mv root/%s.part.root root/%s" % (
         options.fileName,
         options.masses[0],
         nuisStr,
+        fName,
         tempOut,
+        fName,
         tempOut,
     )
 
@@ -201,7 +304,7 @@ for combo in combinationsToRemove:
         combineOpts = "--minosAlgo=stepping -M %s -S 1 -m %g" % (combineMethod, mass)
         combineOut = "higgsCombine%s.%s.mH%g.root" % (fName, combineMethod, mass)
 
-        combineCmd = "combine --verbose=1 root/%s %s -n %s &> log/%s.log && mv %s root/" % (tempOut, combineOpts, fName, combineOut, combineOut)
+        combineCmd = "combine --verbose=1 root/%s %s -n %s > log/%s.log 2>&1 && mv %s root/" % (tempOut, combineOpts, fName, combineOut, combineOut)
 
         if os.path.isfile("root/" + combineOut):
             #            print "Not queuing combine job for %s. (output already present)" % combineOut
@@ -209,6 +312,10 @@ for combo in combinationsToRemove:
 
         combineCmds.append(combineCmd)
 
+    if not any(combineCmds):
+        # the workspace is not needed anymore
+        filterCmd = ""
+
     jobs[combo] = (filterCmd, combineCmds, "root/" + combineOut)
 
 # pprint(jobs)
@@ -217,67 +324,72 @@ g.write(json.dumps(list(jobs.items()), sort_keys=True, indent=2))
 g.close()
 
 
-# function to be used in parallel
-def runCmd(cmd):
-    if not cmd:
-        return 0
-    from subprocess import call
+def readLimits(fname):
+    f = ROOT.TFile(fname)
+    t = f.Get("limit")
 
-    # print cmd
-    return call(cmd, shell=True)
+    leaves = t.GetListOfLeaves()
 
+    class Event(dict):
+        pass
 
-pool = Pool()
+    ev = Event()
+    for i in range(0, leaves.GetEntries()):
+        leaf = leaves.At(i)
+        name = leaf.GetName()
+        ev.__setattr__(name, leaf)
 
-timer.addLap("Running text2Workspace")
-# run all the text2workspace in parallel
-filterCmds = [x[0] for x in list(jobs.values())]
-ret = pool.map(runCmd, filterCmds)
-if reduce(lambda x, y: x + y, ret):
-    raise RuntimeError("Non-zero return code in text2workspace. Check logs.")
+    valDict = dict()
+    for iev in range(0, t.GetEntries()):
+        t.GetEntry(iev)
+        valDict[int(1000 * ev.quantileExpected.GetValue())] = ev.limit.GetValue()
+    f.Close()
+    return valDict
 
-timer.addLap("Running combine")
-# run all the combine jobs in parallel
-combineCmds = [item for sublist in [x[1] for x in list(jobs.values())] for item in sublist]
-ret = pool.map(runCmd, combineCmds)
-if reduce(lambda x, y: x + y, ret):
-    raise RuntimeError("Non-zero return code in combine. Check logs.")
 
+# the limits of each combination are cached in a file named after its hash, so that the
+# combinations already done are not run again
+def limitsCache(combination):
+    return "root/Syst.%s.limits.json" % combinationsHash[combination]
 
-timer.addLap("Harvesting root files")
-# harvest limit values from the output files
-limitsOut = "limits.json"
-if os.path.isfile(limitsOut):
-    #    print "Not harvesting root files. (output already present)"
-    pass
 
-else:
-    limits = dict()
-    for combination in combinationsToRemove:
-        f = ROOT.TFile(jobs[combination][2])
-        t = f.Get("limit")
-
-        leaves = t.GetListOfLeaves()
+limits = dict()
+for combination in combinationsToRemove:
+    if os.path.isfile(limitsCache(combination)):
+        with open(limitsCache(combination)) as g:
+            limits[combination] = dict([(int(k), v) for (k, v) in json.load(g).items()])
+failed = list()
 
-        class Event(dict):
-            pass
 
-        ev = Event()
-        for i in range(0, leaves.GetEntries()):
-            leaf = leaves.At(i)
-            name = leaf.GetName()
-            ev.__setattr__(name, leaf)
-
-        valDict = dict()
-        for iev in range(0, t.GetEntries()):
-            t.GetEntry(iev)
-            valDict[int(1000 * ev.quantileExpected.GetValue())] = ev.limit.GetValue()
-        limits[combination] = valDict
-
-    # pprint(limits)
-    g = open(limitsOut, "w")
-    g.write(json.dumps(list(limits.items()), sort_keys=True, indent=2))
+def jobDone(combination, ret):
+    if ret:
+        failed.append(combination)
+        return
+    limits[combination] = readLimits(jobs[combination][2])
+    g = open(limitsCache(combination), "w")
+    g.write(json.dumps(limits[combination], sort_keys=True, indent=2))
     g.close()
+    if options.removeWorkspaces and os.path.isfile("root/Syst.%s.root" % combinationsHash[combination]):
+        os.remove("root/Syst.%s.root" % combinationsHash[combination])
+
+
+timer.addLap("Running text2workspace and combine")
+# one job per combination, running text2workspace and then combine for all the masses
+tasks = [(combo, " && ".join([x for x in [jobs[combo][0]] + jobs[combo][1] if x])) for combo in combinationsToRemove if combo not in limits]
+print("%d combinations already done, %d to run" % (len(combinationsToRemove) - len(tasks), len(tasks)))
+maxMemory = options.maxMemory or availableMemory() or float("inf")
+engine = JobEngine(options.jobs or cpu_count(), maxMemory, options.jobMemory)
+engine.run(tasks, jobDone)
+if failed:
+    raise RuntimeError("Non-zero return code in %d jobs (%s). Check logs." % (len(failed), ", ".join([combinationsHash[c] for c in failed])))
+
+
+timer.addLap("Harvesting root files")
+# write the limit values of all the combinations
+limitsOut = "limits.json"
+g = open(limitsOut, "w")
+g.write(json.dumps(list(limits.items()), sort_keys=True, indent=2))
+g.close()
 
 os.chdir(OWD)
 